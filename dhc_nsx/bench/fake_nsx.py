@@ -0,0 +1,369 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""A local stand-in for the subset of the NSX API used by dhcnsx
+
+Logical switches and ports are kept in memory.  Every request is delayed
+by ``latency`` seconds (plus up to ``jitter``), a ``failure_rate``
+fraction of them is answered with 503 Service Unavailable, and creating
+more than ``max_lports`` ports on a switch is refused with 409 Conflict.
+"""
+
+import BaseHTTPServer
+import collections
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+
+
+LSWITCH_PATH = re.compile(r'^/ws\.v1/lswitch(?:/(?P<ls>[^/]+))?$')
+LPORT_PATH = re.compile(
+    r'^/ws\.v1/lswitch/(?P<ls>[^/]+)/lport'
+    r'(?:/(?P<lp>[^/]+)(?P<attachment>/attachment)?)?$'
+)
+EMPTY_COLLECTIONS = (
+    '/ws.v1/lrouter',
+    '/ws.v1/security-profile',
+    '/ws.v1/transport-zone',
+)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=''):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def _tagged(obj, params):
+    """Whether obj matches the tag/tag_scope filters of a query."""
+    tags = obj.get('tags', [])
+    for tag in params.get('tag', []):
+        if not any(t['tag'] == tag for t in tags):
+            return False
+    for scope in params.get('tag_scope', []):
+        if not any(t['scope'] == scope for t in tags):
+            return False
+    return True
+
+
+class FakeNsxController(object):
+    """An in-memory NSX controller serving HTTP on ``address``.
+
+    `start` binds to a free port on 127.0.0.1 unless a port is given;
+    the actual address is then in `address`.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 max_lports=None, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.max_lports = max_lports
+        self.port = port
+        self.lswitches = collections.OrderedDict()
+        self.lports = collections.OrderedDict()
+        # (method, resource) -> number of requests served
+        self.requests = collections.Counter()
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self._server.server_address
+
+    def start(self):
+        controller = self
+
+        class Handler(_RequestHandler):
+            nsx = controller
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def populate(self, networks, ports_per_network, tenant_id='bench'):
+        """Create a switch per network and its ports, as dhcnsx would.
+
+        ``max_lports`` is not enforced.  Returns a list of (neutron network
+        id, [neutron port ids]).
+        """
+        result = []
+        for index in range(networks):
+            network_id = str(uuid.uuid4())
+            ls = self.create_lswitch({
+                'display_name': 'bench-%d' % index,
+                'tags': [{'scope': 'quantum_net_id', 'tag': network_id},
+                         {'scope': 'os_tid', 'tag': tenant_id}],
+            })
+            port_ids = []
+            for index in range(ports_per_network):
+                port_id = str(uuid.uuid4())
+                self.create_lport(ls['uuid'], check_limit=False, body={
+                    'display_name': port_id,
+                    'admin_status_enabled': True,
+                    'tags': [{'scope': 'q_port_id', 'tag': port_id},
+                             {'scope': 'os_tid', 'tag': tenant_id}],
+                    'attachment': {'type': 'VifAttachment',
+                                   'vif_uuid': port_id},
+                })
+                port_ids.append(port_id)
+            result.append((network_id, port_ids))
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lswitches': len(self.lswitches),
+                'lports': len(self.lports),
+                'injected_failures': self.failures,
+                'requests': dict(
+                    ('%s %s' % key, count)
+                    for key, count in self.requests.items()
+                ),
+            }
+
+    # resources
+
+    def create_lswitch(self, body):
+        with self._lock:
+            ls = dict(body, uuid=str(uuid.uuid4()), lport_count=0)
+            ls.setdefault('tags', [])
+            self.lswitches[ls['uuid']] = ls
+            return ls
+
+    def create_lport(self, ls_uuid, body, check_limit=True):
+        with self._lock:
+            ls = self._get(self.lswitches, ls_uuid)
+            if (check_limit and self.max_lports and
+                    ls['lport_count'] >= self.max_lports):
+                raise HTTPError(409, 'Logical switch %s is full' % ls_uuid)
+            lp = dict(body, uuid=str(uuid.uuid4()), ls_uuid=ls_uuid)
+            lp.setdefault('tags', [])
+            lp.setdefault('admin_status_enabled', True)
+            self.lports[lp['uuid']] = lp
+            ls['lport_count'] += 1
+            return lp
+
+    def _get(self, resources, resource_uuid):
+        try:
+            return resources[resource_uuid]
+        except KeyError:
+            raise HTTPError(404, '%s not found' % resource_uuid)
+
+    def _render_lswitch(self, ls, relations):
+        result = dict((k, v) for k, v in ls.items() if k != 'lport_count')
+        if 'LogicalSwitchStatus' in relations:
+            result['_relations'] = {'LogicalSwitchStatus': {
+                'fabric_status': True,
+                'lport_count': ls['lport_count'],
+            }}
+        return result
+
+    def _render_lport(self, lp, relations):
+        result = dict(
+            (k, v) for k, v in lp.items()
+            if k not in ('ls_uuid', 'attachment')
+        )
+        rendered = {}
+        if 'LogicalPortStatus' in relations:
+            up = bool(lp.get('attachment')) and lp['admin_status_enabled']
+            rendered['LogicalPortStatus'] = {
+                'fabric_status_up': up,
+                'link_status_up': up,
+            }
+        if 'LogicalSwitchConfig' in relations:
+            ls = self.lswitches[lp['ls_uuid']]
+            rendered['LogicalSwitchConfig'] = {
+                'uuid': ls['uuid'],
+                'display_name': ls.get('display_name'),
+                'tags': ls['tags'],
+            }
+        if 'LogicalPortAttachment' in relations:
+            rendered['LogicalPortAttachment'] = (
+                lp.get('attachment') or {'type': 'NoAttachment'}
+            )
+        if rendered:
+            result['_relations'] = rendered
+        return result
+
+    def _query(self, objects, params, render):
+        relations = params.get('relations', [])
+        matches = [obj for obj in objects if _tagged(obj, params)]
+        # the page cursor is the index of the first object of the page
+        start = int(params.get('_page_cursor', ['0'])[0] or 0)
+        length = int(params.get('_page_length', [len(matches) or 1])[0])
+        page = matches[start:start + length]
+        result = {
+            'results': [render(obj, relations) for obj in page],
+            'result_count': len(matches),
+        }
+        if start + length < len(matches):
+            result['page_cursor'] = str(start + length)
+        return result
+
+    def handle(self, method, path, params, body):
+        """Return the (status, body) of an API request."""
+        if path == '/ws.v1/control-cluster/node':
+            return 200, {'results': [{'uuid': 'fake-node'}],
+                         'result_count': 1}
+        if path in EMPTY_COLLECTIONS and method == 'GET':
+            return 200, {'results': [], 'result_count': 0}
+
+        match = LSWITCH_PATH.match(path)
+        if match:
+            return self._handle_lswitch(method, match.group('ls'), params,
+                                        body)
+        match = LPORT_PATH.match(path)
+        if match:
+            return self._handle_lport(method, match.group('ls'),
+                                      match.group('lp'),
+                                      match.group('attachment'), params,
+                                      body)
+        raise HTTPError(404, 'Unknown resource %s' % path)
+
+    def _handle_lswitch(self, method, ls_uuid, params, body):
+        relations = params.get('relations', [])
+        if ls_uuid is None:
+            if method == 'POST':
+                return 201, self._render_lswitch(
+                    self.create_lswitch(body), relations
+                )
+            with self._lock:
+                return 200, self._query(
+                    list(self.lswitches.values()), params,
+                    self._render_lswitch
+                )
+        with self._lock:
+            ls = self._get(self.lswitches, ls_uuid)
+            if method == 'GET':
+                return 200, self._render_lswitch(ls, relations)
+            if method == 'PUT':
+                ls.update(body)
+                return 200, self._render_lswitch(ls, relations)
+            if method == 'DELETE':
+                del self.lswitches[ls_uuid]
+                for lp_uuid in [lp_id for lp_id, lp in self.lports.items()
+                                if lp['ls_uuid'] == ls_uuid]:
+                    del self.lports[lp_uuid]
+                return 204, None
+        raise HTTPError(405)
+
+    def _handle_lport(self, method, ls_uuid, lp_uuid, attachment, params,
+                      body):
+        relations = params.get('relations', [])
+        if lp_uuid is None:
+            if method == 'POST':
+                return 201, self._render_lport(
+                    self.create_lport(ls_uuid, body), relations
+                )
+            with self._lock:
+                lports = list(self.lports.values())
+                if ls_uuid != '*':
+                    self._get(self.lswitches, ls_uuid)
+                    lports = [lp for lp in lports
+                              if lp['ls_uuid'] == ls_uuid]
+                return 200, self._query(lports, params, self._render_lport)
+        with self._lock:
+            lp = self._get(self.lports, lp_uuid)
+            if ls_uuid != '*' and lp['ls_uuid'] != ls_uuid:
+                raise HTTPError(404, '%s not found' % lp_uuid)
+            if attachment and method == 'PUT':
+                lp['attachment'] = body
+                return 200, body
+            if method == 'GET':
+                return 200, self._render_lport(lp, relations)
+            if method == 'PUT':
+                lp.update(body)
+                return 200, self._render_lport(lp, relations)
+            if method == 'DELETE':
+                del self.lports[lp_uuid]
+                self.lswitches[lp['ls_uuid']]['lport_count'] -= 1
+                return 204, None
+        raise HTTPError(405)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set by FakeNsxController.start
+    nsx = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=None, headers=()):
+        payload = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        # the API client reads the controller version from this header
+        self.send_header('Server', 'NVP/4.2.0.0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _dispatch(self):
+        nsx = self.nsx
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        for name in ('fields', 'relations'):
+            params[name] = [value for values in params.get(name, [])
+                            for value in values.split(',')]
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        resource = re.sub(r'/[0-9a-f-]{36}', '/<uuid>', url.path)
+        with nsx._lock:
+            nsx.requests[(self.command, resource)] += 1
+
+        delay = nsx.latency + random.random() * nsx.jitter
+        if delay:
+            time.sleep(delay)
+        if nsx.failure_rate and random.random() < nsx.failure_rate:
+            with nsx._lock:
+                nsx.failures += 1
+            return self._respond(503, {'error': 'injected failure'})
+
+        try:
+            if url.path == '/ws.v1/login':
+                return self._respond(200, headers=[
+                    ('Set-Cookie', 'nvp_sessionid=%s' % uuid.uuid4().hex)
+                ])
+            status, result = nsx.handle(
+                self.command, url.path, params,
+                json.loads(body) if body else {}
+            )
+        except HTTPError as e:
+            return self._respond(e.status, {'error': str(e)})
+        self._respond(status, result)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
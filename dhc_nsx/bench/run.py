@@ -0,0 +1,589 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks for the dhcnsx drivers, synchronizer and dhcnsx-convert
+
+The drivers and the synchronizer run against a FakeNsxController and a
+neutron database (an SQLite file unless --db-url is given); dhcnsx-convert
+runs against a generated dataset.  Results are written as JSON, e.g.::
+
+    dhcnsx-bench --scenario ports --ports 2000 --concurrency 32 \\
+        --latency 0.02 --output results.json
+"""
+
+import eventlet
+eventlet.monkey_patch()
+from eventlet import semaphore
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+
+from oslo.config import cfg
+import sqlalchemy as sa
+
+from neutron.api.v2 import attributes as attr
+from neutron.common import config as n_config
+from neutron import context as n_context
+from neutron.db import api as db_api
+from neutron.db import db_base_plugin_v2
+from neutron.db import external_net_db
+from neutron.db import model_base
+from neutron.db import models_v2
+from neutron.db import portsecurity_db
+from neutron.plugins.vmware.common import config as nsx_config  # noqa
+from neutron.plugins.vmware.common import nsx_utils
+from neutron.plugins.vmware.common import sync as nsx_sync
+# register the NSX mapping tables with the neutron metadata
+try:
+    from neutron.plugins.vmware.dbexts import nsx_models  # noqa
+except ImportError:
+    # stable/juno keeps the mapping models in dbexts.models
+    from neutron.plugins.vmware.dbexts import models as nsx_models  # noqa
+
+import dhc_nsx
+from dhc_nsx.bench import fake_nsx
+from dhc_nsx.cmd import convert
+from dhc_nsx.ml2 import extension_driver
+from dhc_nsx.ml2 import mech_driver
+from dhc_nsx.ml2 import metrics
+from dhc_nsx.ml2 import sync as dhcnsx_sync
+
+
+SCENARIOS = ('ports', 'sync', 'convert')
+
+
+class BenchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
+                  external_net_db.External_net_db_mixin,
+                  portsecurity_db.PortSecurityDbMixin):
+    """Core plugin the drivers and the synchronizer talk to.
+
+    Only the database side of ML2 is needed, so the plain DB plugin is
+    used and the drivers are called the way ML2 calls them.
+    """
+
+
+class DriverContext(object):
+    """The parts of an ML2 network or port context the driver uses"""
+
+    def __init__(self, plugin_context, current, original=None):
+        self._plugin_context = plugin_context
+        self.current = current
+        self.original = original
+
+
+def setup_neutron(args, controller):
+    """Point neutron at the fake controller and a fresh database."""
+    n_config.init([])
+    cfg.CONF.set_override(
+        'core_plugin', '%s.%s' % (__name__, BenchPlugin.__name__)
+    )
+    cfg.CONF.set_override('notify_nova_on_port_status_changes', False)
+    cfg.CONF.set_override('notify_nova_on_port_data_changes', False)
+    cfg.CONF.set_override('connection', args.db_url, 'database')
+    cfg.CONF.set_override('nsx_controllers', [controller.address])
+    cfg.CONF.set_override('nsx_user', 'admin')
+    cfg.CONF.set_override('nsx_password', 'admin')
+    cfg.CONF.set_override('default_tz_uuid', str(uuid.uuid4()))
+    cfg.CONF.set_override('concurrent_connections', args.connections, 'NSX')
+    if args.max_lports:
+        cfg.CONF.set_override('max_lp_per_overlay_ls', args.max_lports,
+                              'NSX')
+    cfg.CONF.set_override('async_backend', args.async_backend, 'dhcnsx')
+    cfg.CONF.set_override('inline_vif_attachment', args.inline_vif,
+                          'dhcnsx')
+    cfg.CONF.set_override('metrics_interval', 0, 'dhcnsx')
+
+    model_base.BASEV2.metadata.create_all(db_api.get_engine())
+
+
+class Recorder(object):
+    """Latency histogram, error count and wall time of one phase"""
+
+    def __init__(self):
+        self.latency = metrics.Histogram()
+        self.errors = 0
+        self.error_types = {}
+        self.started = self.finished = None
+
+    @contextlib.contextmanager
+    def measure(self):
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.errors += 1
+            name = e.__class__.__name__
+            self.error_types[name] = self.error_types.get(name, 0) + 1
+        finally:
+            self.latency.add(time.time() - started)
+
+    def run(self, pool, func, items):
+        self.started = time.time()
+        for item in items:
+            pool.spawn_n(func, item)
+        pool.waitall()
+        self.finished = time.time()
+
+    def result(self):
+        elapsed = self.finished - self.started
+        return {
+            'operations': self.latency.count,
+            'errors': self.errors,
+            'error_types': self.error_types,
+            'seconds': elapsed,
+            'throughput': self.latency.count / elapsed if elapsed else None,
+            'latency': self.latency.snapshot(),
+        }
+
+
+def bench_ports(args, controller):
+    """Create, update and delete ports through the driver and extension."""
+    plugin = BenchPlugin()
+    driver = mech_driver.NSXMechDriver()
+    driver.initialize()
+    extension = extension_driver.PortSecurityExtension()
+    extension.initialize()
+
+    # SQLite cannot hold concurrent write transactions: serialize them,
+    # NSX calls included, rather than fail on a locked database
+    transactions = semaphore.Semaphore(
+        1 if args.db_url.startswith('sqlite') else args.concurrency
+    )
+
+    @contextlib.contextmanager
+    def transaction(ctx):
+        with transactions:
+            with ctx.session.begin(subtransactions=True):
+                yield
+
+    ctx = n_context.get_admin_context()
+    networks = []
+    for index in range(args.networks):
+        data = {
+            'name': 'bench-%d' % index,
+            'tenant_id': 'bench',
+            'admin_state_up': True,
+            'shared': False,
+            'port_security_enabled': attr.ATTR_NOT_SPECIFIED,
+        }
+        with transaction(ctx):
+            network = plugin.create_network(ctx, {'network': data})
+            extension.process_create_network(ctx.session, data, network)
+            driver.create_network_precommit(DriverContext(ctx, network))
+        driver.create_network_postcommit(DriverContext(ctx, network))
+        networks.append(network)
+
+    pool = eventlet.GreenPool(args.concurrency)
+    ports = {}
+    results = {}
+
+    create = Recorder()
+
+    def create_port(index):
+        ctx = n_context.get_admin_context()
+        data = {
+            'name': 'bench-%d' % index,
+            'tenant_id': 'bench',
+            'network_id': networks[index % len(networks)]['id'],
+            'admin_state_up': True,
+            'mac_address': attr.ATTR_NOT_SPECIFIED,
+            'fixed_ips': attr.ATTR_NOT_SPECIFIED,
+            'device_id': str(uuid.uuid4()),
+            'device_owner': 'compute:bench',
+            'port_security_enabled': attr.ATTR_NOT_SPECIFIED,
+        }
+        with create.measure():
+            with transaction(ctx):
+                port = plugin.create_port(ctx, {'port': data})
+                extension.process_create_port(ctx.session, data, port)
+                port.setdefault('security_groups', [])
+                port.setdefault('allowed_address_pairs', [])
+                driver.create_port_precommit(DriverContext(ctx, port))
+            driver.create_port_postcommit(DriverContext(ctx, port))
+            extension.extend_port_dict(ctx.session, port)
+            ports[index] = port
+
+    create.run(pool, create_port, range(args.ports))
+    results['create'] = create.result()
+
+    update = Recorder()
+
+    def update_port(index):
+        ctx = n_context.get_admin_context()
+        original = ports[index]
+        current = dict(original, name='%s-updated' % original['name'])
+        with update.measure():
+            with transaction(ctx):
+                plugin.update_port(
+                    ctx, current['id'], {'port': {'name': current['name']}}
+                )
+                driver.update_port_precommit(
+                    DriverContext(ctx, current, original)
+                )
+            driver.update_port_postcommit(
+                DriverContext(ctx, current, original)
+            )
+            ports[index] = current
+
+    update.run(pool, update_port, sorted(ports))
+    results['update'] = update.result()
+
+    delete = Recorder()
+
+    def delete_port(index):
+        ctx = n_context.get_admin_context()
+        port = ports[index]
+        with delete.measure():
+            with transaction(ctx):
+                driver.delete_port_precommit(DriverContext(ctx, port))
+                plugin.delete_port(ctx, port['id'])
+            driver.delete_port_postcommit(DriverContext(ctx, port))
+
+    delete.run(pool, delete_port, sorted(ports))
+    results['delete'] = delete.result()
+
+    if driver._backend_queue:
+        driver._backend_queue.waitall()
+    results['driver_metrics'] = driver.metrics.snapshot()
+    results['controller'] = controller.stats()
+    return results
+
+
+def bench_sync(args, controller):
+    """Time full synchronizer sweeps over pre-populated NSX objects."""
+    plugin = BenchPlugin()
+    ports_per_network = max(args.sync_objects // args.networks, 1)
+    objects = controller.populate(args.networks, ports_per_network)
+
+    session = db_api.get_session()
+    with session.begin():
+        for network_id, port_ids in objects:
+            session.add(models_v2.Network(
+                id=network_id, tenant_id='bench', name=network_id,
+                status='DOWN', admin_state_up=True, shared=False
+            ))
+            for port_id in port_ids:
+                session.add(models_v2.Port(
+                    id=port_id, tenant_id='bench', name=port_id,
+                    network_id=network_id,
+                    mac_address=_mac_address(port_id),
+                    admin_state_up=True, status='DOWN',
+                    device_id=port_id, device_owner='compute:bench'
+                ))
+
+    cluster = nsx_utils.create_nsx_cluster(
+        cfg.CONF,
+        args.connections,
+        cfg.CONF.NSX.nsx_gen_timeout
+    )
+    sync_metrics = metrics.Metrics()
+    metrics.instrument_api_client(cluster.api_client, sync_metrics)
+    synchronizer = dhcnsx_sync.AkandaNsxSynchronizer(
+        plugin, cluster, 3600, 0, args.sync_chunk_size, 0
+    )
+    # sweeps are driven below, not by the looping call
+    synchronizer._sync_looping_call.stop()
+
+    # the first sweep also scans neutron for objects missing from NSX
+    sp = nsx_sync.SyncParameters(args.sync_chunk_size)
+    sweeps = []
+    for index in range(args.sync_sweeps):
+        started = time.time()
+        chunks = 0
+        while True:
+            synchronizer._synchronize_state(sp)
+            chunks += 1
+            if sp.current_chunk == 0:
+                break
+        sweeps.append({'seconds': time.time() - started,
+                       'chunks': chunks})
+
+    active = session.query(models_v2.Port).filter_by(
+        status='ACTIVE'
+    ).count()
+    return {
+        'networks': len(objects),
+        'ports': len(objects) * ports_per_network,
+        'active_ports': active,
+        'sweeps': sweeps,
+        'cache_memory': synchronizer.cache_memory(),
+        'controller_metrics': sync_metrics.snapshot()['controllers'],
+        'controller': controller.stats(),
+    }
+
+
+def _mac_address(port_id):
+    digits = port_id.replace('-', '')[-10:]
+    return 'fa:16:' + ':'.join(
+        digits[index:index + 2] for index in range(0, 10, 2)
+    )
+
+
+def generate_convert_dataset(engine, networks, ports, vnis):
+    """Create the tables dhcnsx-convert reads and fill them.
+
+    The tables must not exist yet: they are dropped once the benchmark is
+    done, so an existing neutron database is refused rather than altered.
+    """
+    metadata = sa.MetaData()
+    tables = [
+        sa.Table('networks', metadata,
+                 sa.Column('id', sa.String(36), primary_key=True),
+                 sa.Column('name', sa.String(255))),
+        sa.Table('ports', metadata,
+                 sa.Column('id', sa.String(36), primary_key=True),
+                 sa.Column('network_id', sa.String(36))),
+        sa.Table('ml2_network_segments', metadata,
+                 sa.Column('id', sa.String(36), primary_key=True),
+                 sa.Column('network_id', sa.String(36)),
+                 sa.Column('network_type', sa.String(32)),
+                 sa.Column('physical_network', sa.String(64)),
+                 sa.Column('segmentation_id', sa.Integer),
+                 sa.Column('is_dynamic', sa.Boolean)),
+        sa.Table('portbindingports', metadata,
+                 sa.Column('port_id', sa.String(36), primary_key=True),
+                 sa.Column('host', sa.String(255))),
+        sa.Table('ml2_port_bindings', metadata,
+                 sa.Column('port_id', sa.String(36), primary_key=True),
+                 sa.Column('host', sa.String(255)),
+                 sa.Column('vif_type', sa.String(64)),
+                 sa.Column('driver', sa.String(64)),
+                 sa.Column('segment', sa.String(36)),
+                 sa.Column('vnic_type', sa.String(64)),
+                 sa.Column('vif_details', sa.String(4095)),
+                 sa.Column('profile', sa.String(4095), default='')),
+        sa.Table('ml2_vxlan_allocations', metadata,
+                 sa.Column('vxlan_vni', sa.Integer, primary_key=True,
+                           autoincrement=False),
+                 sa.Column('allocated', sa.Boolean, nullable=False,
+                           default=False)),
+    ]
+    existing = set(sa.inspect(engine).get_table_names()).intersection(
+        table.name for table in tables
+    )
+    if existing:
+        raise RuntimeError(
+            'The convert database already has the tables %s; the convert '
+            'benchmark needs an empty database' % ', '.join(sorted(existing))
+        )
+    metadata.create_all(engine)
+    tables = dict((table.name, table) for table in tables)
+
+    network_ids = [str(uuid.uuid4()) for index in range(networks)]
+    port_rows = [
+        {'id': str(uuid.uuid4()), 'network_id': network_ids[index % networks]}
+        for index in range(ports)
+    ]
+    batch = 5000
+    try:
+        with engine.begin() as conn:
+            for start in range(0, networks, batch):
+                conn.execute(tables['networks'].insert(), [
+                    {'id': network_id, 'name': network_id}
+                    for network_id in network_ids[start:start + batch]
+                ])
+            for start in range(0, ports, batch):
+                rows = port_rows[start:start + batch]
+                conn.execute(tables['ports'].insert(), rows)
+                conn.execute(tables['portbindingports'].insert(), [
+                    {'port_id': row['id'], 'host': 'bench'} for row in rows
+                ])
+            for start in range(0, vnis, batch):
+                conn.execute(tables['ml2_vxlan_allocations'].insert(), [
+                    {'vxlan_vni': 1000 + vni, 'allocated': False}
+                    for vni in range(start, min(start + batch, vnis))
+                ])
+    except Exception:
+        metadata.drop_all(engine)
+        raise
+    return metadata
+
+
+def bench_convert(args, controller):
+    """Time dhcnsx-convert over a generated dataset."""
+    url = args.convert_db_url
+    engine = sa.create_engine(url)
+    metadata = generate_convert_dataset(
+        engine,
+        args.convert_networks,
+        args.convert_ports,
+        args.convert_networks
+    )
+    # keep the progress output of dhcnsx-convert out of the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        started = time.time()
+        convert.convert_nsx_to_ml2(
+            url,
+            batch_size=args.convert_batch_size,
+            progress_interval=3600,
+            workers=args.convert_workers
+        )
+        elapsed = time.time() - started
+        sys.stdout = stdout
+        segments, bindings = [
+            engine.execute(
+                sa.select([sa.func.count()]).select_from(
+                    metadata.tables[name]
+                )
+            ).scalar()
+            for name in ('ml2_network_segments', 'ml2_port_bindings')
+        ]
+        return {
+            'networks': args.convert_networks,
+            'ports': args.convert_ports,
+            'dialect': engine.dialect.name,
+            'segments': segments,
+            'bindings': bindings,
+            'seconds': elapsed,
+        }
+    finally:
+        sys.stdout = stdout
+        metadata.drop_all(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark dhcnsx against a local fake NSX controller'
+    )
+    parser.add_argument(
+        '--scenario',
+        action='append',
+        choices=SCENARIOS,
+        help='Scenario to run; may be repeated (default: all)'
+    )
+    parser.add_argument(
+        '--output',
+        help='File the JSON results are written to (default: stdout)'
+    )
+    parser.add_argument(
+        '--db-url',
+        help='Empty database the drivers and the synchronizer run '
+             'against (default: an SQLite file in a temporary directory)'
+    )
+
+    nsx = parser.add_argument_group('fake NSX controller')
+    nsx.add_argument('--latency', default=0.0, type=float,
+                     help='Seconds every request is delayed by')
+    nsx.add_argument('--jitter', default=0.0, type=float,
+                     help='Maximum random delay added to --latency')
+    nsx.add_argument('--failure-rate', default=0.0, type=float,
+                     help='Fraction of requests answered with a 503')
+    nsx.add_argument('--max-lports', default=None, type=int,
+                     help='Maximum number of ports per logical switch; '
+                          'also used as max_lp_per_overlay_ls')
+    nsx.add_argument('--connections', default=10, type=int,
+                     help='concurrent_connections of the NSX API client')
+
+    ports = parser.add_argument_group('ports scenario')
+    ports.add_argument('--networks', default=10, type=int,
+                       help='Number of networks ports are spread over '
+                            '(also used by the sync scenario)')
+    ports.add_argument('--ports', default=1000, type=int,
+                       help='Number of ports created, updated and deleted')
+    ports.add_argument('--concurrency', default=16, type=int,
+                       help='Number of operations in flight at a time')
+    ports.add_argument('--async-backend', action='store_true',
+                       help='Enable the async_backend driver option')
+    ports.add_argument('--inline-vif', action='store_true',
+                       help='Enable the inline_vif_attachment driver option')
+
+    sync = parser.add_argument_group('sync scenario')
+    sync.add_argument('--sync-objects', default=10000, type=int,
+                      help='Number of ports in NSX and neutron')
+    sync.add_argument('--sync-chunk-size', default=500, type=int,
+                      help='Synchronizer chunk size')
+    sync.add_argument('--sync-sweeps', default=2, type=int,
+                      help='Number of full sweeps timed')
+
+    conversion = parser.add_argument_group('convert scenario')
+    conversion.add_argument('--convert-db-url',
+                            help='Empty database the dataset is generated '
+                                 'in (default: an SQLite file in a '
+                                 'temporary directory)')
+    conversion.add_argument('--convert-networks', default=10000, type=int,
+                            help='Number of networks to migrate')
+    conversion.add_argument('--convert-ports', default=100000, type=int,
+                            help='Number of port bindings to migrate')
+    conversion.add_argument('--convert-batch-size', default=500, type=int,
+                            help='dhcnsx-convert --batch-size')
+    conversion.add_argument('--convert-workers', default=1, type=int,
+                            help='dhcnsx-convert --workers')
+
+    args = parser.parse_args()
+    scenarios = args.scenario or SCENARIOS
+
+    results = {
+        'version': dhc_nsx.__version__,
+        'timestamp': time.time(),
+        'parameters': dict(
+            (name, value) for name, value in vars(args).items()
+            if name not in ('output', 'db_url', 'convert_db_url')
+        ),
+        'results': {},
+    }
+    benchmarks = {
+        'ports': bench_ports,
+        'sync': bench_sync,
+        'convert': bench_convert,
+    }
+    workdir = tempfile.mkdtemp(prefix='dhcnsx-bench-')
+    args.db_url = args.db_url or 'sqlite:///%s' % os.path.join(
+        workdir, 'neutron.db'
+    )
+    args.convert_db_url = args.convert_db_url or 'sqlite:///%s' % (
+        os.path.join(workdir, 'convert.db')
+    )
+    controller = fake_nsx.FakeNsxController(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        max_lports=args.max_lports
+    )
+    controller.start()
+
+    failed = False
+    try:
+        if 'ports' in scenarios or 'sync' in scenarios:
+            setup_neutron(args, controller)
+        for scenario in scenarios:
+            print >>sys.stderr, 'Running %s benchmark' % scenario
+            try:
+                results['results'][scenario] = benchmarks[scenario](
+                    args, controller
+                )
+            except Exception as e:
+                traceback.print_exc()
+                results['results'][scenario] = {'error': str(e)}
+                failed = True
+    finally:
+        controller.stop()
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    return 1 if failed else 0
@@ -0,0 +1,657 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Finds, and optionally repairs, drift between neutron and NSX
+
+Run with the configuration files of neutron-server::
+
+    dhcnsx-audit --config-file /etc/neutron/neutron.conf \\
+        --config-file /etc/neutron/plugins/ml2/ml2_conf.ini [--repair]
+
+NSX logical switches are listed page by page, and the ports of up to
+--concurrency switches at a time, while the neutron networks and ports
+and their NSX mappings are read from the database in pages ordered by
+id.  The streams are joined on the neutron id NSX objects are tagged
+with, keeping only what is not matched yet, in hash tables keyed by
+packed ids.  What ends up unmatched, or matched to a neutron resource
+mapped to another NSX object, is checked again against the database and
+NSX in batches of --batch-size, since both keep changing while the audit
+runs.  The driver creates NSX objects before the transaction adding their
+neutron resource commits, so a resource being created looks like an
+orphan or a missing mapping: what the check finds is checked once more,
+at least --grace-period seconds later, and only confirmed if it still
+differs.  Every confirmed difference is written as a JSON line:
+
+orphaned_lswitch, orphaned_lport
+    NSX object of a neutron network or port that does not exist; deleted
+    with --repair
+missing_network_mapping, missing_port_mapping
+    NSX object of a neutron resource that has no mapping to it; the
+    mapping is added with --repair
+stale_port_mapping
+    port mapped to an NSX port that does not exist, while another one is
+    tagged with its id; the mapping is pointed at that one with --repair
+duplicate_lport
+    NSX port tagged with the id of a port mapped to another, existing NSX
+    port; only reported
+missing_lswitch, missing_lport
+    neutron network or port without any NSX object; only reported
+
+Each unmatched object takes about a hundred bytes.  --partitions splits
+the audit into as many passes over a share of the ids each, dividing the
+memory needed by as much at the cost of listing NSX once per pass.
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import collections
+import json
+import sys
+import time
+import uuid
+import zlib
+
+from eventlet import queue
+from oslo.config import cfg
+import six
+
+from neutron.common import config as n_config
+from neutron.common import constants as n_const
+from neutron.common import exceptions as n_exc
+from neutron import context as n_context
+from neutron.db import models_v2
+from neutron.openstack.common import log
+from neutron.plugins.vmware.common import config as nsx_config  # noqa
+from neutron.plugins.vmware.dbexts import db as nsx_db
+try:
+    from neutron.plugins.vmware.dbexts import nsx_models
+except ImportError:
+    # stable/juno keeps the mapping models in dbexts.models
+    from neutron.plugins.vmware.dbexts import models as nsx_models
+from neutron.plugins.vmware import nsxlib
+from neutron.plugins.vmware.nsxlib import switch as switchlib
+
+from dhc_nsx.ml2 import api_client
+from dhc_nsx.ml2 import config as dhcnsx_config  # noqa
+from dhc_nsx.ml2 import db as dhcnsx_db
+from dhc_nsx.ml2 import metrics
+from dhc_nsx.ml2 import nsxlib as dhcnsx_lib
+
+
+LOG = log.getLogger(__name__)
+
+cli_opts = [
+    cfg.BoolOpt('repair', default=False,
+                help='Repair the differences that can be, instead of only '
+                     'reporting them'),
+    cfg.IntOpt('page-size', default=1000,
+               help='Number of NSX objects or neutron rows fetched per '
+                    'request'),
+    cfg.IntOpt('batch-size', default=500,
+               help='Number of differences of a kind checked and repaired '
+                    'at a time'),
+    cfg.IntOpt('concurrency', default=8,
+               help='Number of logical switches whose ports are listed at '
+                    'the same time, and of NSX requests made per batch'),
+    cfg.IntOpt('partitions', default=1,
+               help='Number of passes the ids are split over, each listing '
+                    'NSX again'),
+    cfg.StrOpt('output',
+               help='File the differences are written to as JSON lines '
+                    '(default: standard output)'),
+    cfg.IntOpt('progress-interval', default=10,
+               help='Minimum number of seconds between progress lines'),
+    cfg.IntOpt('grace-period', default=60,
+               help='Minimum number of seconds between finding a '
+                    'difference and confirming it; resources being created '
+                    'or deleted meanwhile are not reported'),
+]
+cfg.CONF.register_cli_opts(cli_opts)
+
+# tags holding the neutron id of NSX objects
+NEUTRON_ID_TAGS = {
+    'network': 'quantum_net_id',
+    'port': 'q_port_id',
+}
+
+# pages waiting to be joined; the streams block beyond this
+QUEUE_SIZE = 16
+
+# names of the object counts by (side, kind)
+COUNTS = {
+    ('nsx', 'network'): 'nsx_lswitches',
+    ('nsx', 'port'): 'nsx_lports',
+    ('neutron', 'network'): 'neutron_networks',
+    ('neutron', 'port'): 'neutron_ports',
+}
+
+
+def pack(resource_id):
+    """Return a compact, hashable form of a neutron or NSX id."""
+    try:
+        return uuid.UUID(resource_id).bytes
+    except (TypeError, ValueError):
+        # not a uuid; kept as text so that unpack can tell
+        return six.text_type(resource_id)
+
+
+def unpack(packed):
+    if packed is None or isinstance(packed, six.text_type):
+        return packed
+    return str(uuid.UUID(bytes=packed))
+
+
+class Join(object):
+    """Symmetric hash join of NSX objects and neutron rows on neutron id
+
+    Only what is not matched yet is kept: NSX objects whose neutron row
+    was not read yet, and neutron rows whose NSX object was not listed
+    yet.  A match whose NSX object is not one the row is mapped to, and
+    whatever is left once both streams end, are candidate differences.
+
+    NSX objects are (packed uuid, packed parent switch uuid) tuples;
+    neutron rows are the tuple of the packed uuids they are mapped to.
+    """
+
+    def __init__(self):
+        self.nsx = {}
+        self.neutron = {}
+
+    def add_nsx(self, key, nsx_object):
+        """Return whether nsx_object is a candidate difference."""
+        mapped = self.neutron.pop(key, None)
+        if mapped is None:
+            self.nsx.setdefault(key, []).append(nsx_object)
+            return False
+        return nsx_object[0] not in mapped
+
+    def add_neutron(self, key, mapped):
+        """Return the NSX objects of key that are candidate differences."""
+        nsx_objects = self.nsx.pop(key, None)
+        if nsx_objects is None:
+            self.neutron[key] = mapped
+            return []
+        return [nsx_object for nsx_object in nsx_objects
+                if nsx_object[0] not in mapped]
+
+    def __len__(self):
+        return len(self.nsx) + len(self.neutron)
+
+
+class Auditor(object):
+    """Streams, joins, checks and repairs; see the module docstring"""
+
+    def __init__(self, cluster, output, repair, page_size, batch_size,
+                 concurrency, progress_interval, grace_period=0):
+        self.cluster = cluster
+        self.output = output
+        self.repair = repair
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.grace_period = grace_period
+        self.counts = collections.Counter()
+        self._pool = eventlet.GreenPool(concurrency)
+        self._batches = collections.defaultdict(list)
+        # (due time, kind, side, batch) of differences found once, in the
+        # order they are due
+        self._unconfirmed = collections.deque()
+        self._joins = {}
+        self._last_progress = 0
+
+    def run(self, partitions):
+        for index in range(partitions):
+            self._joins = {'network': Join(), 'port': Join()}
+            self._run_pass(
+                lambda key: zlib.crc32(
+                    key.encode('utf-8')
+                    if isinstance(key, six.text_type) else key
+                ) % partitions == index
+            )
+            for kind, join in self._joins.items():
+                for key, nsx_objects in six.iteritems(join.nsx):
+                    for nsx_object in nsx_objects:
+                        self._candidate(kind, 'nsx', key, nsx_object)
+                for key, mapped in six.iteritems(join.neutron):
+                    self._candidate(kind, 'neutron', key, mapped)
+            self._joins = {}
+        for (kind, side), batch in self._batches.items():
+            if batch:
+                self._check(kind, side, batch)
+        self._batches.clear()
+        self._confirm(wait=True)
+        return self.counts
+
+    def _run_pass(self, owned):
+        pages = queue.LightQueue(QUEUE_SIZE)
+        streams = [self._nsx_stream, self._network_stream, self._port_stream]
+
+        def produce(stream):
+            try:
+                stream(pages.put, owned)
+            except Exception as e:
+                LOG.exception("Unable to stream %s", stream.__name__)
+                pages.put(e)
+            pages.put(None)
+
+        producers = [eventlet.spawn(produce, stream) for stream in streams]
+        running = len(producers)
+        try:
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    self._join(*page)
+        finally:
+            for producer in producers:
+                producer.kill()
+
+    def _join(self, side, kind, items):
+        join = self._joins[kind]
+        self.counts[COUNTS[side, kind]] += len(items)
+        for key, value in items:
+            if side == 'nsx':
+                if join.add_nsx(key, value):
+                    self._candidate(kind, side, key, value)
+            else:
+                for nsx_object in join.add_neutron(key, value):
+                    self._candidate(kind, 'nsx', key, nsx_object)
+        self._progress()
+
+    def _progress(self):
+        now = time.time()
+        if now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        sys.stderr.write(
+            'nsx %d lswitches %d lports, neutron %d networks %d ports, '
+            '%d unmatched\n' % (
+                self.counts['nsx_lswitches'], self.counts['nsx_lports'],
+                self.counts['neutron_networks'], self.counts['neutron_ports'],
+                sum(len(join) for join in self._joins.values())
+            )
+        )
+
+    def _tagged(self, kind, nsx_objects, parent, owned):
+        """Return the (key, NSX object) pairs of the owned objects."""
+        scope = NEUTRON_ID_TAGS[kind]
+        items = []
+        for nsx_object in nsx_objects:
+            neutron_id = None
+            for tag in nsx_object.get('tags', []):
+                if tag['scope'] == scope:
+                    neutron_id = tag['tag']
+            if not neutron_id:
+                continue
+            key = pack(neutron_id)
+            if owned(key):
+                items.append((key, (pack(nsx_object['uuid']), parent)))
+        return items
+
+    def _nsx_stream(self, put, owned):
+        """List the switches, and the ports of concurrency at a time."""
+        lswitch_path = nsxlib._build_uri_path(
+            switchlib.LSWITCH_RESOURCE, fields='uuid,tags'
+        )
+        lport_pool = eventlet.GreenPool(self.concurrency)
+        errors = []
+
+        def list_lports(lswitch_uuid):
+            path = nsxlib._build_uri_path(
+                switchlib.LSWITCHPORT_RESOURCE,
+                parent_resource_id=lswitch_uuid,
+                fields='uuid,tags'
+            )
+            try:
+                for lports in dhcnsx_lib.iter_query_pages(
+                        self.cluster, path, self.page_size):
+                    put(('nsx', 'port', self._tagged(
+                        'port', lports, pack(lswitch_uuid), owned
+                    )))
+            except n_exc.NotFound:
+                # deleted since it was listed
+                pass
+            except Exception as e:
+                errors.append(e)
+
+        for lswitches in dhcnsx_lib.iter_query_pages(
+                self.cluster, lswitch_path, self.page_size):
+            put(('nsx', 'network', self._tagged(
+                'network', lswitches, None, owned
+            )))
+            for lswitch in lswitches:
+                if errors:
+                    raise errors[0]
+                lport_pool.spawn_n(list_lports, lswitch['uuid'])
+        lport_pool.waitall()
+        if errors:
+            raise errors[0]
+
+    def _neutron_stream(self, put, owned, kind, column, mapped, *criteria):
+        """Read the ids in column in pages ordered by id."""
+        session = n_context.get_admin_context().session
+        last = None
+        while True:
+            query = session.query(column).filter(*criteria)
+            if last is not None:
+                query = query.filter(column > last)
+            ids = [row[0] for row in
+                   query.order_by(column).limit(self.page_size)]
+            if not ids:
+                return
+            last = ids[-1]
+            keys = dict((resource_id, pack(resource_id))
+                        for resource_id in ids)
+            ids = [resource_id for resource_id in ids
+                   if owned(keys[resource_id])]
+            mappings = mapped(session, ids)
+            put(('neutron', kind, [
+                (keys[resource_id], mappings.get(resource_id, ()))
+                for resource_id in ids
+            ]))
+
+    def _network_stream(self, put, owned):
+        def mapped(session, network_ids):
+            return dict(
+                (network_id, tuple(pack(nsx_id) for nsx_id in nsx_ids))
+                for network_id, nsx_ids in dhcnsx_db.get_nsx_switch_ids(
+                    session, network_ids
+                ).items()
+            )
+
+        self._neutron_stream(
+            put, owned, 'network', models_v2.Network.id, mapped
+        )
+
+    def _port_stream(self, put, owned):
+        def mapped(session, port_ids):
+            return dict(
+                (port_id, (pack(nsx_port_id),))
+                for port_id, (nsx_switch_id, nsx_port_id)
+                in dhcnsx_db.get_nsx_switch_and_port_ids(
+                    session, port_ids
+                ).items()
+            )
+
+        # floating IP ports have no NSX port
+        self._neutron_stream(
+            put, owned, 'port', models_v2.Port.id, mapped,
+            models_v2.Port.device_owner != n_const.DEVICE_OWNER_FLOATINGIP
+        )
+
+    def _candidate(self, kind, side, key, value):
+        batch = self._batches[kind, side]
+        batch.append((unpack(key), value))
+        if len(batch) >= self.batch_size:
+            del self._batches[kind, side]
+            self._check(kind, side, batch)
+        self._confirm()
+
+    def _confirm(self, wait=False):
+        """Check again the differences found at least grace_period ago.
+
+        With wait, every difference is checked again, once it is due.
+        """
+        while self._unconfirmed:
+            due, kind, side, batch = self._unconfirmed[0]
+            delay = due - time.time()
+            if delay > 0:
+                if not wait:
+                    return
+                eventlet.sleep(delay)
+            self._unconfirmed.popleft()
+            self._check(kind, side, batch, confirm=True)
+
+    def _check(self, kind, side, batch, confirm=False):
+        """Check a batch of candidates, then report and repair them.
+
+        Unless confirm is set or there is no grace period, the candidates
+        found to differ are only kept to be checked again once it is over.
+        """
+        session = n_context.get_admin_context().session
+        model = models_v2.Network if kind == 'network' else models_v2.Port
+        neutron_ids = [neutron_id for neutron_id, value in batch]
+        existing = set(
+            row[0] for row in session.query(model.id).filter(
+                model.id.in_(neutron_ids)
+            )
+        )
+        if side == 'nsx' and kind == 'network':
+            differences = self._check_lswitches(session, batch, existing)
+        elif side == 'nsx':
+            differences = self._check_lports(session, batch, existing)
+        else:
+            differences = self._check_missing(kind, batch, existing)
+
+        if self.grace_period and not confirm:
+            if side == 'nsx':
+                found = set((difference['neutron_id'], difference['nsx_id'])
+                            for difference in differences)
+                batch = [(neutron_id, value) for neutron_id, value in batch
+                         if (neutron_id, unpack(value[0])) in found]
+            else:
+                found = set(difference['neutron_id']
+                            for difference in differences)
+                batch = [(neutron_id, value) for neutron_id, value in batch
+                         if neutron_id in found]
+            if batch:
+                self._unconfirmed.append((
+                    time.time() + self.grace_period, kind, side, batch
+                ))
+            return
+
+        by_type = collections.defaultdict(list)
+        for difference in differences:
+            by_type[difference['type']].append(difference)
+        for difference_type, found in sorted(by_type.items()):
+            self.counts[difference_type] += len(found)
+            repair = getattr(self, '_repair_%s' % difference_type, None)
+            if self.repair and repair:
+                repair(session, found)
+            for difference in found:
+                self.output.write(json.dumps(difference, sort_keys=True))
+                self.output.write('\n')
+        self.output.flush()
+
+    def _check_lswitches(self, session, batch, existing):
+        mappings = dhcnsx_db.get_nsx_switch_ids(
+            session, [network_id for network_id, value in batch]
+        )
+        for network_id, (lswitch_uuid, parent) in batch:
+            lswitch_uuid = unpack(lswitch_uuid)
+            if network_id not in existing:
+                difference_type = 'orphaned_lswitch'
+            elif lswitch_uuid not in mappings.get(network_id, ()):
+                difference_type = 'missing_network_mapping'
+            else:
+                continue
+            yield {'type': difference_type, 'neutron_id': network_id,
+                   'nsx_id': lswitch_uuid}
+
+    def _check_lports(self, session, batch, existing):
+        mappings = dhcnsx_db.get_nsx_switch_and_port_ids(
+            session, [port_id for port_id, value in batch]
+        )
+        conflicts = []
+        for port_id, (lport_uuid, lswitch_uuid) in batch:
+            difference = {'neutron_id': port_id,
+                          'nsx_id': unpack(lport_uuid),
+                          'lswitch_id': unpack(lswitch_uuid)}
+            mapping = mappings.get(port_id)
+            if port_id not in existing:
+                difference['type'] = 'orphaned_lport'
+            elif mapping is None:
+                difference['type'] = 'missing_port_mapping'
+            elif mapping[1] != difference['nsx_id']:
+                difference['mapped_nsx_id'] = mapping[1]
+                conflicts.append((difference, mapping))
+                continue
+            else:
+                continue
+            yield difference
+
+        # a mapping to a port that is gone is stale; otherwise this port
+        # is a second one for the same neutron port
+        def mapped_lport_exists(mapping):
+            try:
+                switchlib.get_port(self.cluster, mapping[0], mapping[1])
+            except n_exc.NotFound:
+                return False
+            return True
+
+        for (difference, mapping), exists in zip(conflicts, self._pool.imap(
+                mapped_lport_exists,
+                [conflict[1] for conflict in conflicts])):
+            difference['type'] = (
+                'duplicate_lport' if exists else 'stale_port_mapping'
+            )
+            yield difference
+
+    def _check_missing(self, kind, batch, existing):
+        """Confirm that neutron resources still have no NSX object."""
+        if kind == 'network':
+            resource, parent = switchlib.LSWITCH_RESOURCE, None
+        else:
+            resource, parent = switchlib.LSWITCHPORT_RESOURCE, '*'
+        neutron_ids = [neutron_id for neutron_id, value in batch
+                       if neutron_id in existing]
+
+        def nsx_object_exists(neutron_id):
+            path = nsxlib._build_uri_path(
+                resource,
+                parent_resource_id=parent,
+                fields='uuid',
+                filters={'tag': neutron_id,
+                         'tag_scope': NEUTRON_ID_TAGS[kind]}
+            )
+            results, page_cursor, total = nsxlib.get_single_query_page(
+                path, self.cluster, page_length=1, neutron_only=False
+            )
+            return bool(results)
+
+        for neutron_id, exists in zip(neutron_ids, self._pool.imap(
+                nsx_object_exists, neutron_ids)):
+            if not exists:
+                nsx_kind = 'lswitch' if kind == 'network' else 'lport'
+                yield {'type': 'missing_%s' % nsx_kind,
+                       'neutron_id': neutron_id}
+
+    def _repair_each(self, found, repair, concurrent=True):
+        """Run repair on every difference, recording whether it worked.
+
+        Repairs made through the batch's session must not be concurrent.
+        """
+        def attempt(difference):
+            try:
+                repair(difference)
+            except Exception:
+                LOG.exception("Unable to repair %s", difference)
+                return False
+            return True
+
+        results = (self._pool.imap(attempt, found) if concurrent
+                   else map(attempt, found))
+        for difference, repaired in zip(found, results):
+            difference['repaired'] = repaired
+            self.counts['repaired' if repaired else 'repair_failed'] += 1
+
+    def _repair_orphaned_lswitch(self, session, found):
+        # the ports left on it are deleted with it
+        self._repair_each(found, lambda difference: (
+            dhcnsx_lib.delete_lswitches(
+                self.cluster, [difference['nsx_id']], 1
+            )
+        ))
+
+    def _repair_orphaned_lport(self, session, found):
+        def delete(difference):
+            try:
+                switchlib.delete_port(
+                    self.cluster, difference['lswitch_id'],
+                    difference['nsx_id']
+                )
+            except n_exc.NotFound:
+                # gone already, e.g. with its orphaned switch
+                pass
+
+        self._repair_each(found, delete)
+
+    def _repair_missing_network_mapping(self, session, found):
+        self._repair_each(found, lambda difference: (
+            nsx_db.add_neutron_nsx_network_mapping(
+                session, difference['neutron_id'], difference['nsx_id']
+            )
+        ), concurrent=False)
+
+    def _repair_missing_port_mapping(self, session, found):
+        self._repair_each(found, lambda difference: (
+            nsx_db.add_neutron_nsx_port_mapping(
+                session, difference['neutron_id'],
+                difference['lswitch_id'], difference['nsx_id']
+            )
+        ), concurrent=False)
+
+    def _repair_stale_port_mapping(self, session, found):
+        def update(difference):
+            with session.begin(subtransactions=True):
+                session.query(nsx_models.NeutronNsxPortMapping).filter_by(
+                    neutron_id=difference['neutron_id'],
+                    nsx_port_id=difference['mapped_nsx_id']
+                ).update({'nsx_switch_id': difference['lswitch_id'],
+                          'nsx_port_id': difference['nsx_id']},
+                         synchronize_session=False)
+
+        self._repair_each(found, update, concurrent=False)
+
+
+def main():
+    n_config.init(sys.argv[1:])
+    log.setup('neutron')
+    conf = cfg.CONF
+
+    cluster = api_client.create_cluster(metrics.Metrics())
+    output = open(conf.output, 'w') if conf.output else sys.stdout
+    started = time.time()
+    try:
+        counts = Auditor(
+            cluster,
+            output,
+            conf.repair,
+            conf.page_size,
+            conf.batch_size,
+            conf.concurrency,
+            conf.progress_interval,
+            conf.grace_period
+        ).run(max(conf.partitions, 1))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    sys.stderr.write('%s\n' % json.dumps(
+        dict(counts, seconds=round(time.time() - started, 1)),
+        sort_keys=True
+    ))
+    if counts['repair_failed']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,138 @@
 import argparse
 import itertools
-import uuid
+import json
+import os
+import threading
+import time
+import traceback
 
 from oslo.db.sqlalchemy import session
 import sqlalchemy as sa
 
-def convert_nsx_to_ml2(connection, dry_run=False):
+
+class Progress(object):
+    """Prints "<label> <done>/<total>" at most once every interval seconds"""
+
+    def __init__(self, label, total, interval):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def update(self, count):
+        with self._lock:
+            self.done += count
+            now = time.time()
+            if self.done >= self.total or now - self._last >= self.interval:
+                print '%s %s/%s' % (self.label, self.done, self.total)
+                self._last = now
+
+
+class Checkpoint(object):
+    """Records completed work in a JSON file so that a rerun can skip it
+
+    Without a path nothing is recorded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._state = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._state.get(key, default)
+
+    def set(self, key, value):
+        if not self.path:
+            return
+        with self._lock:
+            self._state[key] = value
+            # write a new file and rename it over the old one, so an
+            # interruption never leaves a truncated checkpoint behind
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+            os.rename(tmp, self.path)
+
+
+def port_id_ranges(workers):
+    """Split the port id space into ``workers`` [lower, upper) ranges
+
+    Port ids are uuids, so the ranges are cut on the leading 32 bits; the
+    first and last ranges are open-ended so that no id is missed.
+    """
+    bounds = [
+        '%08x' % (index * 0x100000000 // workers)
+        for index in range(1, workers)
+    ]
+    return zip([None] + bounds, bounds + [None])
+
+
+def has_window_functions(engine):
+    version = engine.dialect.server_version_info or ()
+    if engine.dialect.name == 'mysql':
+        if 'MariaDB' in version:
+            return version >= (10, 2)
+        return version >= (8, 0)
+    if engine.dialect.name == 'sqlite':
+        return version >= (3, 25)
+    return True
+
+
+def convert_nsx_to_ml2(connection, dry_run=None, batch_size=500,
+                       progress_interval=5, workers=1, checkpoint=None):
+    """Migrate a database from the NSX plugin to ML2 with dhcnsx
+
+    :param dry_run: if set, the path of a file that the compiled SQL is
+                    written to instead of being executed
+    :param workers: number of connections the port bindings are migrated
+                    over in parallel, each handling a range of port ids
+    :param checkpoint: path of a file recording completed chunks; a rerun
+                       with the same file continues where it stopped
+    """
     engine = session.create_engine(connection)
+    checkpoint = Checkpoint(None if dry_run else checkpoint)
+    sql_lock = threading.Lock()
+    sql_file = open(dry_run, 'w') if dry_run else None
+
+    def write_sql(q, rows=None):
+        if rows:
+            # render an executemany as a single multi-row INSERT; None has
+            # no literal rendering of its own
+            q = q.values([
+                dict((k, sa.null() if v is None else v)
+                     for k, v in row.items())
+                for row in rows
+            ])
+        sql = q.compile(
+            dialect=engine.dialect,
+            compile_kwargs={'literal_binds': True}
+        )
+        with sql_lock:
+            sql_file.write('%s;\n' % sql)
+
+    def exec_chunk(*statements):
+        """Run (statement, rows) pairs in a single transaction.
 
-    def exec_q(q):
+        A list of rows is sent as one executemany; None runs the
+        statement as-is.
+        """
         if dry_run:
-            print q
-        else:
-            return engine.execute(q)
+            for q, rows in statements:
+                write_sql(q, rows)
+            return
+        with engine.begin() as conn:
+            for q, rows in statements:
+                if rows:
+                    conn.execute(q, rows)
+                else:
+                    conn.execute(q)
 
     metadata = sa.MetaData()
 
@@ -30,109 +150,253 @@ def convert_nsx_to_ml2(connection, dry_run=False):
         for name in table_names
     }
 
+    def pages(query, key, last=None):
+        """Yield the rows of query in pages of batch_size rows.
+
+        Pages are fetched with keyset pagination on key (which must be
+        unique) through a server-side cursor, so only one page is held in
+        memory at a time.  Each page is fetched after the previous one has
+        been processed, so rows written meanwhile are taken into account.
+        Rows up to and including ``last`` are skipped.
+        """
+        while True:
+            q = query if last is None else query.where(key > last)
+            q = q.order_by(key).limit(batch_size)
+            rows = list(engine.execute(
+                q.execution_options(stream_results=True)
+            ))
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][key]
+
+    def count(query):
+        return engine.execute(
+            sa.select([sa.func.count()]).select_from(query.alias())
+        ).scalar()
+
     # count number of networks
     networks_table = tables['networks']
     segments_table = tables['ml2_network_segments']
 
-    networks = engine.execute(
+    networks = sa.select([networks_table.c.id]).select_from(
         networks_table.outerjoin(
             segments_table,
-            networks_table.c.id==segments_table.c.network_id
-        ).select(
-            segments_table.c.network_id==None,
-            use_labels=True
+            networks_table.c.id == segments_table.c.network_id
         )
-    ).fetchall()
+    ).where(segments_table.c.network_id.is_(None))
 
     # count number of available vnis
     vnis_alloc = tables['ml2_vxlan_allocations']
 
-    vnis = engine.execute(
-        vnis_alloc.select(vnis_alloc.c.allocated==False)
-    ).fetchall()
+    vnis = sa.select([vnis_alloc.c.vxlan_vni]).where(
+        vnis_alloc.c.allocated == sa.false()
+    )
 
-    if len(networks) > len(vnis):
+    # exact number of networks needing a segment and of free vnis, taken
+    # in a single statement
+    total, available = engine.execute(sa.select([
+        sa.select([sa.func.count()]).select_from(networks.alias()).as_scalar(),
+        sa.select([sa.func.count()]).select_from(vnis.alias()).as_scalar()
+    ])).first()
+    if total > available:
         print 'There are more networks than avaialbe VNIs'
         return
 
-    # populate ml2_network_segments
-    total = len(networks)
-    for index, (network, vni) in enumerate(itertools.izip(networks, vnis)):
-        print 'Allocatin VNI %s/%s' % (index, total)
-        q = segments_table.insert().values(
-            id=str(uuid.uuid4()),
-            network_id=network.networks_id,
-            network_type='vxlan',
-            physical_network=None,
-            segmentation_id=vni.vxlan_vni,
-            is_dynamic=False
-        )
+    if total and has_window_functions(engine):
+        # pair the n-th unsegmented network with the n-th free vni and
+        # insert all the segments with a single INSERT ... SELECT
+        row_number = sa.func.row_number()
+        numbered_networks = networks.column(
+            row_number.over(order_by=networks_table.c.id).label('rn')
+        ).alias('numbered_networks')
+        numbered_vnis = vnis.column(
+            row_number.over(order_by=vnis_alloc.c.vxlan_vni).label('rn')
+        ).alias('numbered_vnis')
 
-        retval = exec_q(q)
+        segment_columns = [
+            'id',
+            'network_id',
+            'network_type',
+            'physical_network',
+            'segmentation_id',
+            'is_dynamic'
+        ]
+        # segment ids only have to be unique: reuse the id of the network,
+        # a uuid that no segment uses, rather than generate one per row in
+        # a dialect-specific way
+        pairs = sa.select([
+            numbered_networks.c.id.label('id'),
+            numbered_networks.c.id.label('network_id'),
+            sa.literal('vxlan'),
+            sa.null(),
+            numbered_vnis.c.vxlan_vni,
+            sa.literal(False)
+        ]).select_from(numbered_networks.join(
+            numbered_vnis,
+            numbered_networks.c.rn == numbered_vnis.c.rn
+        ))
+        insert = segments_table.insert().from_select(segment_columns, pairs)
 
-    if total:
         # mark vnis in-use
-        subq = sa.select([segments_table.c.segmentation_id])
-        subq = subq.where(segments_table.c.network_type=='vxlan')
+        if engine.dialect.name == 'sqlite':
+            # SQLite has no multi-table UPDATE
+            update = vnis_alloc.update().where(sa.exists().where(sa.and_(
+                segments_table.c.segmentation_id == vnis_alloc.c.vxlan_vni,
+                segments_table.c.network_type == 'vxlan'
+            )))
+        else:
+            update = vnis_alloc.update().where(sa.and_(
+                segments_table.c.segmentation_id == vnis_alloc.c.vxlan_vni,
+                segments_table.c.network_type == 'vxlan'
+            ))
+        update = update.where(vnis_alloc.c.allocated == sa.false()).values(
+            allocated=True
+        )
+
+        print 'Allocating %s VNIs' % total
+        if dry_run:
+            write_sql(insert)
+            write_sql(update)
+        else:
+            with engine.begin() as conn:
+                inserted = conn.execute(insert).rowcount
+                if inserted != total:
+                    # leaving the block rolls the transaction back
+                    raise RuntimeError(
+                        'Expected to allocate %s VNIs, got %s' % (
+                            total, inserted
+                        )
+                    )
+                conn.execute(update)
 
-        q = vnis_alloc.update().where(vnis_alloc.c.vxlan_vni.in_(subq))
-        q = q.values(allocated=True)
+    elif total:
+        # no window functions (e.g. MySQL < 8.0): pair networks and vnis
+        # page by page, one transaction per page
+        progress = Progress('Allocating VNIs', total, progress_interval)
+        for network_page, vni_page in itertools.izip(
+                pages(networks, networks_table.c.id),
+                pages(vnis, vnis_alloc.c.vxlan_vni)):
+            segments = [
+                dict(
+                    id=network.id,
+                    network_id=network.id,
+                    network_type='vxlan',
+                    physical_network=None,
+                    segmentation_id=vni.vxlan_vni,
+                    is_dynamic=False
+                )
+                for network, vni in itertools.izip(network_page, vni_page)
+            ]
+            q = vnis_alloc.update().where(
+                vnis_alloc.c.vxlan_vni.in_([segment['segmentation_id']
+                                            for segment in segments])
+            ).values(allocated=True)
 
-        print 'Updating allocated vnis'
-        exec_q(q)
+            exec_chunk((segments_table.insert(), segments), (q, None))
+            progress.update(len(segments))
 
     #####
     # add ml2 ports bindings
     old_bindings = tables['portbindingports']
     new_bindings = tables['ml2_port_bindings']
+    ports = tables['ports']
 
-    # find the ports to update
-    ports_to_update = engine.execute(
-        old_bindings.outerjoin(
-            new_bindings,
-            old_bindings.c.port_id==new_bindings.c.port_id
-        ).select(
-            new_bindings.c.port_id==None,
-            use_labels=True
+    # find the ports to update, along with the segment of their network
+    bindings_join = old_bindings.outerjoin(
+        new_bindings,
+        old_bindings.c.port_id == new_bindings.c.port_id
+    ).outerjoin(
+        ports,
+        old_bindings.c.port_id == ports.c.id
+    ).outerjoin(
+        segments_table,
+        ports.c.network_id == segments_table.c.network_id
+    )
+    segment_id = segments_table.c.id
+    if dry_run and total:
+        # the segments above were only written out: the segment of a
+        # network that has none yet is the one the SQL creates, whose id
+        # is the id of the network
+        bindings_join = bindings_join.outerjoin(
+            networks_table,
+            ports.c.network_id == networks_table.c.id
         )
-    ).fetchall()
+        segment_id = sa.func.coalesce(segment_id, networks_table.c.id)
+    ports_to_update = sa.select([
+        old_bindings.c.port_id,
+        old_bindings.c.host,
+        segment_id.label('segment_id')
+    ]).select_from(bindings_join).where(new_bindings.c.port_id.is_(None))
 
-    # cache segments
-    ports = tables['ports']
-    q = ports.join(
-        segments_table,
-        ports.c.network_id==segments_table.c.network_id
-    ).select(use_labels=True)
+    progress = Progress(
+        'Migrating Bindings', count(ports_to_update), progress_interval
+    )
 
-    segment_cache = {
-        rv.ports_id: rv.ml2_network_segments_id
-        for rv in engine.execute(q).fetchall()
-    }
+    def migrate_bindings(lower, upper):
+        name = 'bindings:%s:%s' % (lower or '', upper or '')
+        query = ports_to_update
+        if lower is not None:
+            query = query.where(old_bindings.c.port_id >= lower)
+        if upper is not None:
+            query = query.where(old_bindings.c.port_id < upper)
 
-    total = len(ports_to_update)
+        for chunk in pages(query, old_bindings.c.port_id,
+                           checkpoint.get(name)):
+            bindings = {}
+            for old_binding in chunk:
+                if old_binding.segment_id is None:
+                    print 'Port %s no longer exists, skipping...' % (
+                        old_binding.port_id
+                    )
+                    continue
+                bindings.setdefault(old_binding.port_id, dict(
+                    port_id=old_binding.port_id,
+                    host=old_binding.host,
+                    vif_type='ovs',
+                    driver='dhcnsx',
+                    segment=old_binding.segment_id,
+                    vnic_type='normal',
+                    vif_details='{"port_filter": true}'
+                ))
 
-    for index, old_binding in enumerate(ports_to_update):
-        print 'Migrating Binding %s/%s' % (index, total)
-        if old_binding.portbindingports_port_id not in segment_cache:
-            print 'Port %s no longer exists, skipping...' % (
-                old_binding.portbindingports_port_id
-            )
-        else:
-            q = new_bindings.insert().values(
-                port_id=old_binding.portbindingports_port_id,
-                host=old_binding.portbindingports_host,
-                vif_type='ovs',
-                driver='dhcnsx',
-                segment=segment_cache[old_binding.portbindingports_port_id],
-                vnic_type='normal',
-                vif_details='{"port_filter": true}'
-            )
-            retval = exec_q(q)
-
-        q = old_bindings.delete(
-            old_bindings.c.port_id==old_binding.portbindingports_port_id,
-        )
-        retval = exec_q(q)
+            q = old_bindings.delete(old_bindings.c.port_id.in_(
+                set(old_binding.port_id for old_binding in chunk)
+            ))
+
+            if bindings:
+                exec_chunk(
+                    (new_bindings.insert(), bindings.values()),
+                    (q, None)
+                )
+            else:
+                exec_chunk((q, None))
+            checkpoint.set(name, chunk[-1].port_id)
+            progress.update(len(chunk))
+
+    errors = []
+
+    def run(lower, upper):
+        try:
+            migrate_bindings(lower, upper)
+        except Exception as e:
+            traceback.print_exc()
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=port_range)
+        for port_range in port_id_ranges(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if sql_file:
+        sql_file.close()
+        print 'SQL written to %s' % dry_run
+    if errors:
+        raise errors[0]
 
 
 def main():
@@ -143,10 +407,43 @@ def main():
     )
     parser.add_argument(
         '--dry-run',
-        default=False,
-        action='store_true',
-        help='Conduct a dry-run'
+        nargs='?',
+        const='dhcnsx-convert.sql',
+        metavar='SQL_FILE',
+        help='Conduct a dry-run, writing the SQL that would be executed '
+             'to SQL_FILE (default: %(const)s)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        default=500,
+        type=int,
+        help='Number of rows written per statement and transaction'
+    )
+    parser.add_argument(
+        '--progress-interval',
+        default=5,
+        type=int,
+        help='Minimum number of seconds between progress lines'
+    )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='Number of connections port bindings are migrated over in '
+             'parallel, each handling a range of port ids'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        help='File recording completed chunks; rerunning with the same '
+             'file continues an interrupted migration where it stopped'
     )
 
     args = parser.parse_args()
-    convert_nsx_to_ml2(args.connection, args.dry_run)
+    convert_nsx_to_ml2(
+        args.connection,
+        args.dry_run,
+        args.batch_size,
+        args.progress_interval,
+        args.workers,
+        args.checkpoint
+    )
@@ -0,0 +1,164 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Runs the NSX state synchronization outside of neutron-server
+
+With sync_worker = external in the dhcnsx section, run::
+
+    dhcnsx-sync --config-file /etc/neutron/neutron.conf \\
+        --config-file /etc/neutron/plugins/ml2/ml2_conf.ini
+
+It supervises a worker process synchronizing NSX and neutron, and
+restarts it when it exits or stops sending heartbeats.  With sync_worker
+= spawn, neutron-server runs it itself (see dhc_nsx.ml2.worker).
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import signal
+import sys
+import time
+
+from oslo.config import cfg
+
+from neutron.common import config as n_config
+from neutron.db import db_base_plugin_v2
+from neutron.db import external_net_db
+from neutron.db import portsecurity_db
+from neutron.openstack.common import log
+from neutron.openstack.common import loopingcall
+
+from dhc_nsx.ml2 import api_client
+from dhc_nsx.ml2 import config as dhcnsx_config  # noqa
+from dhc_nsx.ml2 import metrics
+from dhc_nsx.ml2 import sync as dhcnsx_sync
+from dhc_nsx.ml2 import worker
+
+
+LOG = log.getLogger(__name__)
+
+cli_opts = [
+    cfg.BoolOpt('run-worker', default=False,
+                help='Synchronize in this process instead of supervising '
+                     'a worker process that does'),
+    cfg.IntOpt('parent-pid',
+               help='Stop once the process with this pid is no longer the '
+                    'parent of this one'),
+]
+cfg.CONF.register_cli_opts(cli_opts)
+
+
+class SyncPlugin(db_base_plugin_v2.NeutronDbPluginV2,
+                 external_net_db.External_net_db_mixin,
+                 portsecurity_db.PortSecurityDbMixin):
+    """Core plugin the synchronizer of the worker talks to.
+
+    Only the database side is needed; loading the configured core plugin
+    would initialize the mechanism drivers, and with them another worker.
+    """
+
+
+def worker_metrics_file(path):
+    """Return the metrics file of the worker, next to neutron-server's."""
+    root, ext = os.path.splitext(path)
+    return '%s-sync%s' % (root, ext)
+
+
+def parent_exited():
+    return cfg.CONF.parent_pid and os.getppid() != cfg.CONF.parent_pid
+
+
+def run_worker():
+    dhcnsx_opts = cfg.CONF.dhcnsx
+    if dhcnsx_opts.sync_worker_db_pool_size:
+        # set before the first session creates the engine
+        cfg.CONF.set_override(
+            'max_pool_size',
+            dhcnsx_opts.sync_worker_db_pool_size,
+            'database'
+        )
+
+    sync_metrics = metrics.Metrics()
+    cluster = api_client.create_cluster(sync_metrics)
+    if dhcnsx_opts.metrics_interval:
+        metrics_call = loopingcall.FixedIntervalLoopingCall(
+            sync_metrics.report,
+            dhcnsx_opts.metrics_file and
+            worker_metrics_file(dhcnsx_opts.metrics_file)
+        )
+        metrics_call.start(
+            dhcnsx_opts.metrics_interval,
+            initial_delay=dhcnsx_opts.metrics_interval
+        )
+
+    heartbeat = worker.Heartbeat(dhcnsx_opts.sync_worker_heartbeat_file)
+    # beats after every synchronization run, so that one that hangs is
+    # noticed by the supervisor
+    synchronizer = dhcnsx_sync.create_synchronizer(
+        SyncPlugin(),
+        cluster,
+        sync_metrics,
+        shared_watches=True,
+        progress=heartbeat.beat
+    )
+    LOG.info("NSX sync worker %d started", os.getpid())
+    while True:
+        if parent_exited():
+            LOG.warning("The supervisor of NSX sync worker %d exited; "
+                        "stopping", os.getpid())
+            return 0
+        if synchronizer._sync_looping_call.done.ready():
+            LOG.error("NSX synchronization stopped")
+            return 1
+        if not synchronizer.running:
+            # waiting for the next run
+            heartbeat.beat()
+        time.sleep(dhcnsx_opts.sync_worker_heartbeat_interval)
+
+
+def supervise():
+    def terminate(signum, frame):
+        # runs the finally clause below
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    supervisor = worker.create_supervisor(cfg.CONF)
+    try:
+        while True:
+            if parent_exited():
+                LOG.warning("neutron-server exited; stopping dhcnsx-sync")
+                return
+            supervisor.check()
+            time.sleep(cfg.CONF.dhcnsx.sync_worker_heartbeat_interval)
+    finally:
+        supervisor.stop()
+
+
+def main():
+    n_config.init(sys.argv[1:])
+    log.setup('neutron')
+    if not cfg.CONF.NSX_SYNC.state_sync_interval:
+        LOG.info("NSX state synchronization is disabled by "
+                 "state_sync_interval")
+        return 0
+    if cfg.CONF.run_worker:
+        return run_worker()
+    supervise()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""An NSX API client that routes requests to the healthiest controller
+
+The upstream client opens concurrent_connections connections to every
+controller up front and hands them out in a fixed priority order, so the
+first controller takes nearly all requests and a slow or failing one is
+used as much as a healthy one.  `BalancedApiClient` instead keeps a
+moving average of the latency and error rate of every controller and
+sends each request to the one expected to answer first, reusing an idle
+keep-alive connection to it or opening a new one.  Connections left idle
+for idle_timeout seconds are closed; up to min_connections of them per
+controller are replaced by new ones, as the upstream client reconnects
+connections idle for longer than conn_idle_timeout.
+"""
+
+import time
+
+import eventlet
+from oslo.config import cfg
+
+from neutron.openstack.common import log
+from neutron.plugins.vmware.api_client import client
+from neutron.plugins.vmware.common import config as nsx_config  # noqa
+from neutron.plugins.vmware.common import nsx_utils
+
+from dhc_nsx.ml2 import config as dhcnsx_config  # noqa
+from dhc_nsx.ml2 import metrics as dhcnsx_metrics
+
+
+LOG = log.getLogger(__name__)
+
+# weight of the newest sample in the latency and error rate averages
+DECAY = 0.2
+
+# seconds of latency a failed request is worth when ranking controllers
+ERROR_PENALTY = 1.0
+
+# seconds after which a controller's error rate has halved without new
+# samples, so that a controller that recovered gets requests again
+ERROR_HALF_LIFE = 10.0
+
+
+class ControllerStats(object):
+    """Health and connections of one NSX controller"""
+
+    def __init__(self):
+        # moving averages; latency stays None until the first sample
+        self.latency = None
+        self._error_rate = 0.0
+        self._error_rate_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        # open connections, idle or in use
+        self.connections = 0
+        # idle connections, the most recently used last
+        self.idle = []
+
+    def error_rate(self, now=None):
+        now = now or time.time()
+        return self._error_rate * 0.5 ** (
+            (now - self._error_rate_at) / ERROR_HALF_LIFE
+        )
+
+    def record(self, latency, error):
+        now = time.time()
+        self.requests += 1
+        if error:
+            self.errors += 1
+        else:
+            # failed requests end early; do not let them look fast
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += DECAY * (latency - self.latency)
+        error_rate = self.error_rate(now)
+        self._error_rate = error_rate + DECAY * (int(error) - error_rate)
+        self._error_rate_at = now
+
+    def score(self, now):
+        """Expected seconds before a request sent now is answered.
+
+        Controllers without a latency sample yet score 0, so that every
+        controller gets tried.
+        """
+        return ((self.latency or 0.0) * (self.in_flight + 1) +
+                ERROR_PENALTY * self.error_rate(now))
+
+    def snapshot(self, now=None):
+        return {
+            'latency': self.latency,
+            'error_rate': self.error_rate(now),
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'connections': self.connections,
+            'idle': len(self.idle),
+        }
+
+
+class BalancedApiClient(client.NsxApiClient):
+    """NsxApiClient with health-based controller selection.
+
+    Up to max_connections requests are in flight per controller; once
+    every controller is at that limit, `acquire_connection` blocks.
+    """
+
+    def __init__(self, api_providers, user, password, min_connections=1,
+                 max_connections=10, idle_timeout=900, **kwargs):
+        # no connections are opened up front; see acquire_connection
+        super(BalancedApiClient, self).__init__(
+            api_providers, user, password, concurrent_connections=0,
+            **kwargs
+        )
+        self._min_connections = min_connections
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._controllers = dict(
+            (provider, ControllerStats()) for provider in self._api_providers
+        )
+        self._slots = eventlet.semaphore.Semaphore(
+            max_connections * len(self._controllers)
+        )
+
+    def _select(self, now):
+        available = [
+            (stats.score(now), provider)
+            for provider, stats in self._controllers.items()
+            if stats.in_flight < self._max_connections
+        ]
+        return min(available)[1]
+
+    def _close(self, stats, http_conn):
+        stats.connections -= 1
+        try:
+            http_conn.close()
+        except Exception:
+            LOG.debug("Error closing NSX API connection", exc_info=True)
+
+    def _expire_idle(self, stats, now):
+        # the least recently used connections come first
+        while (stats.idle and
+               stats.idle[0].last_used < now - self._idle_timeout):
+            http_conn = stats.idle.pop(0)
+            self._close(stats, http_conn)
+            if stats.connections < self._min_connections:
+                # the controller or a firewall may have dropped it
+                host, port, is_ssl = self._conn_params(http_conn)
+                LOG.debug("Connection to NSX controller %(host)s:%(port)s "
+                          "idle for %(sec)0.2f seconds; reconnecting",
+                          {'host': host, 'port': port,
+                           'sec': now - http_conn.last_used})
+                http_conn = self._create_connection(host, port, is_ssl)
+                http_conn.last_used = now
+                stats.connections += 1
+                stats.idle.append(http_conn)
+
+    def acquire_connection(self, auto_login=True, headers=None, rid=-1):
+        """Check out a connection to the best controller.
+
+        Blocks until fewer than max_connections requests are in flight on
+        some controller.
+        """
+        self._slots.acquire()
+        now = time.time()
+        provider = self._select(now)
+        stats = self._controllers[provider]
+        stats.in_flight += 1
+        try:
+            self._expire_idle(stats, now)
+            if stats.idle:
+                http_conn = stats.idle.pop()
+            else:
+                http_conn = self._create_connection(*provider)
+                stats.connections += 1
+                LOG.debug("[%(rid)d] Opened connection %(count)d to NSX "
+                          "controller %(host)s:%(port)s",
+                          {'rid': rid, 'count': stats.connections,
+                           'host': provider[0], 'port': provider[1]})
+            http_conn.last_used = now
+            if auto_login and self.auth_cookie(http_conn) is None:
+                self._wait_for_login(http_conn, headers)
+        except Exception:
+            stats.in_flight -= 1
+            self._slots.release()
+            raise
+        http_conn.issued_at = time.time()
+        return http_conn
+
+    def release_connection(self, http_conn, bad_state=False,
+                           service_unavail=False, rid=-1):
+        """Return a connection and record how its request went."""
+        if hasattr(http_conn, 'no_release'):
+            # redirect connections are not pooled
+            return
+        stats = self._controllers.get(self._conn_params(http_conn))
+        if stats is None:
+            LOG.debug("[%d] Released connection is not to an API provider "
+                      "of the cluster", rid)
+            return
+
+        now = time.time()
+        stats.in_flight -= 1
+        stats.record(now - getattr(http_conn, 'issued_at', now),
+                     bool(bad_state or service_unavail))
+        if bad_state:
+            self._close(stats, http_conn)
+        else:
+            http_conn.last_used = now
+            stats.idle.append(http_conn)
+        for controller in self._controllers.values():
+            self._expire_idle(controller, now)
+        self._slots.release()
+
+    def controller_stats(self):
+        """Return the stats of every controller by "host:port"."""
+        now = time.time()
+        return dict(
+            ('%s:%s' % (provider[0], provider[1]), stats.snapshot(now))
+            for provider, stats in self._controllers.items()
+        )
+
+
+def create_balanced_client(cluster, min_connections, max_connections,
+                           idle_timeout, gen_timeout):
+    """Return a BalancedApiClient for the controllers of cluster.
+
+    The client is built as nsx_utils.create_nsx_cluster builds the
+    cluster's own one.
+    """
+    api_providers = []
+    for controller in cluster.nsx_controllers:
+        host, port = controller.split(':')
+        api_providers.append((host, int(port), True))
+    return BalancedApiClient(
+        api_providers, cluster.nsx_user, cluster.nsx_password,
+        min_connections=min_connections,
+        max_connections=max_connections,
+        idle_timeout=idle_timeout,
+        gen_timeout=gen_timeout,
+        http_timeout=cluster.http_timeout,
+        retries=cluster.retries,
+        redirects=cluster.redirects
+    )
+
+
+def create_cluster(metrics):
+    """Return the configured NSX cluster, its API calls counted in metrics.
+
+    With balance_controllers, the cluster's client is a BalancedApiClient
+    whose controller stats are added to metrics.
+    """
+    nsx_opts = cfg.CONF.NSX
+    dhcnsx_opts = cfg.CONF.dhcnsx
+    cluster = nsx_utils.create_nsx_cluster(
+        cfg.CONF,
+        nsx_opts.concurrent_connections,
+        nsx_opts.nsx_gen_timeout
+    )
+    if dhcnsx_opts.balance_controllers:
+        cluster.api_client = create_balanced_client(
+            cluster,
+            dhcnsx_opts.controller_min_connections,
+            (dhcnsx_opts.controller_max_connections or
+             nsx_opts.concurrent_connections),
+            dhcnsx_opts.controller_idle_timeout,
+            nsx_opts.nsx_gen_timeout
+        )
+        metrics.add_source(
+            'controller_pool',
+            cluster.api_client.controller_stats
+        )
+    dhcnsx_metrics.instrument_api_client(cluster.api_client, metrics)
+    return cluster
@@ -0,0 +1,186 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""A circuit breaker failing NSX operations fast while NSX is down
+
+Without it, every API call made during an NSX outage waits up to
+nsx_gen_timeout for the controllers while holding its DB transaction,
+until the API workers and DB connections run out.
+"""
+
+import contextlib
+import threading
+import time
+
+from neutron.common import exceptions as n_exc
+from neutron.openstack.common import log
+from neutron.plugins.vmware.api_client import exception as api_exc
+
+if '_' not in __builtins__:
+    # stable/juno does not use this import
+    from neutron.i18n import _
+
+
+LOG = log.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# errors showing that NSX could not be reached or could not serve a
+# request, as opposed to NSX rejecting it
+BACKEND_FAILURES = (api_exc.RequestTimeout, api_exc.ServiceUnavailable)
+
+
+class BackendUnavailable(n_exc.ServiceUnavailable):
+    message = _("The NSX backend is unavailable after %(failures)d "
+                "consecutive failures; operations are rejected for up to "
+                "%(retry_after)d seconds")
+
+
+class CircuitBreaker(object):
+    """Tracks the health of NSX as seen by all its callers.
+
+    closed: calls go through; failure_threshold consecutive backend
+    failures open the circuit.
+
+    open: calls are rejected with BackendUnavailable until reset_timeout
+    seconds have passed, then the circuit is half-open.
+
+    half-open: up to probes calls at a time go through; probes successes
+    in a row close the circuit, a failure opens it again.
+
+    Callers that are never rejected, like the synchronizer, feed the
+    breaker with `record_success` and `record_failure`; a success
+    reported while the circuit is open counts as a probe.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, probes=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self._state = CLOSED
+        self._failures = 0
+        self._successes = 0
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (self._state == OPEN and
+                time.time() - self._opened_at >= self.reset_timeout):
+            self._state = HALF_OPEN
+            self._successes = 0
+            LOG.info(_("NSX circuit breaker half-open; probing the backend"))
+        return self._state
+
+    def _open(self):
+        if self._state != OPEN:
+            LOG.error(_("NSX circuit breaker open after %d consecutive "
+                        "backend failures; rejecting NSX operations for %d "
+                        "seconds"), self._failures, self.reset_timeout)
+        self._state = OPEN
+        self._opened_at = time.time()
+        self._successes = 0
+
+    def before_call(self):
+        """Admit a call or raise BackendUnavailable.
+
+        Returns whether the call is a half-open probe, to be passed back
+        to `record_success`, `record_failure` or `release`.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return True
+            self.rejected += 1
+            if state == OPEN:
+                retry_after = (
+                    self._opened_at + self.reset_timeout - time.time()
+                )
+            else:
+                retry_after = 0
+        raise BackendUnavailable(failures=self._failures,
+                                 retry_after=max(retry_after, 0))
+
+    def release(self, probe=False):
+        """End a call that neither proved nor disproved NSX health."""
+        if probe:
+            with self._lock:
+                self._probes_in_flight -= 1
+
+    def record_success(self, probe=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            if probe:
+                self._probes_in_flight -= 1
+            self._failures = 0
+            if self._current_state() == CLOSED:
+                return
+            self._successes += 1
+            if self._successes >= self.probes:
+                self._state = CLOSED
+                self._successes = 0
+                LOG.info(_("NSX circuit breaker closed; the backend is "
+                           "reachable again"))
+
+    def record_failure(self, probe=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            if probe:
+                self._probes_in_flight -= 1
+            self._failures += 1
+            state = self._current_state()
+            if state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._open()
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Run the enclosed NSX operation through the breaker."""
+        probe = self.before_call()
+        try:
+            yield
+        except BACKEND_FAILURES:
+            self.record_failure(probe)
+            raise
+        except Exception:
+            self.release(probe)
+            raise
+        self.record_success(probe)
+
+    def stats(self):
+        with self._lock:
+            return {'nsx': {
+                'state': self._current_state(),
+                'failures': self._failures,
+                'rejected': self.rejected,
+            }}
@@ -0,0 +1,347 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import sys
+import threading
+import time
+
+
+_MISSING = object()
+
+# NSX resource -> (tag scope of the neutron id, status relation, status
+# field), the only parts of an NSX object the synchronizer looks at
+NSX_OBJECT_FIELDS = {
+    'lswitch': ('quantum_net_id', 'LogicalSwitchStatus', 'fabric_status'),
+    'lrouter': ('q_router_id', 'LogicalRouterStatus', 'fabric_status'),
+    'lport': ('q_port_id', 'LogicalPortStatus', 'link_status_up'),
+}
+
+
+class LRUCache(object):
+    """A bounded, thread-safe LRU mapping with an optional per-entry TTL.
+
+    Entries older than ``ttl`` seconds are treated as missing and are
+    dropped on access.  Hit, miss and eviction counters are kept so that
+    callers can report how effective the cache is.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def _expired(self, stamp):
+        return self.ttl and time.time() - stamp > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is _MISSING or self._expired(entry[0]):
+                self.misses += 1
+                return default
+            # re-insert to mark the key as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """Like `get`, but without touching the counters or LRU order."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or self._expired(entry[0]):
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and not self._expired(entry[0])
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class SwitchCapacityCache(object):
+    """Per-network cache of logical switch UUIDs and their lport counts.
+
+    Each entry maps a neutron network id to a ``{lswitch_uuid: lport_count}``
+    dict.  The driver updates counts as it creates and deletes ports, and
+    the synchronizer refreshes them from the ``LogicalSwitchStatus`` data it
+    fetches anyway, so NSX only needs to be asked when an entry is cold or
+    every switch on the network is close to full.
+    """
+
+    def __init__(self, size, ttl, headroom=0):
+        self.headroom = headroom
+        self._lock = threading.Lock()
+        self._networks = LRUCache(size, ttl)
+
+    def find(self, network_id, max_ports):
+        """Return the UUID of a switch with spare capacity, or None."""
+        switches = self._networks.get(network_id)
+        if switches:
+            with self._lock:
+                for ls_uuid, count in sorted(switches.items()):
+                    if count < max_ports - self.headroom:
+                        return ls_uuid
+        return None
+
+    def load(self, network_id, lswitches):
+        """Replace the entry for a network with freshly fetched lswitches."""
+        self._networks.set(network_id, dict(
+            (ls['uuid'],
+             ls['_relations']['LogicalSwitchStatus']['lport_count'])
+            for ls in lswitches
+        ))
+
+    def update_switch(self, network_id, ls_uuid, lport_count):
+        """Refresh the count of a switch if its network is already cached.
+
+        Partial entries are never created here; a network is only cached
+        once all of its switches are known (see `load`).
+        """
+        switches = self._networks.peek(network_id)
+        if switches is not None:
+            with self._lock:
+                switches[ls_uuid] = lport_count
+
+    def port_added(self, network_id, ls_uuid):
+        self._adjust(network_id, ls_uuid, 1)
+
+    def port_removed(self, network_id, ls_uuid):
+        self._adjust(network_id, ls_uuid, -1)
+
+    def _adjust(self, network_id, ls_uuid, delta):
+        switches = self._networks.peek(network_id)
+        if switches is None:
+            return
+        with self._lock:
+            if ls_uuid in switches:
+                switches[ls_uuid] = max(switches[ls_uuid] + delta, 0)
+            else:
+                # a switch we have never seen was chained to the network;
+                # drop the entry so the next lookup asks NSX
+                self._networks.pop(network_id)
+
+    def invalidate(self, network_id):
+        self._networks.pop(network_id)
+
+    def stats(self):
+        return self._networks.stats()
+
+
+def _str(value):
+    # ASCII unicode strings hash and compare equal to their str version,
+    # which takes a fourth of the memory
+    try:
+        return str(value)
+    except UnicodeEncodeError:
+        return value
+
+
+class NsxObject(object):
+    """What the synchronizer keeps of an NSX object between sweeps"""
+
+    __slots__ = ('neutron_id', 'status', 'lport_count', 'changed', 'hit',
+                 'deleted')
+
+    def __init__(self, neutron_id, status, lport_count):
+        self.neutron_id = neutron_id
+        self.status = status
+        self.lport_count = lport_count
+        self.changed = True
+        self.hit = True
+        self.deleted = False
+
+
+class CompactNsxCache(object):
+    """A replacement for the NsxCache of the upstream synchronizer.
+
+    NsxCache keeps the decoded JSON of every NSX object, and of its
+    previous version, between sweeps.  This keeps an `NsxObject` per
+    object instead: its neutron id, status and, for switches, port count,
+    which is all the synchronizer and the capacity cache use.  An object
+    has changed when one of those did.
+
+    Items are returned as ``{'data': ..., 'data_bk': ...}`` like NsxCache
+    does, with minimal NSX objects rebuilt from the compact form.
+    """
+
+    def __init__(self):
+        self._objects = dict((resource, {}) for resource in NSX_OBJECT_FIELDS)
+
+    def _find(self, nsx_uuid):
+        for resource, objects in self._objects.items():
+            if nsx_uuid in objects:
+                return resource, objects[nsx_uuid]
+        raise KeyError(nsx_uuid)
+
+    def __getitem__(self, nsx_uuid):
+        resource, obj = self._find(nsx_uuid)
+        scope, relation, field = NSX_OBJECT_FIELDS[resource]
+        status = {field: obj.status}
+        if obj.lport_count is not None:
+            status['lport_count'] = obj.lport_count
+        data = {
+            'uuid': nsx_uuid,
+            'tags': [{'scope': scope, 'tag': obj.neutron_id}]
+            if obj.neutron_id else [],
+            '_relations': {relation: status},
+        }
+        if obj.deleted:
+            return {'data': None, 'data_bk': data}
+        return {'data': data, 'data_bk': None}
+
+    def _update(self, resource, items, clear_changed=True):
+        objects = self._objects[resource]
+        if clear_changed:
+            for nsx_uuid, obj in objects.items():
+                if obj.changed and obj.deleted:
+                    del objects[nsx_uuid]
+                obj.changed = False
+
+        scope, relation, field = NSX_OBJECT_FIELDS[resource]
+        for item in items or []:
+            neutron_id = None
+            for tag in item.get('tags', []):
+                if tag['scope'] == scope:
+                    neutron_id = _str(tag['tag'])
+                    break
+            status = item.get('_relations', {}).get(relation, {})
+            lport_count = status.get('lport_count')
+            status = status.get(field)
+
+            obj = objects.get(item['uuid'])
+            if obj is None:
+                objects[_str(item['uuid'])] = NsxObject(
+                    neutron_id, status, lport_count
+                )
+                continue
+            if (obj.deleted or obj.neutron_id != neutron_id or
+                    obj.status != status or obj.lport_count != lport_count):
+                obj.neutron_id = neutron_id
+                obj.status = status
+                obj.lport_count = lport_count
+                obj.deleted = False
+                obj.changed = True
+            obj.hit = True
+
+    def _delete(self, resource):
+        # objects not seen since the last call were removed from NSX
+        for obj in self._objects[resource].values():
+            if not obj.hit:
+                obj.changed = True
+                obj.deleted = True
+            obj.hit = False
+
+    def _ids(self, resource, changed_only):
+        if changed_only:
+            return [nsx_uuid
+                    for nsx_uuid, obj in self._objects[resource].items()
+                    if obj.changed]
+        return self._objects[resource].keys()
+
+    def _changed_ids(self):
+        return (self._ids('lswitch', True), self._ids('lrouter', True),
+                self._ids('lport', True))
+
+    def get_lswitches(self, changed_only=False):
+        return self._ids('lswitch', changed_only)
+
+    def get_lrouters(self, changed_only=False):
+        return self._ids('lrouter', changed_only)
+
+    def get_lswitchports(self, changed_only=False):
+        return self._ids('lport', changed_only)
+
+    def update_lswitch(self, lswitch):
+        self._update('lswitch', [lswitch], clear_changed=False)
+
+    def update_lrouter(self, lrouter):
+        self._update('lrouter', [lrouter], clear_changed=False)
+
+    def update_lswitchport(self, lswitchport):
+        self._update('lport', [lswitchport], clear_changed=False)
+
+    def process_updates(self, lswitches=None, lrouters=None,
+                        lswitchports=None):
+        self._update('lswitch', lswitches)
+        self._update('lrouter', lrouters)
+        self._update('lport', lswitchports)
+        return self._changed_ids()
+
+    def process_deletes(self):
+        for resource in self._objects:
+            self._delete(resource)
+        return self._changed_ids()
+
+    def forget(self, predicate):
+        """Remove the objects for which predicate is true.
+
+        predicate is called with the resource type, the NSX uuid and the
+        neutron id of every object.
+        """
+        for resource, objects in self._objects.items():
+            for nsx_uuid, obj in objects.items():
+                if predicate(resource, nsx_uuid, obj.neutron_id):
+                    del objects[nsx_uuid]
+
+    def memory_stats(self):
+        """Return the number of objects and bytes used per resource type.
+
+        Counts the index, the objects and their strings; booleans and
+        small port counts are shared by the interpreter.
+        """
+        result = {}
+        for resource, objects in self._objects.items():
+            size = sys.getsizeof(objects)
+            for nsx_uuid, obj in objects.items():
+                size += sys.getsizeof(nsx_uuid) + sys.getsizeof(obj)
+                if obj.neutron_id:
+                    size += sys.getsizeof(obj.neutron_id)
+            result[resource] = {
+                'objects': len(objects),
+                'bytes': size,
+                'bytes_per_object': size / len(objects) if objects else 0,
+            }
+        return result
@@ -0,0 +1,186 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from oslo.config import cfg
+
+if '_' not in __builtins__:
+    # stable/juno does not use this import
+    from neutron.i18n import _
+
+
+dhcnsx_opts = [
+    cfg.IntOpt('lswitch_cache_size', default=1024,
+               help=_("Maximum number of networks whose logical switch "
+                      "capacity is cached by the mechanism driver.")),
+    cfg.IntOpt('lswitch_cache_ttl', default=300,
+               help=_("Number of seconds a cached logical switch capacity "
+                      "entry is trusted before NSX is queried again.")),
+    cfg.IntOpt('lswitch_cache_headroom', default=5,
+               help=_("A cached logical switch is only used for a new port "
+                      "if it has at least this many free ports left below "
+                      "max_lp_per_overlay_ls per API worker; otherwise NSX "
+                      "is queried. Ports created by other neutron-server "
+                      "nodes are not accounted for. It is capped at half "
+                      "of max_lp_per_overlay_ls.")),
+    cfg.IntOpt('lswitch_pool_size', default=0,
+               help=_("Number of empty logical switches kept ready on NSX "
+                      "for the default transport zone, so that creating a "
+                      "network or extending a full one only has to retag "
+                      "a switch. 0 disables the pool.")),
+    cfg.IntOpt('lswitch_pool_interval', default=10,
+               help=_("Number of seconds between two checks that the "
+                      "logical switch pool still holds lswitch_pool_size "
+                      "switches.")),
+    cfg.IntOpt('secgroup_cache_size', default=4096,
+               help=_("Maximum number of neutron security group to NSX "
+                      "security profile mappings cached per process.")),
+    cfg.IntOpt('secgroup_cache_ttl', default=3600,
+               help=_("Number of seconds a cached security profile mapping "
+                      "is kept. Deletes are only seen by the process that "
+                      "handles them, so this bounds how long other API "
+                      "workers keep a stale mapping.")),
+    cfg.IntOpt('port_mapping_cache_size', default=16384,
+               help=_("Maximum number of neutron port to NSX switch and "
+                      "port id mappings cached per process.")),
+    cfg.IntOpt('port_mapping_cache_ttl', default=3600,
+               help=_("Number of seconds a cached port mapping is kept. "
+                      "Deletes are only seen by the process that handles "
+                      "them, so this bounds how long other API workers keep "
+                      "the mapping of a deleted port.")),
+    cfg.BoolOpt('async_backend', default=False,
+                help=_("Issue NSX calls from the postcommit phase on a "
+                       "pool of worker greenthreads instead of inside the "
+                       "neutron DB transaction. API calls then return "
+                       "before NSX has confirmed the operation; networks "
+                       "and ports whose NSX creation or update fails are "
+                       "set to ERROR.")),
+    cfg.IntOpt('backend_workers', default=16,
+               help=_("Number of worker greenthreads issuing NSX calls "
+                      "when async_backend is enabled. Operations on the "
+                      "same network or port always run in order.")),
+    cfg.BoolOpt('inline_vif_attachment', default=False,
+                help=_("Create logical ports for bound devices with their "
+                       "VIF attachment in the same NSX request. If the "
+                       "controller rejects it, the driver falls back to a "
+                       "separate attachment request.")),
+    cfg.IntOpt('delete_concurrency', default=4,
+               help=_("Maximum number of concurrent NSX requests made to "
+                      "delete the logical switches of a network, and any "
+                      "ports left on them.")),
+    cfg.IntOpt('full_sync_interval', default=0,
+               help=_("When set, the full NSX state synchronization sweep "
+                      "only runs once every this many seconds. In between, "
+                      "only networks and ports recently created or updated "
+                      "are checked. 0 sweeps on every synchronization run.")),
+    cfg.IntOpt('delta_sync_interval', default=10,
+               help=_("Number of seconds between two delta synchronization "
+                      "runs when full_sync_interval is set.")),
+    cfg.IntOpt('delta_sync_watch_time', default=600,
+               help=_("Number of seconds a created or updated network or "
+                      "port is checked by delta synchronization runs until "
+                      "it becomes active.")),
+    cfg.BoolOpt('adaptive_sync_pacing', default=True,
+                help=_("Size the chunks of the NSX state synchronization "
+                       "sweep and space them from the measured NSX "
+                       "response times, instead of using min_chunk_size "
+                       "chunks spread over state_sync_interval.")),
+    cfg.IntOpt('sync_max_chunk_size', default=10000,
+               help=_("Largest chunk size adaptive_sync_pacing may grow "
+                      "to; min_chunk_size is the smallest.")),
+    cfg.FloatOpt('sync_capacity_fraction', default=0.25,
+                 help=_("Fraction of the time the synchronizer may keep "
+                        "NSX busy with adaptive_sync_pacing: chunks are "
+                        "spaced so that fetching them takes at most this "
+                        "share of a sweep.")),
+    cfg.BoolOpt('sync_partitioning', default=False,
+                help=_("Share the NSX state synchronization sweep between "
+                       "all neutron-server processes with this option "
+                       "set, coordinated through leases in the neutron "
+                       "database. Each process only synchronizes the "
+                       "networks that hash to it, and their ports, and only "
+                       "fetches the logical ports of their switches from "
+                       "NSX.")),
+    cfg.IntOpt('sync_lease_time', default=60,
+               help=_("Number of seconds a synchronization lease is valid. "
+                      "Leases are renewed every third of this; the share of "
+                      "a process that stops renewing it is taken over by "
+                      "the others once it expires.")),
+    cfg.StrOpt('sync_worker', default='inline',
+               choices=['inline', 'spawn', 'external'],
+               help=_("Where the NSX state synchronization runs: 'inline' "
+                      "in every neutron-server process, 'spawn' in a "
+                      "dhcnsx-sync worker process started and supervised "
+                      "by neutron-server, or 'external' in a dhcnsx-sync "
+                      "process run separately.")),
+    cfg.StrOpt('sync_worker_heartbeat_file',
+               default='$state_path/dhcnsx-sync.heartbeat',
+               help=_("File the dhcnsx-sync worker writes its pid and the "
+                      "current time to, for its supervisor.")),
+    cfg.IntOpt('sync_worker_heartbeat_interval', default=10,
+               help=_("Number of seconds between two heartbeats of the "
+                      "dhcnsx-sync worker while it waits for its next "
+                      "synchronization run, and between two checks of it "
+                      "by its supervisor.")),
+    cfg.IntOpt('sync_worker_heartbeat_timeout', default=120,
+               help=_("Number of seconds without a heartbeat after which "
+                      "the dhcnsx-sync worker is restarted. The worker "
+                      "does not beat during a synchronization run, so this "
+                      "must exceed the longest one.")),
+    cfg.IntOpt('sync_worker_db_pool_size', default=2,
+               help=_("Maximum number of database connections the "
+                      "dhcnsx-sync worker keeps open. 0 uses "
+                      "max_pool_size of the database section.")),
+    cfg.BoolOpt('balance_controllers', default=False,
+                help=_("Send each NSX request to the controller with the "
+                       "lowest moving average latency and error rate, "
+                       "opening connections on demand, instead of using "
+                       "the fixed connection pool of the NSX API client.")),
+    cfg.IntOpt('controller_min_connections', default=1,
+               help=_("Number of idle connections kept open to each NSX "
+                      "controller when balance_controllers is set.")),
+    cfg.IntOpt('controller_max_connections', default=0,
+               help=_("Maximum number of concurrent requests to each NSX "
+                      "controller when balance_controllers is set. 0 uses "
+                      "the concurrent_connections option of the NSX "
+                      "section.")),
+    cfg.IntOpt('controller_idle_timeout', default=900,
+               help=_("Number of seconds after which an idle connection to "
+                      "an NSX controller is closed, and replaced by a new "
+                      "one within controller_min_connections.")),
+    cfg.IntOpt('breaker_failure_threshold', default=5,
+               help=_("Number of consecutive NSX request timeouts or "
+                      "service unavailable errors, seen by the driver or "
+                      "the synchronizer, after which NSX operations are "
+                      "rejected immediately instead of waiting for the "
+                      "backend. 0 disables the circuit breaker.")),
+    cfg.IntOpt('breaker_reset_timeout', default=30,
+               help=_("Number of seconds NSX operations are rejected once "
+                      "the circuit breaker opens, before probe operations "
+                      "are let through again.")),
+    cfg.IntOpt('breaker_probes', default=1,
+               help=_("Number of probe operations let through at a time, "
+                      "and of successes needed to close the circuit "
+                      "breaker again.")),
+    cfg.IntOpt('metrics_interval', default=300,
+               help=_("Number of seconds between two summaries of the NSX "
+                      "call latency, error and retry metrics in the log. "
+                      "0 disables the summaries and metrics_file.")),
+    cfg.StrOpt('metrics_file',
+               help=_("Path of a JSON file the NSX call metrics are written "
+                      "to every metrics_interval seconds, for a local "
+                      "scraper.")),
+]
+
+cfg.CONF.register_opts(dhcnsx_opts, 'dhcnsx')
@@ -0,0 +1,115 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Bulk variants of the lookups in neutron.plugins.vmware.dbexts.db
+
+The status update used by the NSX synchronizer lives here too.
+"""
+
+from neutron.db import models_v2
+from neutron.db import portsecurity_db
+try:
+    from neutron.plugins.vmware.dbexts import nsx_models
+except ImportError:
+    # stable/juno keeps the mapping models in dbexts.models
+    from neutron.plugins.vmware.dbexts import models as nsx_models
+
+
+# maximum number of ids in the IN clause of a bulk update
+MAX_IN_IDS = 500
+
+
+def get_nsx_security_group_ids(session, neutron_ids):
+    """Return a {neutron_id: nsx_id} dict for the mapped security groups.
+
+    Security groups without a mapping are simply absent from the result.
+    """
+    if not neutron_ids:
+        return {}
+    model = nsx_models.NeutronNsxSecurityGroupMapping
+    query = session.query(model.neutron_id, model.nsx_id).filter(
+        model.neutron_id.in_(neutron_ids)
+    )
+    return dict(query)
+
+
+def get_nsx_switch_and_port_ids(session, neutron_ids):
+    """Return a {neutron_port_id: (nsx_switch_id, nsx_port_id)} dict."""
+    if not neutron_ids:
+        return {}
+    model = nsx_models.NeutronNsxPortMapping
+    query = session.query(
+        model.neutron_id, model.nsx_switch_id, model.nsx_port_id
+    ).filter(model.neutron_id.in_(neutron_ids))
+    return dict(
+        (neutron_id, (nsx_switch_id, nsx_port_id))
+        for neutron_id, nsx_switch_id, nsx_port_id in query
+    )
+
+
+def get_nsx_switch_ids(session, neutron_ids):
+    """Return a {neutron_network_id: [nsx_switch_id, ...]} dict."""
+    if not neutron_ids:
+        return {}
+    model = nsx_models.NeutronNsxNetworkMapping
+    query = session.query(model.neutron_id, model.nsx_id).filter(
+        model.neutron_id.in_(neutron_ids)
+    )
+    result = {}
+    for neutron_id, nsx_id in query:
+        result.setdefault(neutron_id, []).append(nsx_id)
+    return result
+
+
+def get_port_network_ids(session, port_ids):
+    """Return a {port_id: network_id} dict.
+
+    Issues one query per MAX_IN_IDS ids.
+    """
+    result = {}
+    query = session.query(models_v2.Port.id, models_v2.Port.network_id)
+    for start in range(0, len(port_ids), MAX_IN_IDS):
+        result.update(query.filter(
+            models_v2.Port.id.in_(port_ids[start:start + MAX_IN_IDS])
+        ))
+    return result
+
+
+def get_port_security_bindings(session, port_ids):
+    """Return a {port_id: port_security_enabled} dict."""
+    if not port_ids:
+        return {}
+    model = portsecurity_db.PortSecurityBinding
+    query = session.query(model.port_id, model.port_security_enabled).filter(
+        model.port_id.in_(port_ids)
+    )
+    return dict(query)
+
+
+def update_status(session, model, status, resource_ids):
+    """Set status on the rows of model with the given ids.
+
+    Issues one UPDATE ... WHERE id IN (...) statement per MAX_IN_IDS ids
+    and returns (rows updated, statements issued).
+    """
+    resource_ids = list(resource_ids)
+    rows = statements = 0
+    with session.begin(subtransactions=True):
+        for start in range(0, len(resource_ids), MAX_IN_IDS):
+            rows += session.query(model).filter(
+                model.id.in_(resource_ids[start:start + MAX_IN_IDS])
+            ).update({'status': status}, synchronize_session=False)
+            statements += 1
+    return rows, statements
@@ -14,18 +14,43 @@
 #    under the License.
 
 from neutron.api.v2 import attributes as attr
+from neutron.db import models_v2
 from neutron.db import portsecurity_db
 from neutron.extensions import allowedaddresspairs as addr_pair
 from neutron.extensions import portsecurity as psec
 from neutron import manager
 from neutron.plugins.ml2 import driver_api
 
+from dhc_nsx.ml2 import db as dhcnsx_db
+
+# key of the port security bindings cached in session.info
+PORT_SECURITY_CACHE = 'dhcnsx_port_security'
+
+# key of the network port security defaults cached in session.info; they
+# are only kept for the request, so a change made through another API
+# worker is never missed
+NETWORK_PORT_SECURITY_CACHE = 'dhcnsx_network_port_security'
+
+
+def network_port_security_cache(session):
+    """Return the network id -> port_security_enabled cache of session."""
+    return session.info.setdefault(NETWORK_PORT_SECURITY_CACHE, {})
+
 
 class PortSecurityShim(portsecurity_db.PortSecurityDbMixin):
     """ A composite class to avoid re-implementing the mixin."""
     def __getattr__(self, name):
         return getattr(manager.NeutronManager.get_plugin(), name)
 
+    def _get_network_security_binding(self, context, network_id):
+        # read once per request, e.g. for all the ports of a bulk create
+        network_cache = network_port_security_cache(context.session)
+        if network_id not in network_cache:
+            network_cache[network_id] = super(
+                PortSecurityShim, self
+            )._get_network_security_binding(context, network_id)
+        return network_cache[network_id]
+
 class FakeContext(object):
     def __init__(self, session):
         self.session = session
@@ -45,6 +70,9 @@ class PortSecurityExtension(driver_api.ExtensionDriver):
             data,
             result
         )
+        network_port_security_cache(session)[result['id']] = (
+            result[psec.PORTSECURITY]
+        )
 
     def process_update_network(self, session, data, result):
         self.shim._process_network_security_update(
@@ -52,6 +80,11 @@ class PortSecurityExtension(driver_api.ExtensionDriver):
             data,
             result
         )
+        network_cache = network_port_security_cache(session)
+        if psec.PORTSECURITY in result:
+            network_cache[result['id']] = result[psec.PORTSECURITY]
+        else:
+            network_cache.pop(result['id'], None)
 
     def _process_port(self, func_name, session, data, result):
         port_security, has_ip = self.shim._determine_port_security_and_has_ip(
@@ -64,6 +97,10 @@ class PortSecurityExtension(driver_api.ExtensionDriver):
                 raise addr_pair.AddressPairAndPortSecurityRequired()
 
         getattr(self.shim, func_name)(FakeContext(session), data, result)
+        if psec.PORTSECURITY in result:
+            self._port_security_cache(session)[result['id']] = (
+                result[psec.PORTSECURITY]
+            )
 
     def process_create_port(self, session, data, result):
         self._process_port(
@@ -85,10 +122,42 @@ class PortSecurityExtension(driver_api.ExtensionDriver):
     def extend_network_dict(self, session, result):
         pass  # skipping because importing the mixin attaches mixin hooks
 
+    def _port_security_cache(self, session):
+        return session.info.setdefault(PORT_SECURITY_CACHE, {})
+
+    def _prefetch_port_security(self, session, port_id):
+        """Load the bindings of every port loaded in the session.
+
+        Ports are extended one at a time, but when a list of ports is
+        returned they have all been loaded into the session beforehand;
+        their bindings are fetched with a single query on the first miss
+        and kept in session.info for the rest of the request.
+        """
+        cache = self._port_security_cache(session)
+        port_ids = set(
+            obj.id for obj in session.identity_map.values()
+            if isinstance(obj, models_v2.Port) and obj.id not in cache
+        )
+        port_ids.add(port_id)
+        bindings = dhcnsx_db.get_port_security_bindings(session, port_ids)
+        for listed_id in port_ids:
+            # None records a missing binding, so it is not queried again
+            cache[listed_id] = bindings.get(listed_id)
+        return cache
+
     def extend_port_dict(self, session, result):
         # TODO: investigate whether is this runs port security multiple times
         if psec.PORTSECURITY not in result:
-            result[psec.PORTSECURITY] = self.shim._get_port_security_binding(
-                FakeContext(session),
-                result['id']
-            )
+            cache = self._port_security_cache(session)
+            if result['id'] not in cache:
+                cache = self._prefetch_port_security(session, result['id'])
+            if cache[result['id']] is not None:
+                result[psec.PORTSECURITY] = cache[result['id']]
+            else:
+                # raises PortSecurityBindingNotFound
+                result[psec.PORTSECURITY] = (
+                    self.shim._get_port_security_binding(
+                        FakeContext(session),
+                        result['id']
+                    )
+                )
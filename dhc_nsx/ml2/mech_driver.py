@@ -32,6 +32,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
+import collections
+import contextlib
+import multiprocessing
+import sys
 import uuid
 
 from oslo.config import cfg
@@ -40,76 +45,80 @@ import six
 from neutron.common import constants as n_const
 from neutron.common import exceptions as n_exc
 from neutron.extensions import portbindings
+try:
+    from neutron.callbacks import events
+    from neutron.callbacks import registry
+    from neutron.callbacks import resources
+except ImportError:
+    # stable/juno has no callback registry
+    registry = None
 if '_' not in __builtins__:
     # stable/juno does not use this import
     from neutron.i18n import _
+from neutron import context as n_context
+from neutron.db import models_v2
 from neutron import manager
-from neutron.openstack.common import excutils
 from neutron.openstack.common import log
+from neutron.openstack.common import loopingcall
 from neutron.plugins.ml2 import driver_api
 from neutron.plugins.vmware.api_client import exception as api_exc
 from neutron.plugins.vmware.common import config # noqa
 from neutron.plugins.vmware.common import exceptions as nsx_exc
 from neutron.plugins.vmware.common import nsx_utils
-from neutron.plugins.vmware.common import sync as nsx_sync
+from neutron.plugins.vmware.common import utils
 from neutron.plugins.vmware.dbexts import db as nsx_db
 from neutron.plugins.vmware.nsxlib import switch as switchlib
 
-
-LOG = log.getLogger(__name__)
+from dhc_nsx.ml2 import api_client
+from dhc_nsx.ml2 import breaker
+from dhc_nsx.ml2 import cache
+from dhc_nsx.ml2 import config as dhcnsx_config  # noqa
+from dhc_nsx.ml2 import db as dhcnsx_db
+from dhc_nsx.ml2 import metrics
+from dhc_nsx.ml2 import nsxlib as dhcnsx_lib
+from dhc_nsx.ml2 import pool
+from dhc_nsx.ml2 import sync as dhcnsx_sync
+from dhc_nsx.ml2 import worker
+from dhc_nsx.ml2 import workqueue
 
 
-class DeferredPluginRef(object):
-    def __getattr__(self, name):
-        return getattr(manager.NeutronManager.get_plugin(), name)
+LOG = log.getLogger(__name__)
 
+# neutron port attributes that are reflected on the NSX logical port
+NSX_PORT_ATTRIBUTES = (
+    'name',
+    'admin_state_up',
+    'tenant_id',
+    'device_id',
+    'mac_address',
+    'fixed_ips',
+    'port_security_enabled',
+    'allowed_address_pairs',
+    'security_groups',
+)
 
-class AkandaNsxSynchronizer(nsx_sync.NsxSynchronizer):
-    """
-    The NsxSynchronizer class in Neutron runs a synchronization thread to
-    sync nvp objects with neutron objects. Since we don't use nvp's routers
-    the sync was failing making neutron showing all the routers like if the
-    were in Error state. To fix this behaviour we override the two methods
-    responsible for the routers synchronization in the NsxSynchronizer class
-    to be a noop
+# the attributes NSX allowed_address_pairs are derived from
+ADDRESS_PAIR_ATTRIBUTES = frozenset([
+    'mac_address',
+    'fixed_ips',
+    'port_security_enabled',
+    'allowed_address_pairs',
+])
 
-    """
 
-    def _synchronize_state(self, *args, **kwargs):
-        """
-        Given the complexicity of the NSX synchronization process, there are
-        about a million ways for it to go wrong. (MySQL connection issues,
-        transactional race conditions, etc...)  In the event that an exception
-        is thrown, behavior of the upstream implementation is to immediately
-        report the exception and kill the synchronizer thread.
-
-        This makes it very difficult to detect failure (because the thread just
-        ends) and the problem can only be fixed by completely restarting
-        neutron.
-
-        This implementation changes the behavior to repeatedly fail (and retry)
-        and log verbosely during failure so that the failure is more obvious
-        (and so that auto-recovery is a possibility if e.g., the database
-        comes back to life or a network-related issue becomes resolved).
-        """
-        try:
-            return nsx_sync.NsxSynchronizer._synchronize_state(
-                self, *args, **kwargs
-            )
-        except:
-            LOG.exception("An error occurred while communicating with "
-                          "NSX backend. Will retry synchronization "
-                          "in %d seconds" % self._sync_backoff)
-            self._sync_backoff = min(self._sync_backoff * 2, 64)
-            return self._sync_backoff
-        else:
-            self._sync_backoff = 1
+def api_worker_count():
+    """Return the number of neutron-server processes serving the API."""
+    # not registered outside of neutron-server
+    api_workers = getattr(cfg.CONF, 'api_workers', 0)
+    if api_workers is None:
+        # later releases default to one per CPU
+        api_workers = multiprocessing.cpu_count()
+    return max(api_workers, 1)
 
-    def _synchronize_lrouters(self, *args, **kwargs):
-        pass
 
-    def synchronize_router(self, *args, **kwargs):
-        pass
+class DeferredPluginRef(object):
+    def __getattr__(self, name):
+        return getattr(manager.NeutronManager.get_plugin(), name)
 
 
 class NSXMechDriver(driver_api.MechanismDriver):
@@ -126,20 +135,109 @@ class NSXMechDriver(driver_api.MechanismDriver):
         # start sync thread here
         self.nsx_opts = cfg.CONF.NSX
         self.nsx_sync_opts = cfg.CONF.NSX_SYNC
-        self.cluster = nsx_utils.create_nsx_cluster(
-            cfg.CONF,
-            self.nsx_opts.concurrent_connections,
-            self.nsx_opts.nsx_gen_timeout
+        self.dhcnsx_opts = cfg.CONF.dhcnsx
+        self.metrics = metrics.Metrics()
+        self.cluster = api_client.create_cluster(self.metrics)
+        if self.dhcnsx_opts.metrics_interval:
+            self._metrics_call = loopingcall.FixedIntervalLoopingCall(
+                self.metrics.report,
+                self.dhcnsx_opts.metrics_file
+            )
+            self._metrics_call.start(
+                self.dhcnsx_opts.metrics_interval,
+                initial_delay=self.dhcnsx_opts.metrics_interval
+            )
+
+        self.breaker = breaker.CircuitBreaker(
+            self.dhcnsx_opts.breaker_failure_threshold,
+            self.dhcnsx_opts.breaker_reset_timeout,
+            self.dhcnsx_opts.breaker_probes
         )
+        self.metrics.add_source('breaker', self.breaker.stats)
 
-        self._synchronize = AkandaNsxSynchronizer(
-            DeferredPluginRef(),
-            self.cluster,
-            self.nsx_sync_opts.state_sync_interval+1000,
-            self.nsx_sync_opts.min_sync_req_delay,
-            self.nsx_sync_opts.min_chunk_size,
-            self.nsx_sync_opts.max_random_sync_delay
+        # every API worker counts the ports it creates itself, and misses
+        # those of the others until the entry expires
+        api_workers = api_worker_count()
+        headroom = self.dhcnsx_opts.lswitch_cache_headroom * api_workers
+        max_headroom = self.nsx_opts.max_lp_per_overlay_ls // 2
+        if headroom > max_headroom:
+            # or no cached switch would ever have room for a port
+            LOG.warning(_("lswitch_cache_headroom for %(workers)d API "
+                          "workers is %(headroom)d ports, more than half "
+                          "of max_lp_per_overlay_ls; using %(max)d"),
+                        {'workers': api_workers, 'headroom': headroom,
+                         'max': max_headroom})
+            headroom = max_headroom
+        self._lswitch_cache = cache.SwitchCapacityCache(
+            self.dhcnsx_opts.lswitch_cache_size,
+            self.dhcnsx_opts.lswitch_cache_ttl,
+            headroom
+        )
+        self._secgroup_cache = cache.LRUCache(
+            self.dhcnsx_opts.secgroup_cache_size,
+            self.dhcnsx_opts.secgroup_cache_ttl
         )
+        # neutron port id -> (NSX switch id, NSX port id)
+        self._port_mapping_cache = cache.LRUCache(
+            self.dhcnsx_opts.port_mapping_cache_size,
+            self.dhcnsx_opts.port_mapping_cache_ttl
+        )
+        self._inline_vif_attachment = self.dhcnsx_opts.inline_vif_attachment
+
+        self._lswitch_pool = None
+        if self.dhcnsx_opts.lswitch_pool_size:
+            self._lswitch_pool = pool.LswitchPool(
+                self.cluster,
+                self.dhcnsx_opts.lswitch_pool_size,
+                self._convert_to_transport_zones()
+            )
+            self._lswitch_pool_call = loopingcall.FixedIntervalLoopingCall(
+                self._replenish_lswitch_pool
+            )
+            self._lswitch_pool_call.start(
+                self.dhcnsx_opts.lswitch_pool_interval
+            )
+        # number of NSX requests each port create needed
+        self.port_create_round_trips = collections.Counter()
+        self.metrics.add_source('port_create', self._port_create_stats)
+
+        self._backend_queue = None
+        if self.dhcnsx_opts.async_backend:
+            self._backend_queue = workqueue.OrderedWorkQueue(
+                self.dhcnsx_opts.backend_workers
+            )
+        if registry is not None:
+            registry.subscribe(
+                self._security_group_deleted,
+                resources.SECURITY_GROUP,
+                events.AFTER_DELETE
+            )
+
+        self._sync_supervisor = None
+        if self.dhcnsx_opts.sync_worker == 'inline':
+            self._synchronize = dhcnsx_sync.create_synchronizer(
+                DeferredPluginRef(),
+                self.cluster,
+                self.metrics,
+                breaker=self.breaker,
+                capacity_cache=self._lswitch_cache
+            )
+        else:
+            # a dhcnsx-sync process synchronizes; see dhc_nsx.ml2.worker
+            self._synchronize = worker.WatchForwarder(
+                self.dhcnsx_opts.full_sync_interval,
+                self.dhcnsx_opts.delta_sync_watch_time
+            )
+            if (self.dhcnsx_opts.sync_worker == 'spawn' and
+                    self.nsx_sync_opts.state_sync_interval):
+                self._start_sync_worker()
+
+    def _port_create_stats(self):
+        # number of requests -> port creates that needed that many
+        return {'round_trips': dict(
+            (str(round_trips), count)
+            for round_trips, count in self.port_create_round_trips.items()
+        )}
 
     def _convert_to_transport_zones(self, network=None, bindings=None):
         return nsx_utils.convert_to_nsx_transport_zones(
@@ -149,133 +247,367 @@ class NSXMechDriver(driver_api.MechanismDriver):
             default_transport_type=cfg.CONF.NSX.default_transport_type
         )
 
-    def _find_lswitch(self, context, network_id):
-        max_ports = self.nsx_opts.max_lp_per_overlay_ls
+    @contextlib.contextmanager
+    def _nsx_operation(self, operation):
+        """Time operation and run it through the circuit breaker.
 
-        lswitches = nsx_utils.fetch_nsx_switches(
-            context._plugin_context.session,
-            self.cluster,
-            network_id
+        Raises breaker.BackendUnavailable right away while the circuit is
+        open.
+        """
+        with self.metrics.timed(operation):
+            with self.breaker.guard():
+                yield
+
+    def _start_sync_worker(self):
+        self._sync_supervisor = worker.create_launcher(cfg.CONF)
+        self.metrics.add_source('sync_worker', self._sync_supervisor.stats)
+        atexit.register(self._sync_supervisor.stop)
+        self._sync_supervisor_call = loopingcall.FixedIntervalLoopingCall(
+            self._check_sync_worker
+        )
+        self._sync_supervisor_call.start(
+            self.dhcnsx_opts.sync_worker_heartbeat_interval
         )
 
+    def _check_sync_worker(self):
         try:
-            return [
-                ls for ls in lswitches
-                if (ls['_relations']['LogicalSwitchStatus']['lport_count'] <
-                    max_ports)].pop(0)
-        except IndexError as e:
-            with excutils.save_and_reraise_exception():
-                LOG.debug('No switch has available ports (%d checked)',
-                          len(lswitches))
-
-    def _convert_to_nsx_secgroup_ids(self, context, security_groups):
-        return [
-            nsx_utils.get_nsx_security_group_id(
-                context._plugin_context.session,
-                self.cluster,
-                neutron_sg_id)
-                for neutron_sg_id in security_groups
-        ]
+            self._sync_supervisor.check()
+        except Exception:
+            # keep the looping call alive; the next run tries again
+            LOG.exception(_("Unable to supervise the NSX sync worker"))
 
-    def create_network_precommit(self, context):
-        """Add a network to NSX
+    def _replenish_lswitch_pool(self):
+        try:
+            with self._nsx_operation('pool.replenish'):
+                self._lswitch_pool.replenish()
+        except Exception:
+            # keep the looping call alive; the next run tries again
+            LOG.exception(_("Unable to replenish the logical switch pool"))
 
-        This method does not handle provider networks correctly and
-        is out-of-scope for now.
+    def _claim_pooled_lswitch(self, session, display_name,
+                              transport_zone_config, tags):
+        """Take a switch from the pool, retag it and return its UUID.
+
+        Returns None when the pool is disabled or has no switch for
+        transport_zone_config, so that the caller creates one instead.
         """
-        net_data = context.current
+        if not self._lswitch_pool:
+            return None
 
-        if net_data['admin_state_up'] is False:
-             LOG.warning(_("Network with admin_state_up=False are not yet "
-                           "supported by this plugin. Ignoring setting for "
-                           "network %s"), net_data.get('name', '<unknown>'))
+        with self.metrics.timed('pool.claim'):
+            ls_uuid = self._lswitch_pool.claim(session, transport_zone_config)
+        if not ls_uuid:
+            return None
 
-        transport_zone_config = self._convert_to_transport_zones(net_data)
+        try:
+            with self.metrics.timed('switchlib.update_lswitch'):
+                switchlib.update_lswitch(
+                    self.cluster,
+                    ls_uuid,
+                    display_name,
+                    tags=tags
+                )
+        except n_exc.NotFound:
+            LOG.warning(_("Pooled logical switch %s was not found on the NSX "
+                          "backend"), ls_uuid)
+            return None
+        return ls_uuid
 
-        nsx_switch = switchlib.create_lswitch(
-            self.cluster,
-            net_data['id'],
-            net_data['tenant_id'],
-            net_data.get('name'),
+    def _add_overflow_lswitch(self, session, network_id, lswitches):
+        """Chain a new logical switch to a network whose switches are full.
+
+        As in the NSX plugin, the first switch of the network is tagged
+        multi_lswitch and the new one inherits its tags and transport
+        zones.
+        """
+        main = lswitches[0]
+        multi_lswitch = {'scope': 'multi_lswitch', 'tag': 'True'}
+        tags = [tag for tag in main.get('tags', [])
+                if tag['scope'] != 'multi_lswitch']
+        if len(tags) == len(main.get('tags', [])):
+            with self.metrics.timed('switchlib.update_lswitch'):
+                switchlib.update_lswitch(
+                    self.cluster,
+                    main['uuid'],
+                    main.get('display_name'),
+                    tags=tags + [multi_lswitch]
+                )
+        tags.append(multi_lswitch)
+
+        display_name = '%s-ext-%d' % (main.get('display_name') or '',
+                                      len(lswitches))
+        transport_zone_config = (main.get('transport_zones') or
+                                 self._convert_to_transport_zones())
+        ls_uuid = self._claim_pooled_lswitch(
+            session,
+            display_name,
             transport_zone_config,
-            shared=bool(net_data.get('shared'))
+            tags
         )
+        if not ls_uuid:
+            with self.metrics.timed('nsxlib.create_unbound_lswitch'):
+                ls_uuid = dhcnsx_lib.create_unbound_lswitch(
+                    self.cluster,
+                    display_name,
+                    transport_zone_config,
+                    tags=tags
+                )['uuid']
 
-        nsx_db.add_neutron_nsx_network_mapping(
-           context._plugin_context.session,
-           net_data['id'],
-           nsx_switch['uuid']
-        )
+        with self.metrics.timed('nsx_db.add_neutron_nsx_network_mapping'):
+            nsx_db.add_neutron_nsx_network_mapping(
+                session,
+                network_id,
+                ls_uuid
+            )
+        self._lswitch_cache.update_switch(network_id, ls_uuid, 0)
+        LOG.info(_("Added overflow logical switch %(ls_uuid)s to network "
+                   "%(network_id)s"),
+                 {'ls_uuid': ls_uuid, 'network_id': network_id})
+        return ls_uuid
 
-    def update_network_precommit(self, context):
-        if context.original['name'] != context.current['name']:
-            nsx_switch_ids = nsx_utils.get_nsx_switch_ids(
-               context._plugin_context.session,
-               self.cluster,
-               context.current['id']
+    def _find_lswitch(self, session, network_id, requests=None):
+        """Return the UUID of a logical switch with a free port.
+
+        The capacity cache is consulted first; NSX is only queried when
+        the network is not cached or all of its cached switches are
+        within lswitch_cache_headroom ports per API worker of
+        max_lp_per_overlay_ls, in which case the query is appended to
+        requests.
+        When every switch is full an overflow switch is chained to the
+        network.
+        """
+        max_ports = self.nsx_opts.max_lp_per_overlay_ls
+
+        ls_uuid = self._lswitch_cache.find(network_id, max_ports)
+        if ls_uuid:
+            return ls_uuid
+
+        if requests is not None:
+            requests.append('nsx_utils.fetch_nsx_switches')
+        with self.metrics.timed('nsx_utils.fetch_nsx_switches'):
+            lswitches = nsx_utils.fetch_nsx_switches(
+                session,
+                self.cluster,
+                network_id
             )
+        self._lswitch_cache.load(network_id, lswitches)
+        LOG.debug('Logical switch capacity cache stats: %s',
+                  self._lswitch_cache.stats())
 
-            if not nsx_switch_ids or len(nsx_switch_ids) < 1:
-                 LOG.warn(_("Unable to find NSX mappings for neutron "
-                             "network:%s"), context.original['id'])
+        if not lswitches:
+            raise n_exc.NetworkNotFound(net_id=network_id)
 
-            try:
-                switchlib.update_lswitch(
-                    self.cluster,
-                    lswitch_ids[0],
-                    context.current['name']
+        for ls in lswitches:
+            if (ls['_relations']['LogicalSwitchStatus']['lport_count'] <
+                    max_ports):
+                return ls['uuid']
+
+        LOG.debug('No switch has available ports (%d checked)',
+                  len(lswitches))
+        return self._add_overflow_lswitch(session, network_id, lswitches)
+
+    def _convert_to_nsx_secgroup_ids(self, session, security_groups):
+        """Map neutron security group ids to NSX security profile ids.
+
+        Cached mappings are used as-is; the rest are resolved with a
+        single query against the mapping table, and only groups that are
+        not mapped at all fall back to the per-group NSX search by tag.
+        """
+        nsx_ids = {}
+        for neutron_sg_id in security_groups:
+            nsx_id = self._secgroup_cache.get(neutron_sg_id)
+            if nsx_id:
+                nsx_ids[neutron_sg_id] = nsx_id
+
+        missing = [
+            neutron_sg_id for neutron_sg_id in security_groups
+            if neutron_sg_id not in nsx_ids
+        ]
+        if missing:
+            with self.metrics.timed('dhcnsx_db.get_nsx_security_group_ids'):
+                nsx_ids.update(
+                    dhcnsx_db.get_nsx_security_group_ids(session, missing)
                 )
-            except api_exc.NsxApiException as e:
-                 LOG.warn(_("Logical switch update on NSX backend failed. "
-                            "Neutron network id:%(net_id)s; "
-                            "NSX lswitch id:%(lswitch_id)s;"
-                            "Error:%(error)s"),
-                            {'net_id': context.current['id'],
-                             'lswitch_id': lswitch_ids[0],
-                             'error': e})
+            for neutron_sg_id in missing:
+                if neutron_sg_id not in nsx_ids:
+                    timed = self.metrics.timed(
+                        'nsx_utils.get_nsx_security_group_id'
+                    )
+                    with timed:
+                        nsx_ids[neutron_sg_id] = (
+                            nsx_utils.get_nsx_security_group_id(
+                                session,
+                                self.cluster,
+                                neutron_sg_id)
+                        )
+                if nsx_ids[neutron_sg_id]:
+                    self._secgroup_cache.set(
+                        neutron_sg_id,
+                        nsx_ids[neutron_sg_id]
+                    )
 
-    def delete_network_precommit(self, context):
-        nsx_switch_ids = nsx_utils.get_nsx_switch_ids(
-           context._plugin_context.session,
-           self.cluster,
-           context.current['id']
-        )
+        return [nsx_ids[neutron_sg_id] for neutron_sg_id in security_groups]
 
-        try:
-            switchlib.delete_networks(
+    def _get_nsx_switch_and_port_id(self, session, port_id):
+        """Return the NSX switch and port ids of a neutron port.
+
+        Mappings are cached from the moment this driver writes or first
+        reads them; on a miss nsx_utils reads the mapping table and falls
+        back to an NSX search by tag.
+        """
+        nsx_ids = self._port_mapping_cache.get(port_id)
+        if nsx_ids:
+            return nsx_ids
+
+        with self.metrics.timed('nsx_utils.get_nsx_switch_and_port_id'):
+            nsx_ids = nsx_utils.get_nsx_switch_and_port_id(
+                session,
                 self.cluster,
-                context.current['id'],
-                nsx_switch_ids
+                port_id
             )
-        except n_exc.NotFound:
-             LOG.warning(_("The following logical switches were not found "
-                           "on the NSX backend:%s"), nsx_switch_ids)
+        if nsx_ids[1]:
+            self._port_mapping_cache.set(port_id, nsx_ids)
+        return nsx_ids
 
+    def _security_group_deleted(self, resource, event, trigger, **kwargs):
+        self._secgroup_cache.pop(kwargs.get('security_group_id'))
 
-    def create_port_precommit(self, context):
-        #TODO: mac_learning
+    def _queue_backend(self, key, func, *args, **kwargs):
+        """Queue a backend operation when async_backend is enabled.
 
-        port_data = context.current
+        The operation runs on a worker greenthread with a session of its
+        own, after any work already queued for key (and for parent, if
+        given), so no neutron transaction is held open across the NSX
+        round-trip.
 
-        if port_data['device_owner'] == n_const.DEVICE_OWNER_FLOATINGIP:
-            return  # no need to process further for fip
+        If the operation fails, the status of the resource of model with
+        id key, when given, is set to ERROR: the API call has already
+        returned, and NSX does not match it.
+        """
+        parent = kwargs.pop('parent', None)
+        model = kwargs.pop('model', None)
 
-        nsx_port = None
-        nsx_switch = None
+        def task():
+            session = n_context.get_admin_context().session
+            try:
+                with self._nsx_operation(func.__name__.lstrip('_')):
+                    func(session, *args)
+            except Exception:
+                if model is not None:
+                    self._backend_failed(session, model, key)
+                raise
 
-        nsx_switch = self._find_lswitch(
-            context,
-            port_data['network_id']
-        )
+        self._backend_queue.submit_after(parent, key, task)
 
-        nsx_sec_profile_ids = self._convert_to_nsx_secgroup_ids(
-            context,
-            port_data.get('security_groups') or []
+    def _backend_failed(self, session, model, resource_id):
+        status = (n_const.NET_STATUS_ERROR if model is models_v2.Network
+                  else n_const.PORT_STATUS_ERROR)
+        try:
+            dhcnsx_db.update_status(session, model, status, [resource_id])
+        except Exception:
+            LOG.exception(_("Unable to set the status of %s to ERROR"),
+                          resource_id)
+
+    def _create_network(self, session, net_data):
+        transport_zone_config = self._convert_to_transport_zones(net_data)
+
+        # the tags switchlib.create_lswitch would have set
+        tags = utils.get_tags(
+            os_tid=net_data['tenant_id'],
+            quantum_net_id=net_data['id']
         )
+        if net_data.get('shared'):
+            tags.append({'tag': 'true', 'scope': 'shared'})
+        nsx_switch_id = self._claim_pooled_lswitch(
+            session,
+            net_data.get('name'),
+            transport_zone_config,
+            tags
+        )
+
+        if not nsx_switch_id:
+            with self.metrics.timed('switchlib.create_lswitch'):
+                nsx_switch_id = switchlib.create_lswitch(
+                    self.cluster,
+                    net_data['id'],
+                    net_data['tenant_id'],
+                    net_data.get('name'),
+                    transport_zone_config,
+                    shared=bool(net_data.get('shared'))
+                )['uuid']
+
+        with self.metrics.timed('nsx_db.add_neutron_nsx_network_mapping'):
+            nsx_db.add_neutron_nsx_network_mapping(
+               session,
+               net_data['id'],
+               nsx_switch_id
+            )
+        self._synchronize.watch_network(net_data['id'], session)
+
+    def _update_network(self, session, net_data):
+        with self.metrics.timed('nsx_utils.get_nsx_switch_ids'):
+            nsx_switch_ids = nsx_utils.get_nsx_switch_ids(
+               session,
+               self.cluster,
+               net_data['id']
+            )
 
-        nsx_port = switchlib.create_lport(
+        if not nsx_switch_ids or len(nsx_switch_ids) < 1:
+             LOG.warn(_("Unable to find NSX mappings for neutron "
+                         "network:%s"), net_data['id'])
+             return
+
+        try:
+            with self.metrics.timed('switchlib.update_lswitch'):
+                switchlib.update_lswitch(
+                    self.cluster,
+                    nsx_switch_ids[0],
+                    net_data['name']
+                )
+        except api_exc.NsxApiException as e:
+             LOG.warn(_("Logical switch update on NSX backend failed. "
+                        "Neutron network id:%(net_id)s; "
+                        "NSX lswitch id:%(lswitch_id)s;"
+                        "Error:%(error)s"),
+                        {'net_id': net_data['id'],
+                         'lswitch_id': nsx_switch_ids[0],
+                         'error': e})
+
+    def _delete_network(self, session, network_id, nsx_switch_ids):
+        if not nsx_switch_ids and self._backend_queue:
+            # the mappings went away with the network row; look the
+            # switches up by their neutron tag instead
+            try:
+                with self.metrics.timed('switchlib.get_lswitches'):
+                    lswitches = switchlib.get_lswitches(
+                        self.cluster,
+                        network_id
+                    )
+                nsx_switch_ids = [ls['uuid'] for ls in lswitches]
+            except n_exc.NotFound:
+                nsx_switch_ids = []
+
+        try:
+            with self.metrics.timed('dhcnsx_lib.delete_lswitches'):
+                dhcnsx_lib.delete_lswitches(
+                    self.cluster,
+                    nsx_switch_ids,
+                    self.dhcnsx_opts.delete_concurrency
+                )
+        finally:
+            self._lswitch_cache.invalidate(network_id)
+
+    def _create_lport(self, nsx_switch_id, port_data, nsx_sec_profile_ids,
+                      requests):
+        """Create the NSX logical port of port_data on nsx_switch_id.
+
+        Returns the port and whether its VIF was attached along with it.
+        Every request made is appended to requests, including those that
+        failed.
+        """
+        lport_args = (
             self.cluster,
-            nsx_switch['uuid'],
+            nsx_switch_id,
             port_data['tenant_id'],
             port_data['id'],
             port_data['name'],
@@ -283,66 +615,385 @@ class NSXMechDriver(driver_api.MechanismDriver):
             port_data['admin_state_up'],
             port_data['mac_address'],
             port_data['fixed_ips'],
+        )
+        lport_kwargs = dict(
             port_security_enabled=port_data['port_security_enabled'],
             security_profiles=nsx_sec_profile_ids,
             mac_learning_enabled=None,  # TODO
             allowed_address_pairs=port_data['allowed_address_pairs']
         )
 
-        nsx_db.add_neutron_nsx_port_mapping(
-            context._plugin_context.session,
-            port_data['id'],
-            nsx_switch['uuid'],
-            nsx_port['uuid']
+        inline_error = None
+        if port_data['device_owner'] and self._inline_vif_attachment:
+            requests.append('dhcnsx_lib.create_lport_with_vif')
+            try:
+                with self.metrics.timed('dhcnsx_lib.create_lport_with_vif'):
+                    nsx_port = dhcnsx_lib.create_lport_with_vif(
+                        *lport_args, **lport_kwargs
+                    )
+                return nsx_port, True
+            except api_exc.BadRequest:
+                # the error does not say what NSX rejected; the same port
+                # without the attachment tells whether it was the latter
+                inline_error = sys.exc_info()
+                self.metrics.retry('switchlib.create_lport')
+
+        requests.append('switchlib.create_lport')
+        try:
+            with self.metrics.timed('switchlib.create_lport'):
+                nsx_port = switchlib.create_lport(*lport_args, **lport_kwargs)
+        except api_exc.BadRequest:
+            if inline_error:
+                # the port itself is invalid, not its inline attachment
+                six.reraise(*inline_error)
+            raise
+        if inline_error:
+            # the controller does not take the attachment inline; stop
+            # trying for the lifetime of this process
+            LOG.warning(_("NSX rejected logical port creation with an "
+                          "inline VIF attachment; falling back to a "
+                          "separate attachment request"))
+            self._inline_vif_attachment = False
+        return nsx_port, False
+
+    def _create_port(self, session, port_data):
+        # the NSX requests made, so that they can be counted
+        requests = []
+        nsx_switch_id = self._find_lswitch(
+            session,
+            port_data['network_id'],
+            requests
         )
 
-        if port_data['device_owner']:
-            switchlib.plug_vif_interface(
-                self.cluster,
-                nsx_switch['uuid'],
-                nsx_port['uuid'],
-                "VifAttachment",
-                port_data['id']
+        nsx_sec_profile_ids = self._convert_to_nsx_secgroup_ids(
+            session,
+            port_data.get('security_groups') or []
+        )
+
+        try:
+            nsx_port, attached = self._create_lport(
+                nsx_switch_id,
+                port_data,
+                nsx_sec_profile_ids,
+                requests
+            )
+        except api_exc.Conflict:
+            # the switch is full: its cached count missed ports created
+            # by other processes; look at every switch of the network again
+            LOG.info(_("Logical switch %(ls_uuid)s of network "
+                       "%(network_id)s is full; refreshing its switches"),
+                     {'ls_uuid': nsx_switch_id,
+                      'network_id': port_data['network_id']})
+            self._lswitch_cache.invalidate(port_data['network_id'])
+            nsx_switch_id = self._find_lswitch(
+                session,
+                port_data['network_id'],
+                requests
+            )
+            self.metrics.retry('switchlib.create_lport')
+            nsx_port, attached = self._create_lport(
+                nsx_switch_id,
+                port_data,
+                nsx_sec_profile_ids,
+                requests
             )
 
+        if port_data['device_owner'] and not attached:
+            requests.append('switchlib.plug_vif_interface')
+            with self.metrics.timed('switchlib.plug_vif_interface'):
+                switchlib.plug_vif_interface(
+                    self.cluster,
+                    nsx_switch_id,
+                    nsx_port['uuid'],
+                    "VifAttachment",
+                    port_data['id']
+                )
+        self._lswitch_cache.port_added(port_data['network_id'], nsx_switch_id)
+        self.port_create_round_trips[len(requests)] += 1
+
+        with self.metrics.timed('nsx_db.add_neutron_nsx_port_mapping'):
+            nsx_db.add_neutron_nsx_port_mapping(
+                session,
+                port_data['id'],
+                nsx_switch_id,
+                nsx_port['uuid']
+            )
+        self._port_mapping_cache.set(
+            port_data['id'],
+            (nsx_switch_id, nsx_port['uuid'])
+        )
+
+        self._synchronize.watch_port(port_data['id'], session)
 
         LOG.debug("port created on NSX backend for tenant "
-                  "%(tenant_id)s: (%(id)s)", port_data)
+                  "%(tenant_id)s: (%(id)s) in %(round_trips)d requests",
+                  dict(port_data, round_trips=len(requests)))
 
-    def update_port_precommit(self, context):
-        #TODO: mac_learning
+    @staticmethod
+    def _changed_port_attributes(original, current):
+        """Return the NSX_PORT_ATTRIBUTES that differ between two ports."""
+        if original is None:
+            return set(NSX_PORT_ATTRIBUTES)
+        changed = set()
+        for attribute in NSX_PORT_ATTRIBUTES:
+            before = original.get(attribute)
+            after = current.get(attribute)
+            if attribute == 'security_groups':
+                # the order of security groups is not significant
+                before, after = set(before or []), set(after or [])
+            if before != after:
+                changed.add(attribute)
+        return changed
 
-        port_data = context.current
+    def _nsx_port_changes(self, session, port_data, changed):
+        """Build the NSX logical port attributes affected by changed."""
+        lport_obj = {}
+        if 'name' in changed:
+            lport_obj['display_name'] = utils.check_and_truncate(
+                port_data['name']
+            )
+        if 'admin_state_up' in changed:
+            lport_obj['admin_status_enabled'] = port_data['admin_state_up']
+        if changed & set(['tenant_id', 'device_id']):
+            lport_obj['tags'] = utils.get_tags(
+                os_tid=port_data['tenant_id'],
+                q_port_id=port_data['id'],
+                vm_id=utils.device_id_to_vm_id(port_data['device_id'])
+            )
 
-        nsx_switch_id, nsx_port_id = nsx_utils.get_nsx_switch_and_port_id(
-            context._plugin_context.session,
-            self.cluster,
-            port_data['id']
-        )
+        if changed & (ADDRESS_PAIR_ATTRIBUTES | set(['security_groups'])):
+            nsx_sec_profile_ids = None
+            if 'security_groups' in changed:
+                nsx_sec_profile_ids = self._convert_to_nsx_secgroup_ids(
+                    session,
+                    port_data.get('security_groups') or []
+                )
+            # let switchlib derive the address pairs the way it does on
+            # create, then keep only what changed
+            extensions = {}
+            switchlib._configure_extensions(
+                extensions,
+                port_data['mac_address'],
+                port_data['fixed_ips'],
+                port_data['port_security_enabled'],
+                nsx_sec_profile_ids,
+                None,
+                None,  # TODO: mac_learning
+                port_data['allowed_address_pairs']
+            )
+            if 'security_groups' in changed:
+                lport_obj['security_profiles'] = (
+                    extensions['security_profiles']
+                )
+            if changed & ADDRESS_PAIR_ATTRIBUTES:
+                lport_obj['allowed_address_pairs'] = (
+                    extensions['allowed_address_pairs']
+                )
+        return lport_obj
 
-        nsx_sec_profile_ids = self._convert_to_nsx_secgroup_ids(
-            context,
-            port_data.get('security_groups') or []
-        )
+    def _update_port(self, session, port_data,
+                     changed=frozenset(NSX_PORT_ATTRIBUTES)):
+        """Update the attributes of the NSX logical port affected by changed.
 
-        # ensure port_security_enabled flag set
+        changed is the set of NSX_PORT_ATTRIBUTES that differ from the
+        port as it was last sent to NSX.
+        """
+        nsx_switch_id, nsx_port_id = self._get_nsx_switch_and_port_id(
+            session,
+            port_data['id']
+        )
+        if not nsx_switch_id:
+            return
 
-        if nsx_switch_id:
-            switchlib.update_port(
+        lport_obj = self._nsx_port_changes(session, port_data, changed)
+        with self.metrics.timed('dhcnsx_lib.update_lport'):
+            dhcnsx_lib.update_lport(
                 self.cluster,
                 nsx_switch_id,
                 nsx_port_id,
+                lport_obj
+            )
+        self._synchronize.watch_port(port_data['id'], session)
+
+    def _delete_port(self, session, port_data, nsx_switch_id, nsx_port_id):
+        self._port_mapping_cache.pop(port_data['id'])
+        if not nsx_port_id and self._backend_queue:
+            # the mapping went away with the port row; search by tag
+            with self.metrics.timed('switchlib.get_port_by_neutron_tag'):
+                nsx_port = switchlib.get_port_by_neutron_tag(
+                    self.cluster,
+                    '*',
+                    port_data['id']
+                )
+            if not nsx_port:
+                LOG.warning(_("Port %s not found in NSX"), port_data['id'])
+                return
+            nsx_port_id = nsx_port['uuid']
+            nsx_switch_id = (
+                nsx_port['_relations']['LogicalSwitchConfig']['uuid']
+            )
+
+        try:
+            with self.metrics.timed('switchlib.delete_port'):
+                switchlib.delete_port(
+                    self.cluster,
+                    nsx_switch_id,
+                    nsx_port_id
+                )
+            self._lswitch_cache.port_removed(
+                port_data['network_id'],
+                nsx_switch_id
+            )
+            LOG.debug(
+                "_nsx_delete_port completed for port %(port_id)s on network "
+                "%(net_id)s",
+                {'port_id': port_data['id'], 'net_id': port_data['network_id']}
+            )
+        except n_exc.NotFound:
+            LOG.warning(_("Port %s not found in NSX"), port_data['id'])
+
+    def create_network_precommit(self, context):
+        """Add a network to NSX
+
+        This method does not handle provider networks correctly and
+        is out-of-scope for now.
+        """
+        net_data = context.current
+
+        if net_data['admin_state_up'] is False:
+             LOG.warning(_("Network with admin_state_up=False are not yet "
+                           "supported by this plugin. Ignoring setting for "
+                           "network %s"), net_data.get('name', '<unknown>'))
+
+        if not self._backend_queue:
+            with self._nsx_operation('create_network'):
+                self._create_network(
+                    context._plugin_context.session,
+                    net_data
+                )
+
+    def create_network_postcommit(self, context):
+        if self._backend_queue:
+            self._queue_backend(
+                context.current['id'],
+                self._create_network,
+                dict(context.current),
+                model=models_v2.Network
+            )
+
+    def update_network_precommit(self, context):
+        if context.original['name'] == context.current['name']:
+            return
+        if not self._backend_queue:
+            with self._nsx_operation('update_network'):
+                self._update_network(
+                    context._plugin_context.session,
+                    context.current
+                )
+
+    def update_network_postcommit(self, context):
+        if context.original['name'] == context.current['name']:
+            return
+        if self._backend_queue:
+            self._queue_backend(
+                context.current['id'],
+                self._update_network,
+                dict(context.current),
+                model=models_v2.Network
+            )
+
+    def delete_network_precommit(self, context):
+        if not self._backend_queue:
+            with self._nsx_operation('delete_network'):
+                with self.metrics.timed('nsx_utils.get_nsx_switch_ids'):
+                    nsx_switch_ids = nsx_utils.get_nsx_switch_ids(
+                       context._plugin_context.session,
+                       self.cluster,
+                       context.current['id']
+                    )
+                self._delete_network(
+                    context._plugin_context.session,
+                    context.current['id'],
+                    nsx_switch_ids
+                )
+        else:
+            # the mapping rows are removed together with the network, so
+            # record the switches now and delete them after the commit
+            context._nsx_switch_ids = nsx_db.get_nsx_switch_ids(
+                context._plugin_context.session,
+                context.current['id']
+            )
+
+    def delete_network_postcommit(self, context):
+        if self._backend_queue:
+            self._queue_backend(
+                context.current['id'],
+                self._delete_network,
+                context.current['id'],
+                getattr(context, '_nsx_switch_ids', None)
+            )
+
+    def create_port_precommit(self, context):
+        #TODO: mac_learning
+
+        port_data = context.current
+
+        if port_data['device_owner'] == n_const.DEVICE_OWNER_FLOATINGIP:
+            return  # no need to process further for fip
+
+        if not self._backend_queue:
+            with self._nsx_operation('create_port'):
+                self._create_port(context._plugin_context.session, port_data)
+
+    def create_port_postcommit(self, context):
+        port_data = context.current
+
+        if port_data['device_owner'] == n_const.DEVICE_OWNER_FLOATINGIP:
+            return  # no need to process further for fip
+
+        if self._backend_queue:
+            self._queue_backend(
                 port_data['id'],
-                port_data['tenant_id'],
-                port_data['name'],
-                port_data['device_id'],
-                port_data['admin_state_up'],
-                port_data['mac_address'],
-                port_data['fixed_ips'],
-                port_security_enabled=port_data['port_security_enabled'],
-                security_profiles=nsx_sec_profile_ids,
-                mac_learning_enabled=None, # TODO
-                allowed_address_pairs=port_data['allowed_address_pairs']
+                self._create_port,
+                dict(port_data),
+                parent=port_data['network_id'],
+                model=models_v2.Port
+            )
+
+    def update_port_precommit(self, context):
+        #TODO: mac_learning
+
+        if self._backend_queue:
+            return
+        changed = self._changed_port_attributes(
+            context.original,
+            context.current
+        )
+        if not changed:
+            # e.g. status or binding updates from the agents
+            return
+        with self._nsx_operation('update_port'):
+            self._update_port(
+                context._plugin_context.session,
+                context.current,
+                changed
+            )
+
+    def update_port_postcommit(self, context):
+        if not self._backend_queue:
+            return
+        changed = self._changed_port_attributes(
+            context.original,
+            context.current
+        )
+        if changed:
+            self._queue_backend(
+                context.current['id'],
+                self._update_port,
+                dict(context.current),
+                changed,
+                parent=context.current['network_id'],
+                model=models_v2.Port
             )
 
     def delete_port_precommit(self, context):
@@ -351,22 +1002,47 @@ class NSXMechDriver(driver_api.MechanismDriver):
         if port_data['device_owner'] == n_const.DEVICE_OWNER_FLOATINGIP:
              return  # no need to process further for fip
 
+        if not self._backend_queue:
+            session = context._plugin_context.session
+            with self._nsx_operation('delete_port'):
+                nsx_switch_id, nsx_port_id = (
+                    self._get_nsx_switch_and_port_id(session, port_data['id'])
+                )
+                self._delete_port(
+                    session,
+                    port_data,
+                    nsx_switch_id,
+                    nsx_port_id
+                )
+        else:
+            # the mapping row is removed together with the port, so
+            # record the NSX ids now and delete the lport after the commit
+            context._nsx_port_ids = (
+                self._port_mapping_cache.get(port_data['id']) or
+                nsx_db.get_nsx_switch_and_port_id(
+                    context._plugin_context.session,
+                    port_data['id']
+                )
+            )
 
-        nsx_switch_id, nsx_port_id = nsx_utils.get_nsx_switch_and_port_id(
-            context._plugin_context.session,
-            self.cluster,
-            port_data['id']
-        )
+    def delete_port_postcommit(self, context):
+        port_data = context.current
 
-        try:
-            switchlib.delete_port(self.cluster, nsx_switch_id, nsx_port_id)
-            LOG.debug(
-                "_nsx_delete_port completed for port %(port_id)s on network "
-                "%(net_id)s",
-                {'port_id': port_data['id'], 'net_id': port_data['network_id']}
+        if port_data['device_owner'] == n_const.DEVICE_OWNER_FLOATINGIP:
+             return  # no need to process further for fip
+
+        if self._backend_queue:
+            nsx_switch_id, nsx_port_id = getattr(
+                context, '_nsx_port_ids', (None, None)
+            )
+            self._queue_backend(
+                port_data['id'],
+                self._delete_port,
+                dict(port_data),
+                nsx_switch_id,
+                nsx_port_id,
+                parent=port_data['network_id']
             )
-        except n_exc.NotFound:
-            LOG.warning(_("Port %s not found in NSX"), port_data['id'])
 
     def bind_port(self, context):
         # TODO: handle more than 1 segment
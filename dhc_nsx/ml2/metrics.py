@@ -0,0 +1,292 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Latency and error metrics for the calls made by the mechanism driver
+
+Operations are timed with `Metrics.timed`, e.g.::
+
+    with self.metrics.timed('create_lport'):
+        switchlib.create_lport(...)
+
+and requests to each NSX controller are timed by `instrument_api_client`.
+Other components can add their own per-item stats with `Metrics.add_source`.
+`Metrics.snapshot` returns everything recorded so far as a dict, which
+`Metrics.dump` writes to a JSON file for a local scraper.
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+from neutron.openstack.common import log
+
+
+LOG = log.getLogger(__name__)
+
+# upper bounds, in seconds, of the latency histogram buckets: 1ms to ~65s,
+# four buckets per doubling
+BUCKETS = [0.001 * 2 ** (index / 4.0) for index in range(65)]
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram(object):
+    """Latency counts over the fixed buckets in BUCKETS.
+
+    Percentiles are reported as the upper bound of the bucket they fall
+    in, so they are accurate to within a fifth of their value.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(BUCKETS):
+                    return self.max
+                return min(BUCKETS[index], self.max)
+        return self.max
+
+    def snapshot(self):
+        result = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+        }
+        for percent in PERCENTILES:
+            result['p%d' % percent] = self.percentile(percent)
+        return result
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = collections.Counter()
+        self.retries = 0
+        self.in_flight = 0
+
+    def snapshot(self):
+        return {
+            'latency': self.latency.snapshot(),
+            'errors': dict(self.errors),
+            'error_count': sum(self.errors.values()),
+            'retries': self.retries,
+            'in_flight': self.in_flight,
+        }
+
+
+class Metrics(object):
+    """Per-operation and per-controller latency, error and retry counters"""
+
+    def __init__(self):
+        self._operations = collections.defaultdict(_Stats)
+        self._controllers = collections.defaultdict(_Stats)
+        self._lock = threading.Lock()
+        # name -> function returning {item: {stat: value}}
+        self._sources = {}
+        self.started_at = time.time()
+
+    def _begin(self, stats):
+        with self._lock:
+            stats.in_flight += 1
+        return time.time()
+
+    def _end(self, stats, started, error=None):
+        elapsed = time.time() - started
+        with self._lock:
+            stats.in_flight -= 1
+            stats.latency.add(elapsed)
+            if error:
+                stats.errors[error] += 1
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        """Time the enclosed block as one call of operation.
+
+        Exceptions are counted by class name and re-raised.
+        """
+        stats = self._operations[operation]
+        started = self._begin(stats)
+        try:
+            yield
+        except Exception as e:
+            self._end(stats, started, e.__class__.__name__)
+            raise
+        self._end(stats, started)
+
+    def retry(self, operation):
+        """Count a retry of operation after a failed attempt."""
+        with self._lock:
+            self._operations[operation].retries += 1
+
+    def controller_request_started(self, controller):
+        return self._begin(self._controllers[controller])
+
+    def controller_request_finished(self, controller, started, error=None):
+        self._end(self._controllers[controller], started, error)
+
+    def controller_retry(self, controller):
+        with self._lock:
+            self._controllers[controller].retries += 1
+
+    def add_source(self, name, stats):
+        """Include the stats returned by stats() under name in snapshots.
+
+        stats must return a dict of dicts of numbers, e.g. per controller.
+        """
+        self._sources[name] = stats
+
+    def snapshot(self):
+        sources = dict(
+            (name, stats()) for name, stats in self._sources.items()
+        )
+        with self._lock:
+            return dict(sources, **{
+                'timestamp': time.time(),
+                'uptime': time.time() - self.started_at,
+                'operations': dict(
+                    (name, stats.snapshot())
+                    for name, stats in self._operations.items()
+                ),
+                'controllers': dict(
+                    (name, stats.snapshot())
+                    for name, stats in self._controllers.items()
+                ),
+            })
+
+    def summary(self):
+        """Return one human-readable line per operation and controller."""
+        snapshot = self.snapshot()
+        lines = []
+        for kind in ('operations', 'controllers'):
+            for name, stats in sorted(snapshot[kind].items()):
+                latency = stats['latency']
+                if not latency['count'] and not stats['in_flight']:
+                    continue
+                lines.append(
+                    '%s %s: count=%d errors=%d retries=%d in_flight=%d '
+                    'p50=%s p95=%s p99=%s max=%s' % (
+                        kind[:-1], name, latency['count'],
+                        stats['error_count'], stats['retries'],
+                        stats['in_flight'],
+                        _ms(latency['p50']), _ms(latency['p95']),
+                        _ms(latency['p99']), _ms(latency['max'])
+                    )
+                )
+        for kind in sorted(self._sources):
+            for name, stats in sorted(snapshot[kind].items()):
+                lines.append('%s %s: %s' % (kind, name, ' '.join(
+                    '%s=%s' % (stat, _number(value))
+                    for stat, value in sorted(stats.items())
+                )))
+        return lines
+
+    def dump(self, path):
+        """Write `snapshot` to path as JSON, replacing it atomically."""
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+    def report(self, path=None):
+        for line in self.summary():
+            LOG.info("NSX metrics: %s", line)
+        if path:
+            try:
+                self.dump(path)
+            except (IOError, OSError) as e:
+                LOG.warning("Unable to write NSX metrics to %s: %s", path, e)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return value
+
+
+def _ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1fms' % (seconds * 1000)
+
+
+def instrument_api_client(api_client, metrics):
+    """Record per-controller request metrics for an NSX API client.
+
+    Every request the client issues acquires a controller connection and
+    releases it once the response is in, flagging the connection when the
+    controller failed; the time in between is recorded against the
+    controller. A request that acquires a connection again under the same
+    request id is being retried.
+    """
+    acquire_connection = api_client.acquire_connection
+    release_connection = api_client.release_connection
+    # id(connection) -> (controller, start time)
+    in_flight = {}
+    seen_rids = collections.deque(maxlen=1024)
+
+    def controller(http_conn):
+        host, port, is_ssl = api_client._conn_params(http_conn)
+        return '%s:%s' % (host, port)
+
+    def acquire(*args, **kwargs):
+        http_conn = acquire_connection(*args, **kwargs)
+        if http_conn is not None:
+            rid = kwargs.get('rid', -1)
+            name = controller(http_conn)
+            if rid != -1 and rid in seen_rids:
+                metrics.controller_retry(name)
+            elif rid != -1:
+                seen_rids.append(rid)
+            in_flight[id(http_conn)] = (
+                name, metrics.controller_request_started(name)
+            )
+        return http_conn
+
+    def release(http_conn, bad_state=False, service_unavail=False,
+                *args, **kwargs):
+        started = in_flight.pop(id(http_conn), None)
+        if started:
+            error = None
+            if service_unavail:
+                error = 'service_unavailable'
+            elif bad_state:
+                error = 'bad_state'
+            metrics.controller_request_finished(started[0], started[1], error)
+        return release_connection(http_conn, bad_state, service_unavail,
+                                  *args, **kwargs)
+
+    api_client.acquire_connection = acquire
+    api_client.release_connection = release
@@ -0,0 +1,79 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tables owned by dhcnsx
+
+They are kept out of the neutron metadata, since neutron's migrations know
+nothing about them, and are created on first use instead.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.ext import declarative
+
+
+BASE = declarative.declarative_base()
+
+
+def create_table(session, model):
+    """Create the table of model unless it already exists."""
+    model.__table__.create(session.get_bind(), checkfirst=True)
+
+
+class SyncLease(BASE):
+    """A synchronizer taking part in partitioned synchronization"""
+
+    __tablename__ = 'dhcnsx_sync_leases'
+
+    member_id = sa.Column(sa.String(255), primary_key=True)
+    expires_at = sa.Column(sa.DateTime, nullable=False)
+
+
+class PooledLswitch(BASE):
+    """A pre-created logical switch not yet claimed by a network"""
+
+    __tablename__ = 'dhcnsx_lswitch_pool'
+
+    nsx_id = sa.Column(sa.String(36), primary_key=True)
+    # transport zone configuration the switch was created with
+    transport_zones = sa.Column(sa.String(255), nullable=False, index=True)
+
+
+class LswitchPoolState(BASE):
+    """Which process refills the logical switch pool of a transport zone
+
+    A process only refills the pool once it has set refilling_until, which
+    it can only do when that time has passed.
+    """
+
+    __tablename__ = 'dhcnsx_lswitch_pool_state'
+
+    transport_zones = sa.Column(sa.String(255), primary_key=True)
+    refilling_until = sa.Column(sa.DateTime)
+
+
+class SyncWatch(BASE):
+    """A network or port recently changed by a driver, for sync workers
+
+    Drivers whose synchronization runs in a worker process record here
+    what they would otherwise pass to the synchronizer's watch_network and
+    watch_port; the worker takes the rows over on its next delta sync.
+    """
+
+    __tablename__ = 'dhcnsx_sync_watches'
+
+    resource_id = sa.Column(sa.String(36), primary_key=True)
+    # 'network' or 'port'
+    resource_type = sa.Column(sa.String(16), nullable=False)
+    expires_at = sa.Column(sa.DateTime, nullable=False)
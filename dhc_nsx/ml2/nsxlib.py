@@ -0,0 +1,204 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""NSX API calls that neutron.plugins.vmware.nsxlib does not offer"""
+
+import eventlet
+from oslo.config import cfg
+
+from neutron.common import exceptions as n_exc
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log
+from neutron.plugins.vmware.api_client import exception as api_exc
+from neutron.plugins.vmware.common import exceptions as nsx_exc
+from neutron.plugins.vmware.common import utils
+from neutron.plugins.vmware import nsxlib
+from neutron.plugins.vmware.nsxlib import switch as switchlib
+
+
+LOG = log.getLogger(__name__)
+
+
+def create_lport_with_vif(cluster, lswitch_uuid, tenant_id, neutron_port_id,
+                          display_name, device_id, admin_status_enabled,
+                          mac_address=None, fixed_ips=None,
+                          port_security_enabled=None, security_profiles=None,
+                          queue_id=None, mac_learning_enabled=None,
+                          allowed_address_pairs=None):
+    """Create a logical port with its VifAttachment in a single request.
+
+    Builds the same body as switchlib.create_lport and adds the
+    attachment that switchlib.plug_vif_interface would otherwise PUT in a
+    second request. Controllers that do not accept an inline attachment
+    reject the request with api_exc.BadRequest.
+    """
+    display_name = utils.check_and_truncate(display_name)
+    lport_obj = dict(
+        admin_status_enabled=admin_status_enabled,
+        display_name=display_name,
+        tags=utils.get_tags(os_tid=tenant_id,
+                            q_port_id=neutron_port_id,
+                            vm_id=utils.device_id_to_vm_id(device_id)),
+        attachment={'type': 'VifAttachment', 'vif_uuid': neutron_port_id}
+    )
+
+    switchlib._configure_extensions(lport_obj, mac_address, fixed_ips,
+                                    port_security_enabled, security_profiles,
+                                    queue_id, mac_learning_enabled,
+                                    allowed_address_pairs)
+
+    path = nsxlib._build_uri_path(switchlib.LSWITCHPORT_RESOURCE,
+                                  parent_resource_id=lswitch_uuid)
+    result = nsxlib.do_request(nsxlib.HTTP_POST, path,
+                               jsonutils.dumps(lport_obj),
+                               cluster=cluster)
+
+    LOG.debug("Created logical port %(result)s with VIF attachment on "
+              "logical switch %(uuid)s",
+              {'result': result['uuid'], 'uuid': lswitch_uuid})
+    return result
+
+
+def update_lport(cluster, lswitch_uuid, lport_uuid, lport_obj):
+    """Update only the logical port attributes present in lport_obj.
+
+    NSX leaves attributes missing from a PUT body unchanged (which
+    switchlib.update_lswitch relies on too), so unlike
+    switchlib.update_port this does not resend the whole port.
+    """
+    path = nsxlib._build_uri_path(switchlib.LSWITCHPORT_RESOURCE,
+                                  lport_uuid, lswitch_uuid)
+    try:
+        result = nsxlib.do_request(nsxlib.HTTP_PUT, path,
+                                   jsonutils.dumps(lport_obj),
+                                   cluster=cluster)
+    except n_exc.NotFound:
+        LOG.error("Port or Network not found, Error: %s", lport_uuid)
+        raise n_exc.PortNotFoundOnNetwork(port_id=lport_uuid,
+                                          net_id=lswitch_uuid)
+
+    LOG.debug("Updated attributes %(attributes)s of logical port %(uuid)s "
+              "on logical switch %(ls_uuid)s",
+              {'attributes': sorted(lport_obj), 'uuid': lport_uuid,
+               'ls_uuid': lswitch_uuid})
+    return result
+
+
+def create_unbound_lswitch(cluster, display_name, transport_zones_config,
+                           tags=None):
+    """Create a logical switch that belongs to no neutron network yet.
+
+    Builds the same body as switchlib.create_lswitch, minus the neutron
+    network and tenant tags; a network claiming the switch sets them with
+    switchlib.update_lswitch.
+    """
+    lswitch_obj = {
+        'display_name': utils.check_and_truncate(display_name),
+        'transport_zones': transport_zones_config,
+        'replication_mode': cfg.CONF.NSX.replication_mode,
+        'tags': tags or [],
+    }
+    path = nsxlib._build_uri_path(switchlib.LSWITCH_RESOURCE)
+    lswitch = nsxlib.do_request(nsxlib.HTTP_POST, path,
+                                jsonutils.dumps(lswitch_obj),
+                                cluster=cluster)
+    LOG.debug("Created unbound logical switch %s", lswitch['uuid'])
+    return lswitch
+
+
+def delete_lswitches(cluster, lswitch_uuids, concurrency):
+    """Delete logical switches with up to concurrency requests in flight.
+
+    Unlike switchlib.delete_networks, which stops at the first switch
+    that is not found, every switch is attempted: switches already gone
+    are skipped with a warning, and once all requests are done a single
+    failure is re-raised as is while several are raised together in an
+    NsxPluginException.  If NSX
+    refuses to delete a switch because ports are left on it (409
+    Conflict), the ports are deleted in the same fan-out and the switch
+    deletion is retried once.
+    """
+    limit = eventlet.semaphore.Semaphore(concurrency)
+    lswitch_pool = eventlet.GreenPool(concurrency)
+    # separate, so that switch deletions never wait for a free slot their
+    # own port deletions hold
+    lport_pool = eventlet.GreenPool()
+
+    def request(func, *args, **kwargs):
+        with limit:
+            return func(cluster, *args, **kwargs)
+
+    def delete_lport(lswitch_uuid, lport_uuid):
+        try:
+            request(switchlib.delete_port, lswitch_uuid, lport_uuid)
+        except n_exc.NotFound:
+            pass
+
+    def delete_lswitch(lswitch_uuid):
+        path = nsxlib._build_uri_path(switchlib.LSWITCH_RESOURCE,
+                                      lswitch_uuid)
+        try:
+            try:
+                request(_delete, path)
+            except api_exc.Conflict:
+                lports = request(switchlib.query_lswitch_lports,
+                                 lswitch_uuid, fields='uuid')
+                LOG.info("Deleting %(count)d ports left on logical switch "
+                         "%(uuid)s", {'count': len(lports),
+                                      'uuid': lswitch_uuid})
+                list(lport_pool.imap(delete_lport,
+                                     [lswitch_uuid] * len(lports),
+                                     [lport['uuid'] for lport in lports]))
+                request(_delete, path)
+        except n_exc.NotFound:
+            LOG.warning("Logical switch %s not found on the NSX backend",
+                        lswitch_uuid)
+        except Exception as e:
+            LOG.exception("Unable to delete logical switch %s",
+                          lswitch_uuid)
+            return lswitch_uuid, e
+
+    failures = [failure for failure in lswitch_pool.imap(delete_lswitch,
+                                                         lswitch_uuids)
+                if failure]
+    if len(failures) == 1:
+        raise failures[0][1]
+    if failures:
+        raise nsx_exc.NsxPluginException(
+            err_msg="Unable to delete %d of %d logical switches: %s" % (
+                len(failures), len(lswitch_uuids),
+                '; '.join('%s: %s' % failure for failure in failures)
+            )
+        )
+
+
+def iter_query_pages(cluster, path, page_length, neutron_only=True):
+    """Yield the pages of results of an NSX query one at a time.
+
+    Unlike nsxlib.get_all_query_pages, which gathers every page before
+    returning, only the page being consumed is held in memory.
+    """
+    page_cursor = None
+    while True:
+        results, page_cursor, total = nsxlib.get_single_query_page(
+            path, cluster, page_cursor, page_length, neutron_only
+        )
+        yield results
+        if not page_cursor:
+            return
+
+
+def _delete(cluster, path):
+    nsxlib.do_request(nsxlib.HTTP_DELETE, path, cluster=cluster)
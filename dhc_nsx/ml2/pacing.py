@@ -0,0 +1,91 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Pacing of the NSX state synchronization from measured response times
+
+The upstream synchronizer fetches chunks of a fixed minimum size spread
+evenly over state_sync_interval, whatever the controllers can take.
+`SyncPacer` sizes chunks additive-increase/multiplicative-decrease style
+and spaces them so that the synchronizer keeps NSX busy for at most a
+given fraction of the time.
+"""
+
+# weight of the newest sample in the per-object latency average
+DECAY = 0.2
+
+# a chunk is slow when its per-object latency exceeds the average by this
+# factor, which is taken as a sign of controller load
+LATENCY_TOLERANCE = 2.0
+
+
+class SyncPacer(object):
+    """AIMD chunk sizing and duty-cycle pacing for the synchronizer.
+
+    After every sweep of NSX without failed or slow chunks, the chunk size
+    grows by min_chunk_size, up to max_chunk_size; a failed or slow chunk
+    halves it, down to min_chunk_size.  The size only changes between
+    sweeps, since the synchronizer derives the number of chunks of a
+    sweep from it.
+
+    Chunks of a sweep are spaced so that fetching takes at most
+    capacity_fraction of the time, and at least min_delay apart.
+    """
+
+    def __init__(self, min_chunk_size, max_chunk_size, min_delay,
+                 capacity_fraction):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(max_chunk_size, min_chunk_size)
+        self.min_delay = min_delay
+        self.capacity_fraction = min(max(capacity_fraction, 0.01), 1.0)
+        self.chunk_size = min_chunk_size
+        # moving average of the seconds NSX takes per object fetched
+        self.latency = None
+        self._congested = False
+
+    def start_sweep(self):
+        """Apply the outcome of the previous sweep; return the chunk size."""
+        if self.latency is None:
+            # nothing was fetched yet
+            pass
+        elif self._congested:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+        else:
+            self.chunk_size = min(self.chunk_size + self.min_chunk_size,
+                                  self.max_chunk_size)
+        self._congested = False
+        return self.chunk_size
+
+    def chunk_fetched(self, elapsed, objects):
+        """Record a fetched chunk; return the delay before the next one."""
+        per_object = elapsed / max(objects, 1)
+        if self.latency is None:
+            self.latency = per_object
+        else:
+            if per_object > LATENCY_TOLERANCE * self.latency:
+                self._congested = True
+            self.latency += DECAY * (per_object - self.latency)
+        return max(
+            elapsed * (1 - self.capacity_fraction) / self.capacity_fraction,
+            self.min_delay
+        )
+
+    def chunk_failed(self):
+        self._congested = True
+
+    def stats(self):
+        return {'sync': {
+            'chunk_size': self.chunk_size,
+            'latency_per_object': self.latency,
+        }}
@@ -0,0 +1,163 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Consistent-hash partitioning of NSX synchronization work
+
+Every synchronizer taking part holds a lease in the dhcnsx_sync_leases
+table of the neutron database and renews it periodically.  The members
+with a live lease form a hash ring, and each member only synchronizes the
+resources that hash to it.  When a member stops renewing its lease, the
+others drop it from their ring and take over its share.
+"""
+
+import bisect
+import datetime
+import errno
+import hashlib
+import os
+import socket
+
+from oslo.db import exception as db_exc
+
+from neutron.openstack.common import log
+from neutron.openstack.common import timeutils
+
+from dhc_nsx.ml2 import models
+
+
+LOG = log.getLogger(__name__)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # only allowed to signal our own processes
+        return e.errno == errno.EPERM
+    return True
+
+
+class HashRing(object):
+    """A consistent hash ring with ``replicas`` points per member"""
+
+    def __init__(self, members, replicas=64):
+        self.members = frozenset(members)
+        self._ring = sorted(
+            (self._hash('%s-%d' % (member, index)), member)
+            for member in self.members
+            for index in range(replicas)
+        )
+        self._points = [point for point, member in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def get_member(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._ring[index % len(self._ring)][1]
+
+
+class SyncPartitioner(object):
+    """Decides which resources this process synchronizes
+
+    `heartbeat` must be called well within ``lease_time`` seconds of the
+    previous call; it renews this member's lease and rebuilds the ring from
+    the live leases.
+
+    Neutron forks its API workers after the driver created the
+    partitioner, so the member id is worked out per process: a forked
+    worker owns nothing until its first heartbeat registers it under its
+    own pid.  The lease it inherited is only dropped once the process
+    that holds it is gone; the parent usually keeps renewing it.
+    """
+
+    def __init__(self, lease_time, member_id=None):
+        self.lease_time = lease_time
+        self._member_id = member_id
+        self._pid = os.getpid()
+        self.member_id = self._process_member_id()
+        self.ring = HashRing([self.member_id])
+        self._table_created = False
+
+    def _process_member_id(self):
+        return self._member_id or '%s:%d' % (
+            socket.gethostname(), os.getpid()
+        )
+
+    def heartbeat(self, session):
+        """Renew our lease and refresh the ring; True if it changed"""
+        if not self._table_created:
+            models.create_table(session, models.SyncLease)
+            self._table_created = True
+
+        forked = False
+        inherited = None
+        member_id = self._process_member_id()
+        if member_id != self.member_id:
+            forked = True
+            inherited, self.member_id = self.member_id, member_id
+            parent_pid, self._pid = self._pid, os.getpid()
+            self.ring = HashRing([member_id])
+            LOG.info("NSX synchronization member %(member)s forked from "
+                     "%(inherited)s", {'member': member_id,
+                                       'inherited': inherited})
+            if _process_exists(parent_pid):
+                # still a member in its own right
+                inherited = None
+
+        now = timeutils.utcnow()
+        expires_at = now + datetime.timedelta(seconds=self.lease_time)
+        try:
+            with session.begin(subtransactions=True):
+                if inherited:
+                    session.query(models.SyncLease).filter_by(
+                        member_id=inherited
+                    ).delete(synchronize_session=False)
+                renewed = session.query(models.SyncLease).filter_by(
+                    member_id=self.member_id
+                ).update({'expires_at': expires_at})
+                if not renewed:
+                    session.add(models.SyncLease(
+                        member_id=self.member_id,
+                        expires_at=expires_at
+                    ))
+        except db_exc.DBDuplicateEntry:
+            # another process with the same member id got there first
+            pass
+
+        with session.begin(subtransactions=True):
+            session.query(models.SyncLease).filter(
+                models.SyncLease.expires_at < now
+            ).delete(synchronize_session=False)
+            members = set(
+                lease.member_id for lease in session.query(models.SyncLease)
+            )
+        members.add(self.member_id)
+
+        if members == self.ring.members and not forked:
+            return False
+        LOG.info("NSX synchronization members changed: %s",
+                 ', '.join(sorted(members)))
+        self.ring = HashRing(members)
+        return True
+
+    def owns(self, key):
+        if self._process_member_id() != self.member_id:
+            # forked and not registered yet
+            return False
+        return self.ring.get_member(key) == self.member_id
@@ -0,0 +1,201 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""A pool of pre-created logical switches
+
+Switches are created in the background and recorded in the
+dhcnsx_lswitch_pool table; a network claims one by deleting its row, so
+that concurrent API workers never claim the same switch, and then only
+has to retag it.  Only one process at a time refills a pool, the one
+holding its row in the dhcnsx_lswitch_pool_state table.
+"""
+
+import datetime
+import random
+
+from oslo.db import exception as db_exc
+import sqlalchemy as sa
+
+from neutron import context as n_context
+from neutron.openstack.common import log
+from neutron.openstack.common import timeutils
+
+from dhc_nsx.ml2 import models
+from dhc_nsx.ml2 import nsxlib as dhcnsx_lib
+
+
+LOG = log.getLogger(__name__)
+
+# tag marking the switches of the pool on NSX
+POOL_TAG_SCOPE = 'dhcnsx_pool'
+
+# number of pooled switches a claim tries before giving up
+CLAIM_ATTEMPTS = 5
+
+# seconds a process may spend refilling a pool before another one may
+# take over
+REFILL_TIME = 300
+
+# maximum number of surplus switches deleted at the same time
+TRIM_CONCURRENCY = 4
+
+
+def transport_zones_key(transport_zones_config):
+    """Return a string identifying a transport zone configuration."""
+    return ','.join(sorted(
+        '%s:%s' % (zone['zone_uuid'], zone['transport_type'])
+        for zone in transport_zones_config
+    ))
+
+
+class LswitchPool(object):
+    """Keeps ``size`` unclaimed switches ready for a transport zone config"""
+
+    def __init__(self, cluster, size, transport_zones_config):
+        self.cluster = cluster
+        self.size = size
+        self.transport_zones_config = transport_zones_config
+        self.key = transport_zones_key(transport_zones_config)
+        self._table_created = False
+
+    def _ensure_table(self, session):
+        if not self._table_created:
+            models.create_table(session, models.PooledLswitch)
+            models.create_table(session, models.LswitchPoolState)
+            self._table_created = True
+
+    def _query(self, session):
+        return session.query(models.PooledLswitch).filter_by(
+            transport_zones=self.key
+        )
+
+    def claim(self, session, transport_zones_config):
+        """Take a switch out of the pool and return its UUID.
+
+        Returns None when the pool is empty or was built for another
+        transport zone configuration.  The claim is part of the current
+        transaction of session, so the switch returns to the pool if it
+        is rolled back.
+        """
+        if transport_zones_key(transport_zones_config) != self.key:
+            return None
+        self._ensure_table(session)
+
+        candidates = [
+            row.nsx_id for row in self._query(session).limit(CLAIM_ATTEMPTS)
+        ]
+        # spread concurrent claims over the candidates
+        random.shuffle(candidates)
+        for nsx_id in candidates:
+            with session.begin(subtransactions=True):
+                claimed = session.query(models.PooledLswitch).filter_by(
+                    nsx_id=nsx_id
+                ).delete(synchronize_session=False)
+            if claimed:
+                return nsx_id
+        return None
+
+    def _start_refill(self, session):
+        """Make this process the one refilling the pool.
+
+        Returns the time until which it is, or None when another process
+        is refilling it.  The state row is taken with a conditional
+        UPDATE rather than locked, so no lock is held while switches are
+        created.
+        """
+        now = timeutils.utcnow()
+        until = now + datetime.timedelta(seconds=REFILL_TIME)
+        state = models.LswitchPoolState
+        with session.begin(subtransactions=True):
+            taken = session.query(state).filter(
+                state.transport_zones == self.key,
+                sa.or_(state.refilling_until.is_(None),
+                       state.refilling_until < now)
+            ).update({'refilling_until': until}, synchronize_session=False)
+        if taken:
+            return until
+        if session.query(state).filter_by(transport_zones=self.key).count():
+            return None
+        try:
+            with session.begin(subtransactions=True):
+                session.add(state(transport_zones=self.key,
+                                  refilling_until=until))
+        except db_exc.DBDuplicateEntry:
+            # another process created it first
+            return None
+        return until
+
+    def _finish_refill(self, session, until):
+        state = models.LswitchPoolState
+        with session.begin(subtransactions=True):
+            session.query(state).filter_by(
+                transport_zones=self.key,
+                refilling_until=until
+            ).update({'refilling_until': None}, synchronize_session=False)
+
+    def replenish(self):
+        """Create or delete switches until the pool holds ``size`` of them.
+
+        Every API worker runs this periodically; all but the one refilling
+        the pool at the time return right away.
+        """
+        session = n_context.get_admin_context().session
+        self._ensure_table(session)
+
+        until = self._start_refill(session)
+        if not until:
+            return
+        try:
+            self._refill(session)
+        finally:
+            self._finish_refill(session, until)
+
+    def _refill(self, session):
+        missing = self.size - self._query(session).count()
+        for index in range(missing):
+            lswitch = dhcnsx_lib.create_unbound_lswitch(
+                self.cluster,
+                'dhcnsx-pool',
+                self.transport_zones_config,
+                tags=[{'scope': POOL_TAG_SCOPE, 'tag': self.key[:40]}]
+            )
+            with session.begin(subtransactions=True):
+                session.add(models.PooledLswitch(
+                    nsx_id=lswitch['uuid'],
+                    transport_zones=self.key
+                ))
+        if missing > 0:
+            LOG.debug("Added %d logical switches to the pool", missing)
+            return
+
+        # the size was lowered, or switches were added by a refill that
+        # overran REFILL_TIME; take them out of the pool as claims do
+        surplus = []
+        candidates = [
+            row.nsx_id for row in self._query(session).limit(-missing)
+        ]
+        for nsx_id in candidates:
+            with session.begin(subtransactions=True):
+                claimed = session.query(models.PooledLswitch).filter_by(
+                    nsx_id=nsx_id
+                ).delete(synchronize_session=False)
+            if claimed:
+                surplus.append(nsx_id)
+        if surplus:
+            dhcnsx_lib.delete_lswitches(
+                self.cluster, surplus, TRIM_CONCURRENCY
+            )
+            LOG.debug("Deleted %d surplus logical switches from the pool",
+                      len(surplus))
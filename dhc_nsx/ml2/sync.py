@@ -0,0 +1,738 @@
+#    Copyright 2015 Akanda, Inc.
+#    All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import calendar
+import collections
+import contextlib
+import random
+import time
+
+from oslo.config import cfg
+
+from neutron.common import constants
+from neutron.common import exceptions as n_exc
+from neutron import context as n_context
+from neutron.db import external_net_db
+from neutron.db import models_v2
+from neutron.openstack.common import log
+from neutron.openstack.common import loopingcall
+from neutron.openstack.common import timeutils
+from neutron.plugins.vmware.common import config as nsx_config  # noqa
+from neutron.plugins.vmware.common import sync as nsx_sync
+from neutron.plugins.vmware import nsxlib
+from neutron.plugins.vmware.nsxlib import switch as switchlib
+
+from dhc_nsx.ml2 import breaker as dhcnsx_breaker
+from dhc_nsx.ml2 import cache
+from dhc_nsx.ml2 import config as dhcnsx_config  # noqa
+from dhc_nsx.ml2 import db as dhcnsx_db
+from dhc_nsx.ml2 import models
+from dhc_nsx.ml2 import pacing
+from dhc_nsx.ml2 import partition
+
+
+LOG = log.getLogger(__name__)
+
+# tag holding the neutron network id of logical switches, which
+# partitioning hashes on
+NETWORK_ID_TAG = 'quantum_net_id'
+
+# added to state_sync_interval, the longest delay upstream's looping call
+# allows between runs, when paced: the delay before a sweep adds the
+# random delay to it, and chunks may be spaced further apart
+PACED_INTERVAL_PADDING = 1000
+
+
+class AkandaNsxSynchronizer(nsx_sync.NsxSynchronizer):
+    """
+    The NsxSynchronizer class in Neutron runs a synchronization thread to
+    sync nvp objects with neutron objects. Since we don't use nvp's routers
+    the sync was failing making neutron showing all the routers like if the
+    were in Error state. To fix this behaviour we override the two methods
+    responsible for the routers synchronization in the NsxSynchronizer class
+    to be a noop
+
+    With a full_sync_interval, the upstream full sweep only runs that often.
+    In between, every delta_sync_interval, only the networks and ports the
+    driver has recently created or updated (see `watch_network` and
+    `watch_port`) are fetched from NSX, and only those whose status changed
+    since they were last seen are synchronized.
+
+    With a partitioner, the full sweep is shared with the synchronizers of
+    other neutron-server processes: each one synchronizes the networks
+    that hash to it, and only fetches the logical ports of their switches
+    from NSX (see `_fetch_owned_nsx_data_chunk` and dhc_nsx.ml2.partition).
+
+    With a breaker, the outcome of every synchronization run is reported
+    to the circuit breaker shared with the mechanism driver, so that the
+    driver stops calling NSX during an outage the synchronizer noticed
+    first, and closes it again once the synchronizer reaches NSX.
+
+    Status changes found while synchronizing a chunk are not written one
+    ORM object at a time as upstream does, but gathered and applied with
+    one UPDATE ... WHERE id IN (...) per resource type and status (see
+    `_batched_status_updates`).
+
+    With a pacer, the size of the chunks of a full sweep and the delay
+    between them follow the measured NSX response times instead of being
+    fixed (see dhc_nsx.ml2.pacing); sweeps still start at most once every
+    state_sync_interval.
+
+    The NSX objects seen by the last sweep are kept in a CompactNsxCache
+    rather than as the decoded JSON upstream keeps.
+
+    With shared_watches, as in a sync worker process, the networks and
+    ports to watch are also taken from the dhcnsx_sync_watches table,
+    where the drivers of the API servers record them (see
+    dhc_nsx.ml2.worker).  progress, if given, is called after every
+    synchronization run, so that the worker's heartbeat stops when a run
+    hangs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # set before the upstream constructor starts the looping call
+        self._capacity_cache = kwargs.pop('capacity_cache', None)
+        self._full_sync_interval = kwargs.pop('full_sync_interval', 0)
+        self._delta_sync_interval = kwargs.pop('delta_sync_interval', 0)
+        self._watch_time = kwargs.pop('watch_time', 0)
+        self._last_full_sync = None
+        self._watched_networks = {}
+        self._watched_ports = {}
+        # watched ids that were not in neutron on the last delta sync
+        self._missed_watches = set()
+        # NSX uuid -> status last seen by a delta sync
+        self._status_markers = {}
+        self._partitioner = kwargs.pop('partitioner', None)
+        self._breaker = kwargs.pop('breaker', None)
+        self._pacer = kwargs.pop('pacer', None)
+        self._shared_watches = kwargs.pop('shared_watches', False)
+        self._progress = kwargs.pop('progress', None)
+        # whether a synchronization run is in progress
+        self.running = False
+        self._watch_table_created = False
+        self._sweep_started = None
+        self._chunk_delay = 0
+        # what fetching the current chunk raised, if anything
+        self._chunk_error = None
+        self._ring_changed = False
+        self._skip_unowned = False
+        # (NSX uuid, lport count) of the owned switches whose logical ports
+        # the current sweep has yet to fetch, and the page to fetch next
+        self._pending_lswitches = []
+        self._lport_cursor = None
+        # number of objects the current partitioned sweep should fetch
+        self._sweep_size = 0
+        # (model, status) -> [resource id] while a batch is open
+        self._status_updates = None
+        if self._partitioner:
+            self._heartbeat_call = loopingcall.FixedIntervalLoopingCall(
+                self._heartbeat
+            )
+            self._heartbeat_call.start(
+                max(self._partitioner.lease_time / 3, 1)
+            )
+        if self._pacer:
+            args = list(args)
+            sync_interval = args[2]
+            args[2] = sync_interval + PACED_INTERVAL_PADDING
+        nsx_sync.NsxSynchronizer.__init__(self, *args, **kwargs)
+        # the looping call started above has not run yet
+        if self._pacer:
+            # only its cap is padded
+            self._sync_interval = sync_interval
+        self._nsx_cache = cache.CompactNsxCache()
+
+    @property
+    def delta_sync_enabled(self):
+        return bool(self._full_sync_interval)
+
+    def watch_network(self, network_id, session=None):
+        # session is for the worker.WatchForwarder standing in for us
+        if self.delta_sync_enabled:
+            expiry = time.time() + self._watch_time
+            self._watched_networks[network_id] = expiry
+
+    def watch_port(self, port_id, session=None):
+        if self.delta_sync_enabled:
+            expiry = time.time() + self._watch_time
+            self._watched_ports[port_id] = expiry
+
+    def _synchronize_state(self, sp):
+        """
+        Given the complexicity of the NSX synchronization process, there are
+        about a million ways for it to go wrong. (MySQL connection issues,
+        transactional race conditions, etc...)  In the event that an exception
+        is thrown, behavior of the upstream implementation is to immediately
+        report the exception and kill the synchronizer thread.
+
+        This makes it very difficult to detect failure (because the thread just
+        ends) and the problem can only be fixed by completely restarting
+        neutron.
+
+        This implementation changes the behavior to repeatedly fail (and retry)
+        and log verbosely during failure so that the failure is more obvious
+        (and so that auto-recovery is a possibility if e.g., the database
+        comes back to life or a network-related issue becomes resolved).
+        """
+        self.running = True
+        try:
+            return self._synchronize_run(sp)
+        finally:
+            self.running = False
+            if self._progress:
+                try:
+                    self._progress()
+                except Exception:
+                    LOG.exception("Unable to report synchronization "
+                                  "progress")
+
+    def _synchronize_run(self, sp):
+        """Run a delta sync, or the next chunk of a full sweep."""
+        if self._ring_changed:
+            self._ring_changed = False
+            self._drop_unowned_from_cache()
+
+        # a full sweep spans several chunks; never interrupt one
+        if (self.delta_sync_enabled and sp.current_chunk == 0 and
+                self._last_full_sync is not None and
+                time.time() - self._last_full_sync <
+                self._full_sync_interval):
+            try:
+                self._synchronize_delta(sp.chunk_size)
+            except dhcnsx_breaker.BACKEND_FAILURES:
+                self._record_backend_failure()
+                LOG.exception("An error occurred during delta "
+                              "synchronization with the NSX backend")
+            except:
+                LOG.exception("An error occurred during delta "
+                              "synchronization with the NSX backend")
+            else:
+                self._record_backend_success()
+            return self._delta_sync_interval
+
+        self._chunk_error = None
+        try:
+            interval = nsx_sync.NsxSynchronizer._synchronize_state(self, sp)
+        except:
+            backoff = self._sync_backoff
+            LOG.exception("An error occurred while communicating with "
+                          "NSX backend. Will retry synchronization "
+                          "in %d seconds" % backoff)
+            self._sync_backoff = min(backoff * 2, 64)
+            return backoff
+
+        if self._chunk_error is not None:
+            # upstream handled the NSX error itself, raising the backoff;
+            # only an unreachable NSX counts against the breaker, not one
+            # rejecting a request
+            if isinstance(self._chunk_error,
+                          dhcnsx_breaker.BACKEND_FAILURES):
+                self._record_backend_failure()
+            return interval
+        self._record_backend_success()
+        self._sync_backoff = 1
+        if self._pacer:
+            interval = self._paced_interval(sp)
+        if sp.current_chunk == 0:
+            self._last_full_sync = time.time()
+            self._status_markers.clear()
+        return interval
+
+    def _paced_interval(self, sp):
+        """Return the delay before the next chunk, as paced."""
+        interval = self._chunk_delay
+        if sp.current_chunk == 0:
+            # the sweep is complete; start the next one state_sync_interval
+            # after this one started, as upstream does
+            elapsed = time.time() - self._sweep_started
+            interval = max(interval, self._sync_interval - elapsed)
+            interval += random.randint(0, self._max_rand_delay)
+        return interval
+
+    def _record_backend_success(self):
+        if self._breaker:
+            self._breaker.record_success()
+
+    def _record_backend_failure(self):
+        if self._breaker:
+            self._breaker.record_failure()
+
+    def _heartbeat(self):
+        try:
+            ctx = n_context.get_admin_context()
+            if self._partitioner.heartbeat(ctx.session):
+                self._ring_changed = True
+        except Exception:
+            # keep the looping call alive; if the lease expires meanwhile
+            # the other members simply take over our share
+            LOG.exception("Unable to renew the NSX synchronization lease")
+
+    def _owns(self, neutron_id):
+        return not self._partitioner or self._partitioner.owns(neutron_id)
+
+    def _owns_lswitch(self, lswitch):
+        tags = self._get_tag_dict(lswitch.get('tags', []))
+        return self._owns(tags.get(NETWORK_ID_TAG) or lswitch['uuid'])
+
+    def _drop_unowned_from_cache(self):
+        """Forget cached objects that now belong to another member.
+
+        Otherwise they would be taken for objects deleted from NSX at the
+        end of the next sweep.  The cache does not know the switch of a
+        logical port, so every port is forgotten; the next sweep fetches
+        those of the switches still owned again.
+        """
+        self._nsx_cache.forget(
+            lambda resource, nsx_uuid, neutron_id: (
+                resource == 'lport' or
+                resource == 'lswitch' and
+                not self._owns(neutron_id or nsx_uuid)
+            )
+        )
+
+    def cache_memory(self):
+        """Return the memory used by the NSX object cache per resource."""
+        return self._nsx_cache.memory_stats()
+
+    def _get_chunk_size(self, sp):
+        if self._pacer:
+            return self._pacer.chunk_size
+        return nsx_sync.NsxSynchronizer._get_chunk_size(self, sp)
+
+    def _fetch_nsx_data_chunk(self, sp):
+        if sp.current_chunk == 0:
+            self._sweep_started = time.time()
+            if self._pacer:
+                sp.chunk_size = self._pacer.start_sweep()
+        started = time.time()
+        try:
+            if self._partitioner:
+                lswitches, lrouters, lswitchports = (
+                    self._fetch_owned_nsx_data_chunk(sp)
+                )
+            else:
+                lswitches, lrouters, lswitchports = (
+                    nsx_sync.NsxSynchronizer._fetch_nsx_data_chunk(self, sp)
+                )
+        except Exception as e:
+            self._chunk_error = e
+            if self._pacer:
+                self._pacer.chunk_failed()
+            raise
+        if self._pacer:
+            self._chunk_delay = self._pacer.chunk_fetched(
+                time.time() - started,
+                len(lswitches) + len(lrouters) + len(lswitchports)
+            )
+        return lswitches, lrouters, lswitchports
+
+    def _fetch_owned_nsx_data_chunk(self, sp):
+        """Fetch the next chunk of the NSX objects this member owns.
+
+        The logical ports are the bulk of a sweep, so their listing is
+        split between the members by switch: every member lists the
+        logical switches when a sweep starts, then only fetches the ports
+        of the switches it owns, one switch after the other.  Logical
+        routers are not synchronized, so they are not fetched.
+
+        The sweep ends with the chunk that fetches the last of these
+        ports; until then sp.total_size counts the ports left, as their
+        switches report them, so that upstream keeps going.
+        """
+        lswitches = []
+        if sp.current_chunk == 0:
+            cursor = 'start'
+            while cursor:
+                page, cursor, total = self._fetch_data(
+                    self.LS_URI, cursor, nsx_sync.MAX_PAGE_SIZE
+                )
+                lswitches.extend(ls for ls in page if self._owns_lswitch(ls))
+            pending = [
+                (ls['uuid'],
+                 ls['_relations']['LogicalSwitchStatus']['lport_count'])
+                for ls in lswitches
+            ]
+            self._sweep_size = len(pending) + sum(
+                lport_count for ls_uuid, lport_count in pending
+            )
+            lport_cursor = 'start'
+        else:
+            pending = list(self._pending_lswitches)
+            lport_cursor = self._lport_cursor
+        sp.total_size = self._sweep_size
+        sp.chunk_size = self._get_chunk_size(sp)
+        sp.extra_chunk_size = 0
+
+        lswitchports = []
+        while pending and len(lswitchports) < sp.chunk_size:
+            uri = nsxlib._build_uri_path(
+                switchlib.LSWITCHPORT_RESOURCE,
+                parent_resource_id=pending[0][0],
+                fields='uuid,tags,fabric_status_up',
+                relations='LogicalPortStatus'
+            )
+            try:
+                page, lport_cursor, total = self._fetch_data(
+                    uri, lport_cursor, sp.chunk_size - len(lswitchports)
+                )
+            except n_exc.NotFound:
+                # deleted since the switches were listed
+                lport_cursor = None
+                page = []
+            lswitchports.extend(page)
+            if not lport_cursor:
+                pending.pop(0)
+                lport_cursor = 'start'
+        # kept only once every request succeeded, so that a failed chunk
+        # is fetched again in full
+        self._pending_lswitches = pending
+        self._lport_cursor = lport_cursor
+
+        remaining = 0
+        if pending:
+            remaining = max(
+                sum(lport_count for ls_uuid, lport_count in pending), 1
+            )
+        sp.total_size = sp.chunk_size * (sp.current_chunk + 1) + remaining
+        LOG.debug("Fetched %(lswitches)d owned logical switches and "
+                  "%(lports)d of their logical ports; %(pending)d switches "
+                  "left", {'lswitches': len(lswitches),
+                           'lports': len(lswitchports),
+                           'pending': len(pending)})
+        return lswitches, [], lswitchports
+
+    def _synchronize_lswitches(self, ctx, ls_uuids, scan_missing=False):
+        # the initial scan walks every neutron network; only handle ours
+        self._skip_unowned = scan_missing
+        try:
+            with self._batched_status_updates(ctx):
+                return nsx_sync.NsxSynchronizer._synchronize_lswitches(
+                    self, ctx, ls_uuids, scan_missing=scan_missing
+                )
+        finally:
+            self._skip_unowned = False
+
+    def _synchronize_lswitchports(self, ctx, lp_uuids, scan_missing=False):
+        # the initial scan walks every neutron port; only handle ours
+        self._skip_unowned = scan_missing
+        try:
+            with self._batched_status_updates(ctx):
+                return nsx_sync.NsxSynchronizer._synchronize_lswitchports(
+                    self, ctx, lp_uuids, scan_missing=scan_missing
+                )
+        finally:
+            self._skip_unowned = False
+
+    @contextlib.contextmanager
+    def _batched_status_updates(self, ctx):
+        """Gather the status changes of the enclosed block, then write them.
+
+        Inside the block, synchronize_network and synchronize_port queue
+        the new status of the resources whose NSX objects were passed in
+        instead of updating them; they are written when the block exits
+        without an error.
+        """
+        self._status_updates = collections.defaultdict(list)
+        try:
+            yield
+            updates, self._status_updates = self._status_updates, None
+            self._write_status_updates(ctx, updates)
+        finally:
+            self._status_updates = None
+
+    def _write_status_updates(self, ctx, updates):
+        if not updates:
+            return
+        started = time.time()
+        resources = rows = statements = 0
+        with ctx.session.begin(subtransactions=True):
+            for (model, status), resource_ids in updates.items():
+                updated, issued = dhcnsx_db.update_status(
+                    ctx.session, model, status, resource_ids
+                )
+                resources += len(resource_ids)
+                rows += updated
+                statements += issued
+        LOG.debug("Wrote the status of %(resources)d resources "
+                  "(%(rows)d rows) in %(statements)d statements and "
+                  "%(elapsed).3f seconds",
+                  {'resources': resources, 'rows': rows,
+                   'statements': statements,
+                   'elapsed': time.time() - started})
+
+    def _watched_ids(self, watched, limit):
+        """Return up to limit watched ids, dropping expired ones."""
+        now = time.time()
+        for resource_id, expiry in watched.items():
+            if expiry < now:
+                del watched[resource_id]
+                self._missed_watches.discard(resource_id)
+        return sorted(watched, key=watched.get)[:limit]
+
+    def _unwatch_missing(self, watched, resource_ids, resources):
+        """Stop watching resources that were deleted from neutron.
+
+        Resources are watched from the driver's precommit, so one may not
+        be visible yet because its transaction has not committed: only
+        those missing on two delta syncs in a row are dropped.
+        """
+        found = set(r['id'] for r in resources)
+        for resource_id in resource_ids:
+            if resource_id in found:
+                self._missed_watches.discard(resource_id)
+            elif resource_id in self._missed_watches:
+                self._missed_watches.discard(resource_id)
+                watched.pop(resource_id, None)
+            else:
+                self._missed_watches.add(resource_id)
+
+    def _status_changed(self, nsx_uuid, status):
+        changed = self._status_markers.get(nsx_uuid) != status
+        self._status_markers[nsx_uuid] = status
+        return changed
+
+    def _collect_watches(self, session):
+        """Take over the watches recorded in dhcnsx_sync_watches.
+
+        Rows for resources of other partition members are left to them,
+        unless they expired.  Ports belong to the member owning their
+        network; those not visible in neutron yet are left for later.
+        """
+        if not self._watch_table_created:
+            models.create_table(session, models.SyncWatch)
+            self._watch_table_created = True
+
+        watched = {
+            'network': self._watched_networks,
+            'port': self._watched_ports,
+        }
+        now = timeutils.utcnow()
+        taken = []
+        with session.begin(subtransactions=True):
+            watches = session.query(models.SyncWatch).all()
+            port_networks = dhcnsx_db.get_port_network_ids(session, [
+                watch.resource_id for watch in watches
+                if watch.resource_type == 'port' and watch.expires_at >= now
+            ])
+            for watch in watches:
+                key = watch.resource_id
+                if watch.resource_type == 'port':
+                    key = port_networks.get(watch.resource_id)
+                if watch.expires_at < now:
+                    taken.append(watch.resource_id)
+                elif key and self._owns(key):
+                    watched[watch.resource_type][watch.resource_id] = (
+                        calendar.timegm(watch.expires_at.utctimetuple())
+                    )
+                    taken.append(watch.resource_id)
+            for index in range(0, len(taken), dhcnsx_db.MAX_IN_IDS):
+                session.query(models.SyncWatch).filter(
+                    models.SyncWatch.resource_id.in_(
+                        taken[index:index + dhcnsx_db.MAX_IN_IDS]
+                    )
+                ).delete(synchronize_session=False)
+
+    def _synchronize_delta(self, limit):
+        ctx = n_context.get_admin_context()
+        if self._shared_watches:
+            self._collect_watches(ctx.session)
+        with self._batched_status_updates(ctx):
+            networks, ports = self._synchronize_watched(ctx, limit)
+
+        LOG.debug("Delta synchronization checked %(networks)d networks "
+                  "and %(ports)d ports",
+                  {'networks': len(networks), 'ports': len(ports)})
+
+    def _synchronize_watched(self, ctx, limit):
+        network_ids = self._watched_ids(self._watched_networks, limit)
+        switch_ids = dhcnsx_db.get_nsx_switch_ids(ctx.session, network_ids)
+        networks = self._plugin._get_collection(
+            ctx, models_v2.Network, self._plugin._make_network_dict,
+            filters={'id': network_ids}) if network_ids else []
+        self._unwatch_missing(self._watched_networks, network_ids, networks)
+        for network in networks:
+            try:
+                lswitches = [
+                    switchlib.get_lswitch_by_id(self._cluster, ls_uuid)
+                    for ls_uuid in switch_ids.get(network['id'], [])
+                ]
+            except n_exc.NotFound:
+                lswitches = []
+            fabric_status = tuple(
+                ls['_relations']['LogicalSwitchStatus']['fabric_status']
+                for ls in lswitches
+            )
+            if self._status_changed(network['id'], fabric_status):
+                self.synchronize_network(ctx, network, lswitches or None)
+            if lswitches and all(fabric_status):
+                self._watched_networks.pop(network['id'], None)
+                self._status_markers.pop(network['id'], None)
+
+        port_ids = self._watched_ids(self._watched_ports, limit)
+        port_mappings = dhcnsx_db.get_nsx_switch_and_port_ids(
+            ctx.session, port_ids
+        )
+        ports = self._plugin._get_collection(
+            ctx, models_v2.Port, self._plugin._make_port_dict,
+            filters={'id': port_ids}) if port_ids else []
+        self._unwatch_missing(self._watched_ports, port_ids, ports)
+        ext_networks = []
+        if ports:
+            ext_networks = [net['id'] for net in ctx.session.query(
+                models_v2.Network).join(
+                    external_net_db.ExternalNetwork,
+                    (models_v2.Network.id ==
+                     external_net_db.ExternalNetwork.network_id))]
+        for port in ports:
+            ls_uuid, lp_uuid = port_mappings.get(port['id'], (None, None))
+            if not lp_uuid:
+                # not created on NSX yet
+                continue
+            try:
+                lport = switchlib.get_port(
+                    self._cluster, ls_uuid, lp_uuid,
+                    relations='LogicalPortStatus'
+                )
+            except n_exc.NotFound:
+                lport = None
+            link_status_up = lport and (
+                lport['_relations']['LogicalPortStatus']['link_status_up']
+            )
+            if self._status_changed(lp_uuid, link_status_up):
+                self.synchronize_port(
+                    ctx, port, lport, ext_networks=ext_networks
+                )
+            if link_status_up:
+                self._watched_ports.pop(port['id'], None)
+                self._status_markers.pop(lp_uuid, None)
+        return networks, ports
+
+    def synchronize_network(self, context, neutron_network_data,
+                            lswitches=None):
+        """
+        Refresh the driver's logical switch capacity cache from the
+        LogicalSwitchStatus relations fetched during the sweep before
+        handing over to the upstream status synchronization.
+        """
+        if self._skip_unowned and not self._owns(neutron_network_data['id']):
+            return
+        if self._capacity_cache is not None:
+            for ls in lswitches or []:
+                if not ls:
+                    # a switch was removed from NSX; forget the network
+                    self._capacity_cache.invalidate(
+                        neutron_network_data['id'])
+                    break
+                self._capacity_cache.update_switch(
+                    neutron_network_data['id'],
+                    ls['uuid'],
+                    ls['_relations']['LogicalSwitchStatus']['lport_count']
+                )
+        if self._status_updates is None or not lswitches:
+            # without switches upstream fetches them from NSX first
+            return nsx_sync.NsxSynchronizer.synchronize_network(
+                self, context, neutron_network_data, lswitches
+            )
+
+        # the status upstream would set
+        status = constants.NET_STATUS_ACTIVE
+        for ls in lswitches:
+            if not ls:
+                # a switch was removed from NSX
+                status = constants.NET_STATUS_ERROR
+                break
+            if not ls['_relations']['LogicalSwitchStatus']['fabric_status']:
+                status = constants.NET_STATUS_DOWN
+                break
+        if status != neutron_network_data['status']:
+            self._status_updates[(models_v2.Network, status)].append(
+                neutron_network_data['id']
+            )
+
+    def synchronize_port(self, context, neutron_port_data, lswitchport=None,
+                         ext_networks=None):
+        if (self._skip_unowned and
+                not self._owns(neutron_port_data['network_id'])):
+            return
+        if (self._status_updates is None or not lswitchport or
+                ext_networks is None or
+                neutron_port_data['network_id'] in ext_networks):
+            # upstream fetches a missing port from NSX first, and leaves
+            # ports on external networks alone
+            return nsx_sync.NsxSynchronizer.synchronize_port(
+                self, context, neutron_port_data, lswitchport, ext_networks
+            )
+
+        # the status upstream would set
+        if lswitchport['_relations']['LogicalPortStatus']['link_status_up']:
+            status = constants.PORT_STATUS_ACTIVE
+        else:
+            status = constants.PORT_STATUS_DOWN
+        if status != neutron_port_data['status']:
+            self._status_updates[(models_v2.Port, status)].append(
+                neutron_port_data['id']
+            )
+
+    def _synchronize_lrouters(self, *args, **kwargs):
+        pass
+
+    def synchronize_router(self, *args, **kwargs):
+        pass
+
+
+def create_synchronizer(plugin, cluster, metrics, breaker=None,
+                        capacity_cache=None, shared_watches=False,
+                        progress=None):
+    """Return an AkandaNsxSynchronizer set up from the configuration.
+
+    Its looping call is started; the stats of its pacer and NSX object
+    cache are added to metrics.
+    """
+    nsx_sync_opts = cfg.CONF.NSX_SYNC
+    dhcnsx_opts = cfg.CONF.dhcnsx
+
+    partitioner = None
+    if dhcnsx_opts.sync_partitioning:
+        partitioner = partition.SyncPartitioner(dhcnsx_opts.sync_lease_time)
+
+    pacer = None
+    if dhcnsx_opts.adaptive_sync_pacing:
+        pacer = pacing.SyncPacer(
+            nsx_sync_opts.min_chunk_size,
+            dhcnsx_opts.sync_max_chunk_size,
+            nsx_sync_opts.min_sync_req_delay,
+            dhcnsx_opts.sync_capacity_fraction
+        )
+        metrics.add_source('sync_pacing', pacer.stats)
+
+    synchronizer = AkandaNsxSynchronizer(
+        plugin,
+        cluster,
+        nsx_sync_opts.state_sync_interval,
+        nsx_sync_opts.min_sync_req_delay,
+        nsx_sync_opts.min_chunk_size,
+        nsx_sync_opts.max_random_sync_delay,
+        capacity_cache=capacity_cache,
+        full_sync_interval=dhcnsx_opts.full_sync_interval,
+        delta_sync_interval=dhcnsx_opts.delta_sync_interval,
+        watch_time=dhcnsx_opts.delta_sync_watch_time,
+        partitioner=partitioner,
+        breaker=breaker,
+        pacer=pacer,
+        shared_watches=shared_watches,
+        progress=progress
+    )
+    metrics.add_source('sync_cache', synchronizer.cache_memory)
+    return synchronizer
@@ -0,0 +1,290 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""NSX state synchronization in a worker process
+
+Decoding NSX sweeps and writing their statuses blocks the eventlet hub of
+the process doing it, so with sync_worker set the synchronizer runs in a
+dhcnsx-sync process of its own (see dhc_nsx.cmd.sync) instead of in the
+API server:
+
+- the worker writes its pid and the time to a heartbeat file after every
+  synchronization run, and every sync_worker_heartbeat_interval seconds
+  while it waits for the next one;
+- `SyncWorkerSupervisor`, run by dhcnsx-sync, starts the worker and
+  restarts it when it exits or its heartbeat gets older than
+  sync_worker_heartbeat_timeout;
+- with sync_worker = spawn, the mechanism driver starts dhcnsx-sync
+  itself, and only restarts it when it exits: neutron-server reaps the
+  children of its parent process, which would hide the exit status of the
+  worker from a supervisor running there;
+- `WatchForwarder` takes the synchronizer's place in the driver and hands
+  the networks and ports to watch to the worker through the
+  dhcnsx_sync_watches table.
+"""
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+from oslo.db import exception as db_exc
+
+from neutron.openstack.common import log
+from neutron.openstack.common import timeutils
+
+from dhc_nsx.ml2 import models
+
+
+LOG = log.getLogger(__name__)
+
+# longest delay, in seconds, before restarting a worker that keeps failing
+MAX_RESTART_BACKOFF = 64
+
+# seconds a worker is given to exit after SIGTERM before it is killed
+STOP_TIMEOUT = 10
+
+
+def worker_command(conf, parent_pid=None, run_worker=True):
+    """Return the command line running a sync worker with conf's files.
+
+    Without run_worker, the command runs dhcnsx-sync, supervising a worker.
+    """
+    command = [sys.executable, '-m', 'dhc_nsx.cmd.sync']
+    if run_worker:
+        command.append('--run-worker')
+    if parent_pid:
+        command.extend(['--parent-pid', str(parent_pid)])
+    for config_file in conf.config_file:
+        command.extend(['--config-file', config_file])
+    if conf.config_dir:
+        command.extend(['--config-dir', conf.config_dir])
+    return command
+
+
+def read_heartbeat(path):
+    """Return the last heartbeat written to path, or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Heartbeat(object):
+    """Tells the supervisor that this worker is alive"""
+
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+
+    def beat(self):
+        # replaced atomically, so that readers never see a partial file
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump({
+                'pid': os.getpid(),
+                'timestamp': time.time(),
+                'started_at': self.started_at,
+            }, f)
+        os.rename(tmp, self.path)
+
+
+class SyncWorkerSupervisor(object):
+    """Keeps one sync worker process running.
+
+    `check` must be called periodically.  Neutron forks its API workers
+    after the driver is initialized; only the process that created the
+    supervisor manages the worker, so that it is never started twice.
+
+    Without a heartbeat_timeout, the process is only restarted when it
+    exits.  name is what it is called in the logs.
+    """
+
+    def __init__(self, command, heartbeat_file, heartbeat_timeout,
+                 name='NSX sync worker'):
+        self.command = command
+        self.name = name
+        self.heartbeat_file = heartbeat_file
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restarts = 0
+        self._owner_pid = os.getpid()
+        self._process = None
+        self._started_at = None
+        self._backoff = 1
+        self._restart_at = 0
+
+    def _owner(self):
+        return os.getpid() == self._owner_pid
+
+    def _last_heartbeat(self):
+        """Return the time of the running worker's last heartbeat."""
+        heartbeat = read_heartbeat(self.heartbeat_file)
+        if heartbeat and heartbeat.get('pid') == self._process.pid:
+            return heartbeat['timestamp']
+        return None
+
+    def _start(self):
+        self._process = subprocess.Popen(self.command, close_fds=True)
+        self._started_at = time.time()
+        LOG.info("Started %(name)s %(pid)d",
+                 {'name': self.name, 'pid': self._process.pid})
+
+    def _stop(self):
+        process, self._process = self._process, None
+        if process.poll() is not None:
+            return
+        process.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            LOG.warning("%(name)s %(pid)d did not exit after %(timeout)d "
+                        "seconds; killing it",
+                        {'name': self.name, 'pid': process.pid,
+                         'timeout': STOP_TIMEOUT})
+            process.kill()
+            process.wait()
+
+    def check(self):
+        """Start the worker, or restart it if it died or hangs."""
+        if not self._owner():
+            return
+        now = time.time()
+        if self._process is not None:
+            returncode = self._process.poll()
+            if returncode is None and self.heartbeat_timeout is None:
+                if now - self._started_at > MAX_RESTART_BACKOFF:
+                    self._backoff = 1
+                return
+            if returncode is None:
+                heartbeat = self._last_heartbeat()
+                if now - (heartbeat or self._started_at) <= (
+                        self.heartbeat_timeout):
+                    if heartbeat and heartbeat - self._started_at > (
+                            self.heartbeat_timeout):
+                        # it stayed up; forget earlier failures
+                        self._backoff = 1
+                    return
+                LOG.error("%(name)s %(pid)d sent no heartbeat for "
+                          "%(timeout)d seconds; restarting it in "
+                          "%(backoff)d seconds",
+                          {'name': self.name, 'pid': self._process.pid,
+                           'timeout': self.heartbeat_timeout,
+                           'backoff': self._backoff})
+                self._stop()
+            else:
+                LOG.error("%(name)s %(pid)d exited with status "
+                          "%(status)d; restarting it in %(backoff)d seconds",
+                          {'name': self.name, 'pid': self._process.pid,
+                           'status': returncode, 'backoff': self._backoff})
+                self._process = None
+            self._restart_at = now + self._backoff
+            self._backoff = min(self._backoff * 2, MAX_RESTART_BACKOFF)
+            self.restarts += 1
+        if now >= self._restart_at:
+            self._start()
+
+    def stop(self):
+        if self._owner() and self._process is not None:
+            LOG.info("Stopping %(name)s %(pid)d",
+                     {'name': self.name, 'pid': self._process.pid})
+            self._stop()
+
+    def stats(self):
+        # whichever worker wrote it, with a supervisor in between
+        heartbeat = read_heartbeat(self.heartbeat_file)
+        return {'worker': {
+            'running': int(self._process is not None),
+            'restarts': self.restarts,
+            'heartbeat_age': (heartbeat and
+                              time.time() - heartbeat['timestamp']),
+        }}
+
+
+class WatchForwarder(object):
+    """Stands in for the synchronizer in a driver whose sync is a worker.
+
+    watch_network and watch_port record the resource in the
+    dhcnsx_sync_watches table as part of the driver's transaction, so the
+    worker never sees a watch for a resource that was rolled back.
+    Without delta synchronization (full_sync_interval unset) nothing is
+    watched.
+    """
+
+    def __init__(self, full_sync_interval, watch_time):
+        self.delta_sync_enabled = bool(full_sync_interval)
+        self._watch_time = watch_time
+        self._table_created = False
+
+    def watch_network(self, network_id, session):
+        self._watch(session, 'network', network_id)
+
+    def watch_port(self, port_id, session):
+        self._watch(session, 'port', port_id)
+
+    def _watch(self, session, resource_type, resource_id):
+        if not self.delta_sync_enabled:
+            return
+        if not self._table_created:
+            models.create_table(session, models.SyncWatch)
+            self._table_created = True
+
+        expires_at = timeutils.utcnow() + datetime.timedelta(
+            seconds=self._watch_time
+        )
+        with session.begin(subtransactions=True):
+            try:
+                # a savepoint, so that a duplicate leaves the driver's
+                # transaction usable
+                with session.begin_nested():
+                    renewed = session.query(models.SyncWatch).filter_by(
+                        resource_id=resource_id
+                    ).update({'expires_at': expires_at})
+                    if not renewed:
+                        session.add(models.SyncWatch(
+                            resource_id=resource_id,
+                            resource_type=resource_type,
+                            expires_at=expires_at
+                        ))
+            except db_exc.DBDuplicateEntry:
+                # another API worker watched it at the same time
+                pass
+
+
+def create_supervisor(conf):
+    """Return a supervisor running dhcnsx-sync workers as configured."""
+    return SyncWorkerSupervisor(
+        worker_command(conf, parent_pid=os.getpid()),
+        conf.dhcnsx.sync_worker_heartbeat_file,
+        conf.dhcnsx.sync_worker_heartbeat_timeout
+    )
+
+
+def create_launcher(conf):
+    """Return a supervisor keeping dhcnsx-sync itself running.
+
+    dhcnsx-sync supervises its worker with heartbeats; this one only
+    restarts dhcnsx-sync when it exits.
+    """
+    return SyncWorkerSupervisor(
+        worker_command(conf, parent_pid=os.getpid(), run_worker=False),
+        conf.dhcnsx.sync_worker_heartbeat_file,
+        None,
+        name='dhcnsx-sync'
+    )
+
@@ -0,0 +1,107 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+
+import eventlet
+from eventlet import event
+
+from neutron.openstack.common import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class OrderedWorkQueue(object):
+    """A bounded pool of greenthreads with per-key ordering.
+
+    Work submitted under the same key runs one item at a time, in
+    submission order; work for different keys runs concurrently on up to
+    ``size`` greenthreads.  Submitting blocks while every greenthread is
+    busy, which pushes back on the API workers instead of queueing
+    without limit.
+
+    Work that raises is logged, and the work queued after it still runs;
+    callers record failures in their own work.
+    """
+
+    def __init__(self, size):
+        self._pool = eventlet.GreenPool(size)
+        self._pending = {}
+        # sent once no key has work left; GreenPool.waitall can miss the
+        # end of work spawned while it waits
+        self._idle = event.Event()
+        self._idle.send()
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Run func after all work previously submitted for key."""
+        self._enqueue(key, None, (func, args, kwargs))
+
+    def submit_after(self, parent, key, func, *args, **kwargs):
+        """Run func after the work queued for both key and parent.
+
+        Used for work on a child resource (a port) that must not start
+        before outstanding work on its parent (the network) has finished.
+        """
+        self._enqueue(key, parent, (func, args, kwargs))
+
+    def _enqueue(self, key, parent, task):
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append(task)
+                return
+            if not self._pending:
+                self._idle = event.Event()
+            self._pending[key] = collections.deque([task])
+            if parent in self._pending:
+                # the parent's greenthread starts draining this key once
+                # the work queued ahead of it has completed
+                self._pending[parent].append((self._release, (key,), {}))
+                return
+        self._pool.spawn_n(self._drain, key)
+
+    def _release(self, key):
+        # the key gets a greenthread of its own; waiting for one to free
+        # up must not hold up the parent's, which may be the last one
+        eventlet.spawn_n(self._pool.spawn_n, self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._pending[key]
+                if not queue:
+                    del self._pending[key]
+                    if not self._pending:
+                        self._idle.send()
+                    return
+                func, args, kwargs = queue.popleft()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                LOG.exception("Queued NSX backend work for %s failed", key)
+
+    def pending(self):
+        """Return the number of keys with queued or running work."""
+        return len(self._pending)
+
+    def waitall(self):
+        """Wait until the work submitted so far has run.
+
+        Keys released by their parent count as pending until drained, so
+        this also covers them.
+        """
+        self._idle.wait()
@@ -0,0 +1,152 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from neutron.plugins.vmware.api_client import exception as api_exc
+
+from dhc_nsx.ml2 import breaker
+
+
+class TestCircuitBreaker(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(breaker.time, 'time',
+                                    side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = breaker.CircuitBreaker(3, 30, probes=2)
+
+    def _open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+
+    def _half_open(self):
+        self._open()
+        self.now += 30
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.assertFalse(self.breaker.before_call())
+        self.breaker.record_failure()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_open_rejects_calls(self):
+        self._open()
+        self.now += 10
+        self.assertRaises(breaker.BackendUnavailable,
+                          self.breaker.before_call)
+        self.assertRaises(breaker.BackendUnavailable,
+                          self.breaker.before_call)
+        self.assertEqual(2, self.breaker.rejected)
+
+    def test_half_open_after_reset_timeout(self):
+        self._open()
+        self.now += 29
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.now += 1
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+
+    def test_half_open_admits_limited_probes(self):
+        self._half_open()
+        self.assertTrue(self.breaker.before_call())
+        self.assertTrue(self.breaker.before_call())
+        self.assertRaises(breaker.BackendUnavailable,
+                          self.breaker.before_call)
+
+    def test_released_probe_frees_its_slot(self):
+        self._half_open()
+        probe = self.breaker.before_call()
+        self.breaker.before_call()
+        self.breaker.release(probe)
+        self.assertTrue(self.breaker.before_call())
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+
+    def test_successful_probes_close(self):
+        self._half_open()
+        first = self.breaker.before_call()
+        second = self.breaker.before_call()
+        self.breaker.record_success(first)
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+        self.breaker.record_success(second)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.assertFalse(self.breaker.before_call())
+
+    def test_failed_probe_opens_again(self):
+        self._half_open()
+        self.breaker.record_failure(self.breaker.before_call())
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertRaises(breaker.BackendUnavailable,
+                          self.breaker.before_call)
+        # the reset timeout starts over
+        self.now += 30
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.before_call())
+
+    def test_successes_reported_while_open_count_as_probes(self):
+        self._open()
+        self.breaker.record_success()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.breaker.record_success()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_guard_counts_backend_failures(self):
+        for _ in range(3):
+            with testtools.ExpectedException(api_exc.RequestTimeout):
+                with self.breaker.guard():
+                    raise api_exc.RequestTimeout()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+
+    def test_guard_ignores_other_errors(self):
+        for _ in range(3):
+            with testtools.ExpectedException(ValueError):
+                with self.breaker.guard():
+                    raise ValueError()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_guard_releases_probe_on_other_errors(self):
+        self._half_open()
+        for _ in range(3):
+            with testtools.ExpectedException(ValueError):
+                with self.breaker.guard():
+                    raise ValueError()
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+        with self.breaker.guard():
+            pass
+        with self.breaker.guard():
+            pass
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_disabled_never_rejects(self):
+        disabled = breaker.CircuitBreaker(0, 30)
+        for _ in range(10):
+            disabled.record_failure()
+        self.assertFalse(disabled.before_call())
+        self.assertEqual(breaker.CLOSED, disabled.state)
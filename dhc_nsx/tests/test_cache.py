@@ -0,0 +1,161 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import testtools
+
+from dhc_nsx.ml2 import cache
+
+
+def _lswitch(uuid, net_id, status=True, lport_count=0):
+    return {
+        'uuid': uuid,
+        'display_name': 'a name the cache drops',
+        'tags': [{'scope': 'os_tid', 'tag': 'tenant'},
+                 {'scope': 'quantum_net_id', 'tag': net_id}],
+        '_relations': {'LogicalSwitchStatus': {
+            'fabric_status': status, 'lport_count': lport_count,
+        }},
+    }
+
+
+def _lport(uuid, port_id, status=True):
+    return {
+        'uuid': uuid,
+        'tags': [{'scope': 'q_port_id', 'tag': port_id}],
+        '_relations': {'LogicalPortStatus': {'link_status_up': status}},
+    }
+
+
+class TestCompactNsxCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCompactNsxCache, self).setUp()
+        self.cache = cache.CompactNsxCache()
+        self.cache.process_updates(
+            lswitches=[_lswitch('ls1', 'net1'), _lswitch('ls2', 'net2')],
+            lswitchports=[_lport('lp1', 'port1')]
+        )
+        self.cache.process_deletes()
+
+    def _sweep(self, lswitches, lswitchports=()):
+        # the ids changed or deleted by a full sweep
+        self.cache.process_updates(lswitches=lswitches,
+                                   lswitchports=list(lswitchports))
+        ls_ids, lr_ids, lp_ids = self.cache.process_deletes()
+        return sorted(ls_ids), sorted(lp_ids)
+
+    def test_new_objects_are_changed(self):
+        compact = cache.CompactNsxCache()
+        ls_ids, lr_ids, lp_ids = compact.process_updates(
+            lswitches=[_lswitch('ls1', 'net1')],
+            lswitchports=[_lport('lp1', 'port1')]
+        )
+        self.assertEqual(['ls1'], ls_ids)
+        self.assertEqual([], lr_ids)
+        self.assertEqual(['lp1'], lp_ids)
+
+    def test_unchanged_objects_are_not_changed(self):
+        self.assertEqual(
+            ([], []),
+            self._sweep([_lswitch('ls1', 'net1'), _lswitch('ls2', 'net2')],
+                        [_lport('lp1', 'port1')])
+        )
+
+    def test_status_change_is_detected(self):
+        self.assertEqual(
+            (['ls2'], ['lp1']),
+            self._sweep([_lswitch('ls1', 'net1'),
+                         _lswitch('ls2', 'net2', status=False)],
+                        [_lport('lp1', 'port1', status=False)])
+        )
+        self.assertFalse(self.cache['ls2']['data']['_relations']
+                         ['LogicalSwitchStatus']['fabric_status'])
+
+    def test_lport_count_change_is_detected(self):
+        self.assertEqual(
+            (['ls1'], []),
+            self._sweep([_lswitch('ls1', 'net1', lport_count=4),
+                         _lswitch('ls2', 'net2')],
+                        [_lport('lp1', 'port1')])
+        )
+        self.assertEqual(4, self.cache['ls1']['data']['_relations']
+                         ['LogicalSwitchStatus']['lport_count'])
+
+    def test_neutron_id_change_is_detected(self):
+        self.assertEqual(
+            (['ls1'], []),
+            self._sweep([_lswitch('ls1', 'net3'), _lswitch('ls2', 'net2')],
+                        [_lport('lp1', 'port1')])
+        )
+
+    def test_changed_flags_cleared_by_next_sweep(self):
+        self._sweep([_lswitch('ls1', 'net1', lport_count=4),
+                     _lswitch('ls2', 'net2')], [_lport('lp1', 'port1')])
+        self.assertEqual(['ls1'], self.cache.get_lswitches(changed_only=True))
+        self._sweep([_lswitch('ls1', 'net1', lport_count=4),
+                     _lswitch('ls2', 'net2')], [_lport('lp1', 'port1')])
+        self.assertEqual([], self.cache.get_lswitches(changed_only=True))
+
+    def test_missing_objects_are_deleted(self):
+        self.assertEqual((['ls2'], ['lp1']),
+                         self._sweep([_lswitch('ls1', 'net1')]))
+        item = self.cache['ls2']
+        self.assertIsNone(item['data'])
+        self.assertEqual('net2', item['data_bk']['tags'][0]['tag'])
+
+        # deleted objects are dropped by the following sweep
+        self.assertEqual(([], []), self._sweep([_lswitch('ls1', 'net1')]))
+        self.assertRaises(KeyError, self.cache.__getitem__, 'ls2')
+        self.assertEqual(['ls1'], self.cache.get_lswitches())
+
+    def test_deleted_object_coming_back_is_changed(self):
+        self._sweep([_lswitch('ls1', 'net1')], [_lport('lp1', 'port1')])
+        self.assertEqual(
+            (['ls2'], []),
+            self._sweep([_lswitch('ls1', 'net1'), _lswitch('ls2', 'net2')],
+                        [_lport('lp1', 'port1')])
+        )
+        self.assertIsNotNone(self.cache['ls2']['data'])
+
+    def test_item_rebuilds_nsx_object(self):
+        self.assertEqual(
+            {'data': {
+                'uuid': 'lp1',
+                'tags': [{'scope': 'q_port_id', 'tag': 'port1'}],
+                '_relations': {'LogicalPortStatus': {'link_status_up': True}},
+            }, 'data_bk': None},
+            self.cache['lp1']
+        )
+
+    def test_single_update_keeps_other_changes(self):
+        self._sweep([_lswitch('ls1', 'net1', lport_count=4),
+                     _lswitch('ls2', 'net2')], [_lport('lp1', 'port1')])
+        self.cache.update_lswitch(_lswitch('ls2', 'net2', status=False))
+        self.assertEqual(['ls1', 'ls2'],
+                         sorted(self.cache.get_lswitches(changed_only=True)))
+
+    def test_forget(self):
+        self.cache.forget(
+            lambda resource, nsx_uuid, neutron_id: neutron_id == 'net2'
+        )
+        self.assertEqual(['ls1'], self.cache.get_lswitches())
+        self.assertEqual(['lp1'], self.cache.get_lswitchports())
+
+    def test_memory_stats(self):
+        stats = self.cache.memory_stats()
+        self.assertEqual(2, stats['lswitch']['objects'])
+        self.assertEqual(1, stats['lport']['objects'])
+        self.assertEqual(0, stats['lrouter']['objects'])
+        self.assertTrue(stats['lswitch']['bytes_per_object'] > 0)
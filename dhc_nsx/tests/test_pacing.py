@@ -0,0 +1,126 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from neutron.plugins.vmware.common import sync as nsx_sync
+
+from dhc_nsx.ml2 import pacing
+from dhc_nsx.ml2 import sync
+
+
+class TestSyncPacer(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSyncPacer, self).setUp()
+        self.pacer = pacing.SyncPacer(100, 400, 1, 0.5)
+
+    def _sweep(self, elapsed=1.0, objects=100):
+        size = self.pacer.start_sweep()
+        self.pacer.chunk_fetched(elapsed, objects)
+        return size
+
+    def test_first_sweep_uses_min_chunk_size(self):
+        self.assertEqual(100, self.pacer.start_sweep())
+        self.assertEqual(100, self.pacer.start_sweep())
+
+    def test_clean_sweeps_grow_additively_up_to_max(self):
+        sizes = [self._sweep() for _ in range(6)]
+        self.assertEqual([100, 200, 300, 400, 400, 400], sizes)
+
+    def test_failed_chunk_halves_down_to_min(self):
+        for _ in range(4):
+            self._sweep()
+        self.assertEqual(400, self.pacer.chunk_size)
+        self.pacer.chunk_failed()
+        self.assertEqual(200, self.pacer.start_sweep())
+        self.pacer.chunk_failed()
+        self.assertEqual(100, self.pacer.start_sweep())
+        self.pacer.chunk_failed()
+        self.assertEqual(100, self.pacer.start_sweep())
+
+    def test_slow_chunk_halves(self):
+        for _ in range(4):
+            self._sweep()
+        self.pacer.chunk_fetched(3.0, 100)
+        self.assertEqual(200, self.pacer.start_sweep())
+
+    def test_latency_within_tolerance_keeps_growing(self):
+        self._sweep()
+        self.pacer.chunk_fetched(1.9, 100)
+        self.assertEqual(200, self.pacer.start_sweep())
+
+    def test_congestion_only_counts_for_one_sweep(self):
+        for _ in range(4):
+            self._sweep()
+        self.pacer.chunk_failed()
+        self.assertEqual(200, self._sweep())
+        self.assertEqual(300, self.pacer.start_sweep())
+
+    def test_delay_keeps_nsx_busy_for_capacity_fraction(self):
+        self.assertEqual(2.0, self.pacer.chunk_fetched(2.0, 100))
+        pacer = pacing.SyncPacer(100, 400, 1, 0.25)
+        self.assertEqual(6.0, pacer.chunk_fetched(2.0, 100))
+
+    def test_delay_at_least_min_delay(self):
+        pacer = pacing.SyncPacer(100, 400, 1, 1.0)
+        self.assertEqual(1, pacer.chunk_fetched(2.0, 100))
+        self.assertEqual(1, self.pacer.chunk_fetched(0.1, 100))
+
+    def test_limits_are_sane(self):
+        pacer = pacing.SyncPacer(100, 50, 1, 0)
+        self.assertEqual(100, pacer.max_chunk_size)
+        self.assertEqual(0.01, pacer.capacity_fraction)
+
+
+class TestPacedSynchronizer(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPacedSynchronizer, self).setUp()
+        patcher = mock.patch.object(nsx_sync, '_start_loopingcall')
+        self.start_loopingcall = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.synchronizer = sync.AkandaNsxSynchronizer(
+            mock.Mock(), mock.Mock(), 120, 1, 50, 5,
+            pacer=pacing.SyncPacer(50, 500, 1, 0.5)
+        )
+
+    def test_looping_call_cap_is_padded(self):
+        self.start_loopingcall.assert_called_once_with(
+            50, 120 + sync.PACED_INTERVAL_PADDING,
+            self.synchronizer._synchronize_state
+        )
+        self.assertEqual(120, self.synchronizer._sync_interval)
+
+    def _interval(self, current_chunk, chunk_delay, elapsed):
+        self.synchronizer._chunk_delay = chunk_delay
+        self.synchronizer._sweep_started = 1000.0
+        with mock.patch.object(sync.time, 'time',
+                               return_value=1000.0 + elapsed):
+            return self.synchronizer._paced_interval(
+                mock.Mock(current_chunk=current_chunk)
+            )
+
+    def test_chunks_spaced_by_pacer_delay(self):
+        self.assertEqual(7, self._interval(3, 7, 30))
+
+    @mock.patch.object(sync.random, 'randint', return_value=5)
+    def test_next_sweep_starts_sync_interval_after_last(self, _):
+        self.assertEqual(95, self._interval(0, 7, 30))
+
+    @mock.patch.object(sync.random, 'randint', return_value=5)
+    def test_next_sweep_waits_for_pacer_delay(self, _):
+        self.assertEqual(205, self._interval(0, 200, 30))
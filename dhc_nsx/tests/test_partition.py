@@ -0,0 +1,141 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+import sqlalchemy as sa
+from sqlalchemy import orm
+import testtools
+
+from dhc_nsx.ml2 import models
+from dhc_nsx.ml2 import partition
+
+
+KEYS = ['net-%d' % index for index in range(3000)]
+
+
+class TestHashRing(testtools.TestCase):
+
+    def _owners(self, ring):
+        return dict((key, ring.get_member(key)) for key in KEYS)
+
+    def test_empty_ring_owns_nothing(self):
+        self.assertIsNone(partition.HashRing([]).get_member('net'))
+
+    def test_single_member_owns_everything(self):
+        ring = partition.HashRing(['a'])
+        self.assertEqual(set(['a']), set(self._owners(ring).values()))
+
+    def test_ownership_does_not_depend_on_member_order(self):
+        self.assertEqual(self._owners(partition.HashRing(['a', 'b', 'c'])),
+                         self._owners(partition.HashRing(['c', 'a', 'b'])))
+
+    def test_keys_spread_over_members(self):
+        owners = self._owners(partition.HashRing(['a', 'b', 'c']))
+        for member in 'abc':
+            share = owners.values().count(member) / float(len(KEYS))
+            self.assertTrue(0.2 < share < 0.5, '%s owns %s' % (member, share))
+
+    def test_member_loss_only_moves_its_keys(self):
+        before = self._owners(partition.HashRing(['a', 'b', 'c']))
+        after = self._owners(partition.HashRing(['a', 'b']))
+        for key in KEYS:
+            if before[key] == 'c':
+                self.assertIn(after[key], ('a', 'b'))
+            else:
+                self.assertEqual(before[key], after[key])
+
+    def test_member_join_only_takes_keys(self):
+        before = self._owners(partition.HashRing(['a', 'b']))
+        after = self._owners(partition.HashRing(['a', 'b', 'c']))
+        moved = [key for key in KEYS if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertEqual(set(['c']), set(after[key] for key in moved))
+
+
+class TestSyncPartitioner(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSyncPartitioner, self).setUp()
+        engine = sa.create_engine('sqlite://')
+        self.session = orm.sessionmaker(bind=engine, autocommit=True)()
+
+    def _expire(self, member_id):
+        with self.session.begin():
+            self.session.query(models.SyncLease).filter_by(
+                member_id=member_id
+            ).update({'expires_at': datetime.datetime(2000, 1, 1)})
+
+    def _leases(self):
+        return sorted(lease.member_id
+                      for lease in self.session.query(models.SyncLease))
+
+    def test_members_share_keys(self):
+        first = partition.SyncPartitioner(60, member_id='a')
+        second = partition.SyncPartitioner(60, member_id='b')
+        self.assertFalse(first.heartbeat(self.session))
+        self.assertTrue(second.heartbeat(self.session))
+        self.assertTrue(first.heartbeat(self.session))
+        for key in KEYS:
+            self.assertNotEqual(first.owns(key), second.owns(key))
+
+    def test_unchanged_members_keep_ring(self):
+        member = partition.SyncPartitioner(60, member_id='a')
+        member.heartbeat(self.session)
+        ring = member.ring
+        self.assertFalse(member.heartbeat(self.session))
+        self.assertIs(ring, member.ring)
+
+    def test_takeover_on_member_loss(self):
+        first = partition.SyncPartitioner(60, member_id='a')
+        second = partition.SyncPartitioner(60, member_id='b')
+        first.heartbeat(self.session)
+        second.heartbeat(self.session)
+        first.heartbeat(self.session)
+        self.assertFalse(all(first.owns(key) for key in KEYS))
+
+        self._expire('b')
+        self.assertTrue(first.heartbeat(self.session))
+        self.assertEqual(['a'], self._leases())
+        self.assertTrue(all(first.owns(key) for key in KEYS))
+
+    @mock.patch.object(partition.socket, 'gethostname', return_value='host')
+    def test_forked_worker_owns_nothing_until_heartbeat(self, _):
+        with mock.patch.object(partition.os, 'getpid', return_value=1234):
+            member = partition.SyncPartitioner(60)
+            member.heartbeat(self.session)
+        with mock.patch.object(partition.os, 'getpid', return_value=4321):
+            self.assertFalse(member.owns('net'))
+            with mock.patch.object(partition, '_process_exists',
+                                   return_value=True):
+                self.assertTrue(member.heartbeat(self.session))
+            self.assertEqual('host:4321', member.member_id)
+            # the parent still renews its own lease
+            self.assertEqual(['host:1234', 'host:4321'], self._leases())
+            owned = [key for key in KEYS if member.owns(key)]
+            self.assertTrue(0 < len(owned) < len(KEYS))
+
+    @mock.patch.object(partition.socket, 'gethostname', return_value='host')
+    def test_forked_worker_drops_lease_of_dead_parent(self, _):
+        with mock.patch.object(partition.os, 'getpid', return_value=1234):
+            member = partition.SyncPartitioner(60)
+            member.heartbeat(self.session)
+        with mock.patch.object(partition.os, 'getpid', return_value=4321):
+            with mock.patch.object(partition, '_process_exists',
+                                   return_value=False):
+                member.heartbeat(self.session)
+            self.assertEqual(['host:4321'], self._leases())
+            self.assertTrue(all(member.owns(key) for key in KEYS))
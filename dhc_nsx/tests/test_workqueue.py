@@ -0,0 +1,100 @@
+# Copyright (c) 2015 Akanda Inc
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+from eventlet import event
+import testtools
+
+from dhc_nsx.ml2 import workqueue
+
+
+class TestOrderedWorkQueue(testtools.TestCase):
+
+    def setUp(self):
+        super(TestOrderedWorkQueue, self).setUp()
+        self.done = []
+
+    def _work(self, name, delay=0, wait_for=None, fail=False):
+        if wait_for is not None:
+            wait_for.wait()
+        eventlet.sleep(delay)
+        self.done.append(name)
+        if fail:
+            raise RuntimeError(name)
+
+    def test_same_key_runs_in_submission_order(self):
+        queue = workqueue.OrderedWorkQueue(4)
+        for index in range(5):
+            # later work is quicker, but must not overtake
+            queue.submit('net', self._work, index, delay=0.01 * (5 - index))
+        queue.waitall()
+        self.assertEqual(range(5), self.done)
+        self.assertEqual(0, queue.pending())
+
+    def test_keys_run_concurrently(self):
+        queue = workqueue.OrderedWorkQueue(2)
+        blocker = event.Event()
+        queue.submit('net1', self._work, 'net1', wait_for=blocker)
+        queue.submit('net2', self._work, 'net2')
+        eventlet.sleep(0.01)
+        self.assertEqual(['net2'], self.done)
+        self.assertEqual(1, queue.pending())
+        blocker.send()
+        queue.waitall()
+        self.assertEqual(['net2', 'net1'], self.done)
+
+    def test_failed_work_does_not_stop_key(self):
+        queue = workqueue.OrderedWorkQueue(2)
+        queue.submit('net', self._work, 'first', fail=True)
+        queue.submit('net', self._work, 'second')
+        queue.waitall()
+        self.assertEqual(['first', 'second'], self.done)
+
+    def test_child_waits_for_parent(self):
+        queue = workqueue.OrderedWorkQueue(4)
+        queue.submit('net', self._work, 'network', delay=0.02)
+        queue.submit_after('net', 'port', self._work, 'port1')
+        queue.submit('port', self._work, 'port2')
+        queue.waitall()
+        self.assertEqual(['network', 'port1', 'port2'], self.done)
+
+    def test_child_does_not_wait_for_later_parent_work(self):
+        queue = workqueue.OrderedWorkQueue(4)
+        blocker = event.Event()
+        queue.submit('net', self._work, 'network')
+        queue.submit_after('net', 'port', self._work, 'port')
+        queue.submit('net', self._work, 'network update', wait_for=blocker)
+        eventlet.sleep(0.01)
+        self.assertEqual(['network', 'port'], self.done)
+        blocker.send()
+        queue.waitall()
+        self.assertEqual(['network', 'port', 'network update'], self.done)
+
+    def test_child_without_pending_parent_runs_at_once(self):
+        queue = workqueue.OrderedWorkQueue(2)
+        queue.submit_after('net', 'port', self._work, 'port')
+        queue.waitall()
+        self.assertEqual(['port'], self.done)
+
+    def test_waitall_covers_released_keys(self):
+        # with a single greenthread, the released child can only start
+        # once the parent's has returned to the pool
+        queue = workqueue.OrderedWorkQueue(1)
+        queue.submit('net', self._work, 'network')
+        queue.submit_after('net', 'port1', self._work, 'port1')
+        queue.submit_after('net', 'port2', self._work, 'port2')
+        queue.waitall()
+        self.assertEqual(['network', 'port1', 'port2'], self.done)
+        self.assertEqual(0, queue.pending())